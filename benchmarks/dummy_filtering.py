@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark DummyStorage lookups answered from its indexes against a full scan.
+
+Loads patients into a DummyStorage and times each lookup through the indexed
+filter/count methods and through a scan which checks every record, as the
+storage did before it was indexed.
+
+    python benchmarks/dummy_filtering.py --rows=200000
+"""
+import datetime
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+
+parser = optparse.OptionParser()
+parser.add_option('--rows', type='int', default=200000, help='Number of patients to load.')
+parser.add_option('--lookups', type='int', default=50, help='Number of times to run each lookup.')
+parser.add_option('--seed', type='int', default=42, help='Random seed for the generated data.')
+opts, args = parser.parse_args()
+
+
+if not settings.configured:
+    settings.configure(USE_TZ=True)
+
+
+from healthcare.backends import comparisons
+from healthcare.backends.dummy import DummyStorage
+
+
+LOCATIONS = 1000
+START = datetime.date(1940, 1, 1)
+
+
+def load(backend, rows):
+    "Create patients with spread out locations and birth dates."
+    for i in range(rows):
+        backend.create_patient({
+            'name': 'Patient {0}'.format(i), 'sex': random.choice('MF'),
+            'location': 'Location {0}'.format(random.randint(0, LOCATIONS - 1)),
+            'birth_date': START + datetime.timedelta(days=random.randint(0, 365 * 70)),
+            'status': random.choice('AAAAI'),
+        })
+
+
+def scan(backend, lookups):
+    "Check every record against the lookups."
+    filters = [backend._lookup_to_filter(lookup) for lookup in lookups]
+    return [r for r in backend._patients.records.values() if all(f(r) for f in filters)]
+
+
+def lookups(i):
+    "The lookups to time for the i-th sample."
+    location = 'Location {0}'.format(i % LOCATIONS)
+    born = START + datetime.timedelta(days=i % (365 * 70))
+    return (
+        ('equal', [('location', comparisons.EQUAL, location)]),
+        ('in', [('location', comparisons.IN, [location, 'Location 0', 'Location 1'])]),
+        ('range', [('birth_date', comparisons.GTE, born),
+                   ('birth_date', comparisons.LT, born + datetime.timedelta(days=30))]),
+        ('equal_and_range', [('location', comparisons.EQUAL, location),
+                             ('birth_date', comparisons.GT, born)]),
+        ('status_count', [('status', comparisons.EQUAL, 'I')]),
+    )
+
+
+def percentiles(timings):
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    random.seed(opts.seed)
+    backend = DummyStorage()
+    start = time.time()
+    load(backend, opts.rows)
+    print('Loaded {0} patients in {1:.1f}s'.format(opts.rows, time.time() - start))
+    samples = [random.randint(0, opts.rows) for i in range(opts.lookups)]
+    # Build the indexes up front so their one-off cost is reported separately
+    start = time.time()
+    for name, lookup in lookups(0):
+        backend.count_patients(*lookup)
+    print('Built indexes in {0:.1f}s'.format(time.time() - start))
+    scanned, indexed = {}, {}
+    for i in samples:
+        for name, lookup in lookups(i):
+            start = time.time()
+            expected = len(scan(backend, lookup))
+            scanned.setdefault(name, []).append((time.time() - start) * 1000)
+            start = time.time()
+            if name.endswith('_count'):
+                found = backend.count_patients(*lookup)
+            else:
+                found = len(list(backend.filter_patients(*lookup)))
+            indexed.setdefault(name, []).append((time.time() - start) * 1000)
+            assert found == expected, (name, found, expected)
+    print('{0:<20} {1:>12} {2:>12} {3:>14} {4:>14}'.format(
+        'Lookup (ms)', 'Scan median', 'Scan p95', 'Index median', 'Index p95'))
+    for name, lookup in lookups(0):
+        print('{0:<20} {1:>12.3f} {2:>12.3f} {3:>14.3f} {4:>14.3f}'.format(
+            name, *(percentiles(scanned[name]) + percentiles(indexed[name]))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark the cost of importing healthcare.api and of creating API clients.
+
+Imports healthcare.api in a new Python process for each run, so nothing is
+already imported, and reports the time taken and the modules it loaded, then
+times creating the first and later clients for a backend path in this process.
+
+    python benchmarks/import_time.py --runs=20
+"""
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from django.conf import settings
+
+
+parser = optparse.OptionParser()
+parser.add_option('--runs', type='int', default=20, help='Number of processes importing the module.')
+parser.add_option('--clients', type='int', default=1000, help='Number of clients to create.')
+parser.add_option('--backend', default='healthcare.backends.djhealth.DjangoStorage',
+    help='Full Python path of the backend of the clients.')
+opts, args = parser.parse_args()
+
+
+CONFIGURE = """
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=('healthcare', 'healthcare.backends.djhealth'),
+)
+"""
+
+# Run in each process: Django's settings are imported first so only healthcare.api is timed
+IMPORT = """
+import sys, time
+import django.conf
+%s
+before = set(sys.modules)
+start = time.time()
+import healthcare.api
+seconds = time.time() - start
+loaded = [name for name in set(sys.modules) - before if sys.modules[name] is not None]
+models = 'healthcare.backends.djhealth.models' in sys.modules
+print('%%f %%d %%d' %% (seconds, len(loaded), models))
+"""
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def import_once(configured):
+    """
+    Seconds taken to import healthcare.api in a new process, the number of modules
+    it loaded and whether they include the models, or None if the import failed.
+    """
+    code = IMPORT % (CONFIGURE if configured else '')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen([sys.executable, '-c', code], env=env, cwd=ROOT,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    if process.returncode:
+        return None
+    seconds, loaded, models = output.split()
+    return float(seconds), int(loaded), models == b'1'
+
+
+def report(name, configured):
+    results = [import_once(configured) for i in range(opts.runs)]
+    if None in results:
+        print('{0}: failed'.format(name))
+        return
+    timings = sorted(seconds * 1000 for seconds, loaded, models in results)
+    print('{0}: median {1:.1f}ms, min {2:.1f}ms, {3} modules, models imported: {4}'.format(
+        name, timings[len(timings) // 2], timings[0], results[0][1], results[0][2]))
+
+
+def main():
+    report('import without settings', configured=False)
+    report('import with settings', configured=True)
+
+    if not settings.configured:
+        exec(CONFIGURE)
+    from healthcare.api import HealthcareAPI
+    # The first client imports and creates the backend if it wasn't imported with the module
+    start = timer()
+    HealthcareAPI(opts.backend)
+    first = timer() - start
+    start = timer()
+    for i in range(opts.clients):
+        HealthcareAPI(opts.backend)
+    seconds = timer() - start
+    print('clients of {0}: first {1:.1f}ms, then {2:.3f}ms each'.format(
+        opts.backend.rsplit('.', 1)[-1], first * 1000, seconds * 1000 / opts.clients))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Benchmark the djhealth lookups before and after the 0002 index migration.
+
+Loads patients, each with a source id, into a SQLite database migrated to 0001,
+times the common lookups, migrates to 0002 and times the same lookups again.
+Requires South.
+
+    python benchmarks/lookup_indexes.py --rows=1000000
+"""
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+
+parser = optparse.OptionParser()
+parser.add_option('--rows', type='int', default=1000000, help='Number of patients to load.')
+parser.add_option('--lookups', type='int', default=200, help='Number of times to run each lookup.')
+parser.add_option('--seed', type='int', default=42, help='Random seed for the generated data.')
+opts, args = parser.parse_args()
+
+
+directory = tempfile.mkdtemp()
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(directory, 'benchmark.db'),
+            }
+        },
+        INSTALLED_APPS=(
+            'healthcare',
+            'healthcare.backends.djhealth',
+            'south',
+        ),
+        HEALTHCARE_STORAGE_BACKEND='healthcare.backends.djhealth.DjangoStorage',
+    )
+
+
+from django.core.management import call_command
+from django.db import transaction
+
+from healthcare.backends import comparisons
+from healthcare.backends.djhealth import DjangoStorage
+from healthcare.backends.djhealth.models import Patient, PatientID
+from healthcare.utils import chunked
+
+
+SOURCES = ('NationalID', 'ClinicA', 'ClinicB', 'ClinicC', 'ClinicD')
+LOCATIONS = 1000
+
+
+def load(rows):
+    "Load patients with one source id each in batches."
+    for batch in chunked(xrange(1, rows + 1), 10000):
+        with transaction.commit_on_success():
+            Patient.objects.bulk_create([
+                Patient(pk=i, name='Patient {0}'.format(i), sex=random.choice('MF'),
+                        location='Location {0}'.format(i % LOCATIONS))
+                for i in batch
+            ])
+            PatientID.objects.bulk_create([
+                PatientID(uid=str(i), source=SOURCES[i % len(SOURCES)], patient_id=i)
+                for i in batch
+            ])
+
+
+def measure(rows, count):
+    "Time each lookup and return the latency percentiles in milliseconds."
+    backend = DjangoStorage()
+    samples = [random.randint(1, rows) for i in range(count)]
+    lookups = (
+        ('get_by_source', lambda i: backend.get_patient(str(i), source=SOURCES[i % len(SOURCES)])),
+        ('filter_by_name', lambda i: list(backend.filter_patients(
+            ('name', comparisons.EQUAL, 'Patient {0}'.format(i))))),
+        ('filter_by_location', lambda i: list(backend.filter_patients(
+            ('location', comparisons.EQUAL, 'Location {0}'.format(i % LOCATIONS)), limit=50))),
+        ('count_by_status', lambda i: backend.count_patients(('status', comparisons.EQUAL, 'I'))),
+    )
+    results = {}
+    for name, lookup in lookups:
+        timings = []
+        for i in samples:
+            start = time.time()
+            lookup(i)
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        results[name] = {
+            'median': timings[len(timings) // 2],
+            'p95': timings[int(len(timings) * 0.95) - 1],
+        }
+    return results
+
+
+def main():
+    random.seed(opts.seed)
+    try:
+        call_command('syncdb', verbosity=0, interactive=False)
+        call_command('migrate', 'djhealth', '0001', verbosity=0)
+        start = time.time()
+        load(opts.rows)
+        print('Loaded {0} patients in {1:.1f}s'.format(opts.rows, time.time() - start))
+        before = measure(opts.rows, opts.lookups)
+        start = time.time()
+        call_command('migrate', 'djhealth', '0002', verbosity=0)
+        print('Built indexes in {0:.1f}s'.format(time.time() - start))
+        after = measure(opts.rows, opts.lookups)
+        print('{0:<20} {1:>14} {2:>14} {3:>14} {4:>14}'.format(
+            'Lookup (ms)', 'Before median', 'Before p95', 'After median', 'After p95'))
+        for name in sorted(before):
+            print('{0:<20} {1:>14.3f} {2:>14.3f} {3:>14.3f} {4:>14.3f}'.format(
+                name, before[name]['median'], before[name]['p95'],
+                after[name]['median'], after[name]['p95']))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,216 @@ Healthcare API client.
 from __future__ import unicode_literals
 
 import operator
+import threading
 
 from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 
-from .backends import comparisons
-from .backends.base import get_backend
+from .backends import aggregates, comparisons
+from .backends.aggregates import AGE_BANDS, AgeBands
+from .backends.asynchronous import AsyncHealthcareStorage, SyncStorageAdapter, settle, then
+from .backends.base import ResultSet, get_backend
+from .backends.caching import LRUCache
+from .backends.expressions import And, Not, Or
+from .backends.search import SEARCH_FIELDS
 
 from .exceptions import PatientDoesNotExist, ProviderDoesNotExist
+from .instrumentation import get_instrumentation
+from .loader import AsyncCategoryLoader, DataLoader
+from .utils import chunked, freeze
+
+
+class BulkResult(object):
+    """
+    Outcome of a bulk call. ``results`` holds the backend result for each item in
+    the order given and ``errors`` maps the position of each failed item to the reason.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.errors = {}
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+
+def copy_result(result):
+    "Copy a shared result so that callers can't change each other's records."
+    if isinstance(result, dict):
+        return dict(result)
+    if isinstance(result, ResultSet):
+        return result.copy()
+    return result
+
+
+def load_result(result):
+    "Load a filter result so that it can be shared."
+    if isinstance(result, ResultSet):
+        len(result)
+    return result
+
+
+class Flight(object):
+    "A call in progress which other callers can wait on."
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+
+class SingleFlight(object):
+    """
+    Merges identical calls made while the first of them is still in progress so that
+    only one reaches the backend. The other callers, from threads or from an asyncio
+    event loop, get a copy of its result or the same error.
+    """
+
+    def __init__(self):
+        self.calls = self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._futures = {}
+
+    @property
+    def stats(self):
+        "Number of calls made and how many of those shared another call's result."
+        return {'calls': self.calls, 'coalesced': self.coalesced}
+
+    def _hashable(self, key):
+        try:
+            hash(key)
+        except TypeError:
+            return False
+        return True
+
+    def do(self, key, call):
+        "Return the result of call or wait for an identical call in progress to finish."
+        if not self._hashable(key):
+            with self._lock:
+                self.calls += 1
+            return call()
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy_result(flight.result)
+        try:
+            flight.result = call()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def do_async(self, key, call, loop):
+        "Return the future from call or a copy of an identical future still pending."
+        with self._lock:
+            self.calls += 1
+            future = self._futures.get(key) if self._hashable(key) else None
+            if future is not None:
+                self.coalesced += 1
+        if future is not None:
+            return then(future, copy_result, loop)
+        future = call()
+        if self._hashable(key):
+            with self._lock:
+                self._futures[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+
+class Q(object):
+    """
+    Filter expression of keyword lookups, given as for filter, which must all match.
+    Expressions can be combined with & and | and negated with ~.
+    """
+
+    def __init__(self, **lookups):
+        self.connector = And
+        self.children = sorted(lookups.items())
+
+    def _combine(self, connector, *children):
+        combined = Q()
+        combined.connector, combined.children = connector, list(children)
+        return combined
+
+    def __and__(self, other):
+        if not isinstance(other, Q):
+            return NotImplemented
+        return self._combine(And, self, other)
+
+    def __or__(self, other):
+        if not isinstance(other, Q):
+            return NotImplemented
+        return self._combine(Or, self, other)
+
+    def __invert__(self):
+        return self._combine(Not, self)
+
+    def resolve(self, translate):
+        "Backend expression with the keyword lookups converted by translate."
+        return self.connector(*[
+            child.resolve(translate) if isinstance(child, Q) else translate(*child)
+            for child in self.children
+        ])
+
+
+class PreparedQuery(object):
+    """
+    Filter returned by prepare. Its lookups have already been parsed and compiled by
+    the backend so running it only binds the values.
+    """
+
+    def __init__(self, wrapper, names, defaults, plan):
+        self.names, self.defaults = names, defaults
+        self.positions = dict((name, i) for i, name in enumerate(names))
+        fields = [name.split('__')[0] for name in names]
+        for i, field in enumerate(fields):
+            # Values can also be given by field name when it has only one lookup
+            if fields.count(field) == 1:
+                self.positions.setdefault(field, i)
+        self._run = wrapper._method('prepared_filter_{category}s', plan.run)
+
+    def run(self, limit=None, offset=None, after=None, **values):
+        """
+        Returns a lazy iterable of the records matching the lookups with the values
+        given by lookup or field name. limit, offset and after select a page as
+        they do for filter.
+        """
+        bound = list(self.defaults)
+        for name, value in values.items():
+            if name not in self.positions:
+                raise TypeError("Unknown query parameter: {0}".format(name))
+            bound[self.positions[name]] = value
+        missing = [name for name, value in zip(self.names, bound) if value is Ellipsis]
+        if missing:
+            raise TypeError("Missing query parameters: {0}".format(', '.join(missing)))
+        options = {}
+        for name, value in (('limit', limit), ('offset', offset), ('after', after)):
+            if value is not None:
+                options[name] = value
+        return self._run(bound, **options)
 
 
 class CategoryWrapper(object):
@@ -27,25 +230,103 @@ class CategoryWrapper(object):
         'gte': comparisons.GTE,
     }
 
-    def __init__(self, backend, category):
+    _aggregate_mapping = {
+        'count': aggregates.COUNT,
+        'min': aggregates.MIN,
+        'max': aggregates.MAX,
+    }
+
+    # Number of items passed to the backend in each bulk call
+    bulk_batch_size = 500
+
+    def __init__(self, backend, category, coalescer=None, instrumentation=None):
         self.backend, self.category = backend, category
+        self.coalescer = coalescer
+        self.instrumentation = instrumentation
+        # Backend plans of the prepared filters keyed by their shape and options
+        self.plans = LRUCache(getattr(settings, 'HEALTHCARE_PLAN_CACHE_SIZE', 100))
+
+    def _method(self, name, method=None, **kwargs):
+        """
+        Backend method for the category, or the method given for that name, which is
+        instrumented when instrumentation is enabled.
+        """
+        name = name.format(category=self.category, **kwargs)
+        if method is None:
+            method = getattr(self.backend, name)
+        if self.instrumentation is None:
+            return method
+        return self.instrumentation.wrap(self.backend, self.category, name, method)
 
-    def get(self, id, **kwargs):
-        method = getattr(self.backend, 'get_{category}'.format(category=self.category))
-        return method(id, **kwargs)
+    def _coalesce(self, key, call):
+        "Share the result of identical calls which are in progress at the same time."
+        if self.coalescer is None:
+            return call()
+        return self.coalescer.do((self.category, ) + key, call)
+
+    def get(self, id, fields=None, **kwargs):
+        method = self._method('get_{category}')
+        if fields is not None:
+            kwargs['fields'] = fields
+        return self._coalesce(('get', id, freeze(kwargs)), lambda: method(id, **kwargs))
+
+    def get_many(self, ids):
+        "Returns a dictionary of the records found for the given ids keyed by id."
+        method = self._method('get_many_{category}s')
+        return method(list(ids))
 
     def create(self, **kwargs):
-        method = getattr(self.backend, 'create_{category}'.format(category=self.category))
+        method = self._method('create_{category}')
         return method(kwargs)
 
     def update(self, id, **kwargs):
-        method = getattr(self.backend, 'update_{category}'.format(category=self.category))
+        method = self._method('update_{category}')
         return bool(method(id, kwargs))
 
     def delete(self, id):
-        method = getattr(self.backend, 'delete_{category}'.format(category=self.category))
+        method = self._method('delete_{category}')
         return bool(method(id))
 
+    def _add_batch(self, outcome, batch, results, error, failure):
+        "Add the results of a bulk batch, failing every item if the call raised an error."
+        start = len(outcome.results)
+        if error is not None:
+            results, reason = [None] * len(batch), '{0}'.format(error)
+        else:
+            results, reason = list(results), failure
+        for i, result in enumerate(results):
+            if not result:
+                outcome.errors[start + i] = reason
+        outcome.results.extend(results)
+
+    def _bulk(self, action, items, batch_size, failure):
+        "Pass items to a backend bulk method in batches and collect per-item errors."
+        method = self._method('bulk_{action}_{category}s', action=action)
+        outcome = BulkResult()
+        for batch in chunked(items, batch_size or self.bulk_batch_size):
+            try:
+                results, error = list(method(batch)), None
+            except Exception as e:
+                # A failure of the whole batch shouldn't abort the remaining batches
+                results, error = None, e
+            self._add_batch(outcome, batch, results, error, failure)
+        return outcome
+
+    def bulk_create(self, items, batch_size=None):
+        "Create a record for each dictionary in items."
+        failure = "{0} could not be created".format(self.category.title())
+        return self._bulk('create', items, batch_size, failure)
+
+    def bulk_update(self, updates, batch_size=None):
+        "Update records from an iterable of (id, data) pairs."
+        failure = "{0} was not found".format(self.category.title())
+        return self._bulk('update', updates, batch_size, failure)
+
+    def bulk_delete(self, ids, batch_size=None):
+        "Delete the records for each id."
+        failure = "{0} was not found".format(self.category.title())
+        return self._bulk('delete', ids, batch_size, failure)
+
     def _translate_filter_expression(self, name, value):
         "Convert a field lookup into the appropriate backend call."
         parts = name.split('__')
@@ -60,20 +341,145 @@ class CategoryWrapper(object):
             raise TypeError("Invalid lookup type: {0}".format(lookup))
         return (field_name, comparison, value)
 
-    def filter(self, **kwargs):
-        method = getattr(self.backend, 'filter_{category}s'.format(category=self.category))
+    def _lookups(self, expressions, kwargs):
+        "Backend lookups for the keyword lookups and Q expressions."
         args = [self._translate_filter_expression(k, v) for k, v in kwargs.items()]
-        return method(args)
+        for expression in expressions:
+            if not isinstance(expression, Q):
+                raise TypeError("Invalid filter expression: {0!r}".format(expression))
+            args.append(expression.resolve(self._translate_filter_expression))
+        return args
+
+    def filter(self, *expressions, **kwargs):
+        """
+        Returns a lazy iterable of the records matching the keyword lookups and Q
+        expressions. The backend fetches the records in chunks of chunk_size as they
+        are consumed.
+
+        Results are sorted by the order_by field name(s), prefixed with '-' for descending
+        order, and then by id. limit and offset select a slice of the results while after
+        takes the cursor of a previous result to continue from its last record.
+
+        fields limits each record to the given field names along with the id and
+        order_by fields.
+
+        When coalescing, only filters with a limit are merged, since their records are
+        loaded to be shared, so other filters still stream their records.
+        """
+        options = {}
+        chunk_size = kwargs.pop('chunk_size', None)
+        if chunk_size:
+            options['chunk_size'] = chunk_size
+        for name in ('order_by', 'limit', 'offset', 'after', 'fields'):
+            value = kwargs.pop(name, None)
+            if value is not None:
+                options[name] = value
+        method = self._method('filter_{category}s')
+        args = self._lookups(expressions, kwargs)
+        if self.coalescer is None or 'limit' not in options:
+            return method(*args, **options)
+        key = ('filter', frozenset(freeze(args)), freeze(options))
+        return self._coalesce(key, lambda: load_result(method(*args, **options)))
+
+    def prepare(self, chunk_size=None, order_by=None, fields=None, **kwargs):
+        """
+        Prepare a filter for the lookups, given as for filter, whose values are bound
+        when it is run. A value of Ellipsis must be given to run while other values
+        are used unless run is given another. The backend plan for the lookups and
+        options is compiled once and kept in a bounded cache.
+        """
+        names = sorted(kwargs)
+        shape = tuple(self._translate_filter_expression(name, None)[:2] for name in names)
+        options = {}
+        for name, value in (('chunk_size', chunk_size), ('order_by', order_by), ('fields', fields)):
+            if value is not None:
+                options[name] = value
+        key = (shape, freeze(options))
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self._method('prepare_{category}s')(shape, **options)
+            self.plans.set(key, plan)
+        return PreparedQuery(self, names, [kwargs[name] for name in names], plan)
+
+    def count(self, *expressions, **kwargs):
+        "Number of records matching the lookups."
+        method = self._method('count_{category}s')
+        return method(*self._lookups(expressions, kwargs))
+
+    def exists(self, *expressions, **kwargs):
+        "Whether any records match the lookups."
+        method = self._method('exists_{category}s')
+        return bool(method(*self._lookups(expressions, kwargs)))
+
+    def _translate_aggregate(self, name):
+        "Convert 'count' or a '<field>__<function>' aggregate into the backend (name, function, field)."
+        parts = name.split('__')
+        field = parts[0] if len(parts) > 1 else None
+        function = self._aggregate_mapping.get(parts[-1])
+        if function is None or (field is None and function != aggregates.COUNT):
+            raise TypeError("Invalid aggregate: {0}".format(name))
+        return (name, function, field)
+
+    def _translate_group(self, name, age_bands, as_of):
+        "Convert a field name or '<date field>__age' into a backend group."
+        parts = name.split('__')
+        if len(parts) == 1:
+            return name
+        if parts[-1] != 'age':
+            raise TypeError("Invalid group: {0}".format(name))
+        return AgeBands(parts[0], age_bands, as_of, name=name)
+
+    def aggregate(self, *expressions, **kwargs):
+        """
+        Summarize the records matching the lookups. aggregates lists 'count' for the
+        number of records and '<field>__count', '<field>__min' or '<field>__max' for the
+        values of a field. Returns a dictionary of the aggregates for each combination of
+        the group_by field values, ordered by those values.
+
+        A date field in group_by followed by '__age', such as 'birth_date__age', groups
+        by age bands which start at each of the age_bands years on the as_of date.
+        """
+        group_by = kwargs.pop('group_by', None) or []
+        if not isinstance(group_by, (list, tuple)):
+            group_by = [group_by]
+        names = kwargs.pop('aggregates', None) or ['count']
+        age_bands = kwargs.pop('age_bands', None) or AGE_BANDS
+        as_of = kwargs.pop('as_of', None)
+        method = self._method('aggregate_{category}s')
+        return method(
+            *self._lookups(expressions, kwargs),
+            group_by=[self._translate_group(name, age_bands, as_of) for name in group_by],
+            aggregates=[self._translate_aggregate(name) for name in names])
+
+    def group_by(self, *fields, **kwargs):
+        "Number of records matching the lookups for each combination of the field values."
+        return self.aggregate(group_by=list(fields), **kwargs)
+
+    def search(self, text, fields=None, limit=None, threshold=None):
+        """
+        Returns up to limit records, best match first, with a field which contains each
+        word of the text or which shares at least the threshold fraction of its trigrams
+        so that misspellings are found. Patients are searched by name and location and
+        providers by name unless fields are given.
+        """
+        if fields is not None:
+            if not isinstance(fields, (list, tuple)):
+                fields = [fields]
+            invalid = [field for field in fields if field not in SEARCH_FIELDS[self.category]]
+            if invalid:
+                raise TypeError("Invalid search field: {0}".format(', '.join(invalid)))
+        method = self._method('search_{category}s')
+        return method(text, fields=fields, limit=limit, threshold=threshold)
 
 
 class PatientWrapper(CategoryWrapper):
     "Wrapper around backend patient calls."
 
-    def __init__(self, backend):
-        super(PatientWrapper, self).__init__(backend, 'patient')
+    def __init__(self, backend, coalescer=None, instrumentation=None):
+        super(PatientWrapper, self).__init__(backend, 'patient', coalescer, instrumentation)
 
-    def get(self, id, source=None):
-        result = super(PatientWrapper, self).get(id, source=source)
+    def _found(self, result, id, source=None):
+        "Return the patient or raise PatientDoesNotExist if it wasn't found."
         if result is None:
             if source:
                 message = "Patient ID {0} for {1} was not found".format(id, source)
@@ -82,38 +488,204 @@ class PatientWrapper(CategoryWrapper):
             raise PatientDoesNotExist(message)
         return result
 
+    def get(self, id, source=None, fields=None):
+        result = super(PatientWrapper, self).get(id, source=source, fields=fields)
+        return self._found(result, id, source)
+
+    def get_many_by_source(self, pairs):
+        """
+        Returns a dictionary of the patients found for the given (source_id, source_name)
+        pairs keyed by pair.
+        """
+        return self._method('get_many_patients_by_source')(list(pairs))
+
+    def find_duplicates(self, record, limit=None, threshold=None):
+        """
+        Returns (patient, score) for the patients which may be duplicates of the record,
+        a dictionary of patient fields such as a new registration or the id of a stored
+        patient, best first. Only the patients sharing a blocking key of the record, made
+        of the sound of its name with its birth year or location, are compared.
+        """
+        return self._method('find_duplicate_patients')(record, limit=limit, threshold=threshold)
+
+    def dedupe(self, threshold=None):
+        """
+        Returns (first id, second id, score) for each pair of patients which may be
+        duplicates, best first.
+        """
+        return self._method('dedupe_patients')(threshold=threshold)
+
     def link(self, id, source_id, source_name):
-        result = self.backend.link_patient(id, source_id, source_name)
+        result = self._method('link_patient')(id, source_id, source_name)
         return bool(result)
 
     def unlink(self, id, source_id, source_name):
-        result = self.backend.unlink_patient(id, source_id, source_name)
+        result = self._method('unlink_patient')(id, source_id, source_name)
         return bool(result)
 
 
 class ProviderWrapper(CategoryWrapper):
     "Wrapper around backend provider calls."
 
-    def __init__(self, backend):
-        super(ProviderWrapper, self).__init__(backend, 'provider')
+    def __init__(self, backend, coalescer=None, instrumentation=None):
+        super(ProviderWrapper, self).__init__(backend, 'provider', coalescer, instrumentation)
 
-    def get(self, id):
-        result = super(ProviderWrapper, self).get(id)
+    def _found(self, result, id):
+        "Return the provider or raise ProviderDoesNotExist if it wasn't found."
         if result is None:
             raise ProviderDoesNotExist("Provider ID {0} was not found".format(id))
         return result
 
+    def get(self, id, fields=None):
+        result = super(ProviderWrapper, self).get(id, fields=fields)
+        return self._found(result, id)
+
 
 class HealthcareAPI(object):
-    "API Client for accessing healthcare data via the configured backend."
+    """
+    API Client for accessing healthcare data via the configured backend. With coalesce
+    set, identical get and filter calls made at the same time share one backend call.
+    instrumentation is a list of sinks, or their paths, which are sent each backend call.
+    """
 
-    def __init__(self, backend):
+    def __init__(self, backend, coalesce=False, instrumentation=None):
         self.backend = get_backend(backend)
-        self.patients = PatientWrapper(self.backend)
-        self.providers = ProviderWrapper(self.backend)
+        self.coalescer = SingleFlight() if coalesce else None
+        self.instrumentation = get_instrumentation(instrumentation)
+        self.patients = PatientWrapper(self.backend, self.coalescer, self.instrumentation)
+        self.providers = ProviderWrapper(self.backend, self.coalescer, self.instrumentation)
+
+    def loader(self):
+        "Return a DataLoader which batches the gets made through it."
+        return DataLoader(self)
+
+    def changes(self, after=None, limit=None, chunk_size=None):
+        """
+        Returns a lazy iterable of the patient and provider changes in the order they were
+        made. Its cursor can be passed as after to continue from the last change seen.
+        """
+        method = self.backend.get_changes
+        if self.instrumentation is not None:
+            method = self.instrumentation.wrap(self.backend, None, 'get_changes')
+        return method(after=after, limit=limit, chunk_size=chunk_size)
+
+
+class AsyncCategoryWrapper(CategoryWrapper):
+    """
+    Wrapper which returns awaitable futures from an asynchronous backend. The
+    arguments and results are the same as the synchronous wrapper.
+    """
+
+    # AsyncCategoryLoader which batches the gets made in the same loop iteration
+    loader = None
+
+    def _then(self, future, callback):
+        return then(future, callback, self.backend.get_loop())
+
+    def _coalesce(self, key, call):
+        if self.coalescer is None:
+            return call()
+        return self.coalescer.do_async((self.category, ) + key, call, self.backend.get_loop())
+
+    def update(self, id, **kwargs):
+        method = self._method('update_{category}')
+        return self._then(method(id, kwargs), bool)
+
+    def delete(self, id):
+        method = self._method('delete_{category}')
+        return self._then(method(id), bool)
+
+    def _bulk(self, action, items, batch_size, failure):
+        "Start a backend bulk call for each batch and collect the per-item errors."
+        method = self._method('bulk_{action}_{category}s', action=action)
+        batches = list(chunked(items, batch_size or self.bulk_batch_size))
+
+        def collect(outcomes):
+            outcome = BulkResult()
+            for batch, (results, error) in zip(batches, outcomes):
+                self._add_batch(outcome, batch, results, error, failure)
+            return outcome
+
+        futures = [method(batch) for batch in batches]
+        return self._then(settle(futures, self.backend.get_loop()), collect)
+
+    def exists(self, *expressions, **kwargs):
+        method = self._method('exists_{category}s')
+        return self._then(method(*self._lookups(expressions, kwargs)), bool)
+
+
+class AsyncPatientWrapper(AsyncCategoryWrapper, PatientWrapper):
+    "Wrapper around asynchronous backend patient calls."
+
+    def get(self, id, source=None, fields=None):
+        if self.loader is not None:
+            return self.loader.get(id, source=source, fields=fields)
+        future = CategoryWrapper.get(self, id, source=source, fields=fields)
+        return self._then(future, lambda result: self._found(result, id, source))
+
+    def link(self, id, source_id, source_name):
+        return self._then(self._method('link_patient')(id, source_id, source_name), bool)
+
+    def unlink(self, id, source_id, source_name):
+        return self._then(self._method('unlink_patient')(id, source_id, source_name), bool)
+
+
+class AsyncProviderWrapper(AsyncCategoryWrapper, ProviderWrapper):
+    "Wrapper around asynchronous backend provider calls."
+
+    def get(self, id, fields=None):
+        if self.loader is not None:
+            return self.loader.get(id, fields=fields)
+        future = CategoryWrapper.get(self, id, fields=fields)
+        return self._then(future, lambda result: self._found(result, id))
+
+
+class AsyncHealthcareAPI(object):
+    """
+    API Client for accessing healthcare data from an asyncio event loop. Each method
+    returns an awaitable. A synchronous backend is run on a pool of at most
+    max_workers threads. With batch set, the gets made in the same iteration of the
+    event loop are fetched with one get_many call.
+    """
+
+    def __init__(self, backend, max_workers=None, loop=None, coalesce=False, batch=False,
+                 instrumentation=None):
+        backend = get_backend(backend)
+        if not isinstance(backend, AsyncHealthcareStorage):
+            backend = SyncStorageAdapter(backend, max_workers=max_workers, loop=loop)
+        self.backend = backend
+        self.coalescer = SingleFlight() if coalesce else None
+        self.instrumentation = get_instrumentation(instrumentation)
+        self.patients = AsyncPatientWrapper(self.backend, self.coalescer, self.instrumentation)
+        self.providers = AsyncProviderWrapper(self.backend, self.coalescer, self.instrumentation)
+        if batch:
+            self.patients.loader = AsyncCategoryLoader(self.patients)
+            self.providers.loader = AsyncCategoryLoader(self.providers)
+
+    def changes(self, after=None, limit=None, chunk_size=None):
+        "Returns a future of the changes made after the cursor, loaded into memory."
+        method = self.backend.get_changes
+        if self.instrumentation is not None:
+            method = self.instrumentation.wrap(self.backend, None, 'get_changes')
+        return method(after=after, limit=limit, chunk_size=chunk_size)
+
+
+DEFAULT_STORAGE_BACKEND = 'healthcare.backends.djhealth.DjangoStorage'
+
+
+def get_storage_backend():
+    "Full Python path of the backend set by HEALTHCARE_STORAGE_BACKEND."
+    return getattr(settings, 'HEALTHCARE_STORAGE_BACKEND', DEFAULT_STORAGE_BACKEND)
 
 
-STORAGE_BACKEND = getattr(settings, 'HEALTHCARE_STORAGE_BACKEND', 'healthcare.backends.djhealth.DjangoStorage')
+def get_client():
+    "Return a HealthcareAPI for the configured backend and settings."
+    return HealthcareAPI(
+        get_storage_backend(),
+        coalesce=getattr(settings, 'HEALTHCARE_COALESCE', False),
+        instrumentation=getattr(settings, 'HEALTHCARE_INSTRUMENTATION', None),
+    )
 
 
-client = HealthcareAPI(STORAGE_BACKEND)
+# The client, and its backend, are created when it's first used rather than on import
+client = SimpleLazyObject(get_client)
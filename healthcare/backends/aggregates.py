@@ -0,0 +1,115 @@
+"""
+Aggregate function constants and groupings for the backend aggregate methods.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+
+COUNT = 'count'
+MIN = 'min'
+MAX = 'max'
+
+# Lower bounds, in whole years, of the default age bands
+AGE_BANDS = (0, 5, 15, 25, 50, 65)
+
+
+def years_before(date, years):
+    "The same day of the year the given number of years earlier, using Feb 28 for Feb 29."
+    try:
+        return date.replace(year=date.year - years)
+    except ValueError:
+        return date.replace(year=date.year - years, day=28)
+
+
+def sort_value(value):
+    "Comparable form of a field or group value with empty values first."
+    return (0, ) if value is None else (1, value)
+
+
+class AgeBands(object):
+    """
+    Groups records by the age, in whole years on the as_of date, of a date field
+    such as the birth date. Each band starts at one of the bounds and ends before
+    the next, the last one has no end. The group value is the band's label, for
+    example '5-14' or '65+', or None for records without a date.
+    """
+
+    def __init__(self, field, bounds=AGE_BANDS, as_of=None, name=None):
+        self.field = field
+        self.bounds = sorted(bounds)
+        self.as_of = as_of or datetime.date.today()
+        self.name = name or '{0}__age'.format(field)
+        labels = [
+            '{0}-{1}'.format(bound, end - 1) for bound, end in zip(self.bounds, self.bounds[1:])
+        ] + ['{0}+'.format(self.bounds[-1])]
+        # Latest date in each band, oldest band first, so a date is in the first band it doesn't follow
+        self.cutoffs = list(reversed([
+            (label, years_before(self.as_of, bound)) for label, bound in zip(labels, self.bounds)
+        ]))
+
+    def band(self, value):
+        "Label of the band for a date or None if it's empty or before the first band."
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        for label, cutoff in self.cutoffs:
+            if value <= cutoff:
+                return label
+        return None
+
+
+def group_name(group):
+    "Name of the group value in the aggregate results."
+    return group.name if isinstance(group, AgeBands) else group
+
+
+class Aggregator(object):
+    """
+    Computes the aggregates of records added one at a time for each group of the
+    group_by values. aggregates is a list of (name, function, field) where a
+    count with no field counts the records and any other skips empty values.
+    """
+
+    def __init__(self, group_by, aggregates):
+        self.group_by, self.aggregates = list(group_by or []), list(aggregates)
+        self.names = [group_name(group) for group in self.group_by]
+        self.groups = {}
+
+    def _key(self, record):
+        return tuple(
+            group.band(record.get(group.field)) if isinstance(group, AgeBands) else record.get(group)
+            for group in self.group_by
+        )
+
+    def add(self, record):
+        key = self._key(record)
+        values = self.groups.get(key)
+        if values is None:
+            values = self.groups[key] = [0 if function == COUNT else None
+                                         for name, function, field in self.aggregates]
+        for i, (name, function, field) in enumerate(self.aggregates):
+            value = record.get(field) if field is not None else True
+            if value is None:
+                continue
+            if function == COUNT:
+                values[i] += 1
+            elif values[i] is None:
+                values[i] = value
+            elif function == MIN:
+                values[i] = min(values[i], value)
+            else:
+                values[i] = max(values[i], value)
+
+    def results(self):
+        "List of a dictionary of the group values and aggregates for each group in group value order."
+        groups = self.groups
+        if not groups and not self.group_by:
+            # Aggregates of all records are returned even when there are none
+            groups = {(): [0 if function == COUNT else None for name, function, field in self.aggregates]}
+        names = self.names + [name for name, function, field in self.aggregates]
+        return [
+            dict(zip(names, key + tuple(groups[key])))
+            for key in sorted(groups, key=lambda key: tuple(sort_value(value) for value in key))
+        ]
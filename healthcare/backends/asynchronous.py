@@ -0,0 +1,414 @@
+"""
+Asynchronous storage backend API and an adapter which runs a synchronous backend
+on a thread pool.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import functools
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .base import PreparedFilter
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures package
+    ThreadPoolExecutor = None
+
+# asyncio module, imported by get_asyncio
+_asyncio = []
+
+
+def get_asyncio():
+    """
+    Return the asyncio module, or trollius on Python 2, or None if neither is
+    installed. It's imported on first use so that only asynchronous clients load it.
+    """
+    if not _asyncio:
+        try:
+            import asyncio
+        except ImportError:  # Python 2
+            try:
+                import trollius as asyncio
+            except ImportError:
+                asyncio = None
+        _asyncio.append(asyncio)
+    return _asyncio[0]
+
+
+def completed(result, loop):
+    "Return a future which already has the given result."
+    future = get_asyncio().Future(loop=loop)
+    future.set_result(result)
+    return future
+
+
+def then(future, callback, loop):
+    "Return a future for the result of calling callback with the result of future."
+    chained = get_asyncio().Future(loop=loop)
+
+    def done(future):
+        if chained.cancelled():
+            return
+        if future.cancelled():
+            chained.cancel()
+        elif future.exception() is not None:
+            chained.set_exception(future.exception())
+        else:
+            try:
+                chained.set_result(callback(future.result()))
+            except Exception as e:
+                chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def settle(futures, loop):
+    """
+    Return a future for a list of (result, exception) pairs, in the order given,
+    once all of the futures are done.
+    """
+    combined = get_asyncio().Future(loop=loop)
+    outcomes = [None] * len(futures)
+    remaining = [len(futures)]
+
+    def done(i, future):
+        if future.cancelled():
+            outcomes[i] = (None, get_asyncio().CancelledError())
+        elif future.exception() is not None:
+            outcomes[i] = (None, future.exception())
+        else:
+            outcomes[i] = (future.result(), None)
+        remaining[0] -= 1
+        if not remaining[0] and not combined.cancelled():
+            combined.set_result(outcomes)
+
+    if not futures:
+        combined.set_result([])
+    for i, future in enumerate(futures):
+        future.add_done_callback(functools.partial(done, i))
+    return combined
+
+
+class AsyncHealthcareStorage(object):
+    """
+    Asynchronous variant of HealthcareStorage. Each method takes the same arguments
+    as the synchronous method and returns an awaitable future of the same result.
+    """
+
+    # Event loop for the returned futures, defaults to the current loop
+    loop = None
+
+    def get_loop(self):
+        "Return the event loop the futures are created on."
+        return self.loop or get_asyncio().get_event_loop()
+
+    def get_patient(self, id, source=None, fields=None):
+        "Retrieve a patient record by ID."
+        raise NotImplementedError("Define in subclass")
+
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs as a dictionary keyed by ID."
+        raise NotImplementedError("Define in subclass")
+
+    def get_many_patients_by_source(self, pairs):
+        "Retrieve patient records for a list of (source_id, source_name) pairs."
+        raise NotImplementedError("Define in subclass")
+
+    def create_patient(self, data):
+        "Create a patient record."
+        raise NotImplementedError("Define in subclass")
+
+    def update_patient(self, id, data):
+        "Update a patient record by ID."
+        raise NotImplementedError("Define in subclass")
+
+    def delete_patient(self, id):
+        "Delete a patient record."
+        raise NotImplementedError("Define in subclass")
+
+    def bulk_create_patients(self, data):
+        "Create patient records from a list of dictionaries."
+        raise NotImplementedError("Define in subclass")
+
+    def bulk_update_patients(self, updates):
+        "Update patient records from a list of (id, data) pairs."
+        raise NotImplementedError("Define in subclass")
+
+    def bulk_delete_patients(self, ids):
+        "Delete patient records from a list of IDs."
+        raise NotImplementedError("Define in subclass")
+
+    def filter_patients(self, *lookups, **options):
+        """
+        Find patient records matching the given lookups. The ResultSet should already
+        be loaded so that iterating it doesn't block the event loop.
+        """
+        raise NotImplementedError("Define in subclass")
+
+    def prepare_patients(self, shape, **options):
+        "Prepare a patient filter whose run method returns a future of the ResultSet."
+        return PreparedFilter(self.filter_patients, shape, options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def aggregate_patients(self, *lookups, **options):
+        "Aggregate the patient records matching the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        "Find the patient records matching the search query, best match first."
+        raise NotImplementedError("Define in subclass")
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        "Find the patients which may be duplicates of a record, best first."
+        raise NotImplementedError("Define in subclass")
+
+    def dedupe_patients(self, threshold=None):
+        "Find the pairs of patients which may be duplicates."
+        raise NotImplementedError("Define in subclass")
+
+    def link_patient(self, id, source_id, source_name):
+        "Associated a source/id pair with this patient."
+        raise NotImplementedError("Define in subclass")
+
+    def unlink_patient(self, id, source_id, source_name):
+        "Remove association of a source/id pair with this patient."
+        raise NotImplementedError("Define in subclass")
+
+    def get_provider(self, id, fields=None):
+        "Retrieve a provider record by ID."
+        raise NotImplementedError("Define in subclass")
+
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs as a dictionary keyed by ID."
+        raise NotImplementedError("Define in subclass")
+
+    def create_provider(self, data):
+        "Create a provider record."
+        raise NotImplementedError("Define in subclass")
+
+    def update_provider(self, id, data):
+        "Update a provider record by ID."
+        raise NotImplementedError("Define in subclass")
+
+    def delete_provider(self, id):
+        "Delete a provider record."
+        raise NotImplementedError("Define in subclass")
+
+    def bulk_create_providers(self, data):
+        "Create provider records from a list of dictionaries."
+        raise NotImplementedError("Define in subclass")
+
+    def bulk_update_providers(self, updates):
+        "Update provider records from a list of (id, data) pairs."
+        raise NotImplementedError("Define in subclass")
+
+    def bulk_delete_providers(self, ids):
+        "Delete provider records from a list of IDs."
+        raise NotImplementedError("Define in subclass")
+
+    def filter_providers(self, *lookups, **options):
+        "Find provider records matching the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def prepare_providers(self, shape, **options):
+        "Prepare a provider filter whose run method returns a future of the ResultSet."
+        return PreparedFilter(self.filter_providers, shape, options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def aggregate_providers(self, *lookups, **options):
+        "Aggregate the provider records matching the given lookups."
+        raise NotImplementedError("Define in subclass")
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        "Find the provider records matching the search query, best match first."
+        raise NotImplementedError("Define in subclass")
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        "Find the changes made after the cursor. The ResultSet should already be loaded."
+        raise NotImplementedError("Define in subclass")
+
+
+class SyncStorageAdapter(AsyncHealthcareStorage):
+    """
+    Runs the calls of a synchronous backend on a pool of at most max_workers threads,
+    given by the HEALTHCARE_ASYNC_WORKERS setting by default. Calls beyond that wait
+    in the pool's queue without blocking the event loop.
+    """
+
+    def __init__(self, backend, max_workers=None, executor=None, loop=None):
+        if get_asyncio() is None:
+            raise ImproperlyConfigured(
+                "Asynchronous storage requires asyncio or, on Python 2, trollius.")
+        if executor is None:
+            if ThreadPoolExecutor is None:
+                raise ImproperlyConfigured(
+                    "Asynchronous storage requires concurrent.futures or, on Python 2, futures.")
+            if max_workers is None:
+                max_workers = getattr(settings, 'HEALTHCARE_ASYNC_WORKERS', 10)
+            executor = ThreadPoolExecutor(max_workers)
+        self.backend, self.executor, self.loop = backend, executor, loop
+
+    def _run(self, name, *args, **kwargs):
+        call = functools.partial(getattr(self.backend, name), *args, **kwargs)
+        return self.get_loop().run_in_executor(self.executor, call)
+
+    def _filter(self, name, lookups, options):
+        method = getattr(self.backend, name)
+
+        def fetch():
+            result = method(*lookups, **options)
+            # Load the records on the worker thread rather than when iterated on the loop
+            len(result)
+            return result
+
+        return self.get_loop().run_in_executor(self.executor, fetch)
+
+    def get_patient(self, id, source=None, fields=None):
+        "Retrieve a patient record by ID."
+        kwargs = {'source': source} if source else {}
+        if fields is not None:
+            kwargs['fields'] = fields
+        return self._run('get_patient', id, **kwargs)
+
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs as a dictionary keyed by ID."
+        return self._run('get_many_patients', ids)
+
+    def get_many_patients_by_source(self, pairs):
+        "Retrieve patient records for a list of (source_id, source_name) pairs."
+        return self._run('get_many_patients_by_source', pairs)
+
+    def create_patient(self, data):
+        "Create a patient record."
+        return self._run('create_patient', data)
+
+    def update_patient(self, id, data):
+        "Update a patient record by ID."
+        return self._run('update_patient', id, data)
+
+    def delete_patient(self, id):
+        "Delete a patient record."
+        return self._run('delete_patient', id)
+
+    def bulk_create_patients(self, data):
+        "Create patient records from a list of dictionaries."
+        return self._run('bulk_create_patients', data)
+
+    def bulk_update_patients(self, updates):
+        "Update patient records from a list of (id, data) pairs."
+        return self._run('bulk_update_patients', updates)
+
+    def bulk_delete_patients(self, ids):
+        "Delete patient records from a list of IDs."
+        return self._run('bulk_delete_patients', ids)
+
+    def filter_patients(self, *lookups, **options):
+        "Find patient records matching the given lookups."
+        return self._filter('filter_patients', lookups, options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        return self._run('count_patients', *lookups)
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        return self._run('exists_patients', *lookups)
+
+    def aggregate_patients(self, *lookups, **options):
+        "Aggregate the patient records matching the given lookups."
+        return self._run('aggregate_patients', *lookups, **options)
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        "Find the patient records matching the search query, best match first."
+        return self._run('search_patients', query, fields=fields, limit=limit, threshold=threshold)
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        "Find the patients which may be duplicates of a record, best first."
+        return self._run('find_duplicate_patients', record, limit=limit, threshold=threshold)
+
+    def dedupe_patients(self, threshold=None):
+        "Find the pairs of patients which may be duplicates."
+        return self._run('dedupe_patients', threshold=threshold)
+
+    def link_patient(self, id, source_id, source_name):
+        "Associated a source/id pair with this patient."
+        return self._run('link_patient', id, source_id, source_name)
+
+    def unlink_patient(self, id, source_id, source_name):
+        "Remove association of a source/id pair with this patient."
+        return self._run('unlink_patient', id, source_id, source_name)
+
+    def get_provider(self, id, fields=None):
+        "Retrieve a provider record by ID."
+        kwargs = {'fields': fields} if fields is not None else {}
+        return self._run('get_provider', id, **kwargs)
+
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs as a dictionary keyed by ID."
+        return self._run('get_many_providers', ids)
+
+    def create_provider(self, data):
+        "Create a provider record."
+        return self._run('create_provider', data)
+
+    def update_provider(self, id, data):
+        "Update a provider record by ID."
+        return self._run('update_provider', id, data)
+
+    def delete_provider(self, id):
+        "Delete a provider record."
+        return self._run('delete_provider', id)
+
+    def bulk_create_providers(self, data):
+        "Create provider records from a list of dictionaries."
+        return self._run('bulk_create_providers', data)
+
+    def bulk_update_providers(self, updates):
+        "Update provider records from a list of (id, data) pairs."
+        return self._run('bulk_update_providers', updates)
+
+    def bulk_delete_providers(self, ids):
+        "Delete provider records from a list of IDs."
+        return self._run('bulk_delete_providers', ids)
+
+    def filter_providers(self, *lookups, **options):
+        "Find provider records matching the given lookups."
+        return self._filter('filter_providers', lookups, options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        return self._run('count_providers', *lookups)
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        return self._run('exists_providers', *lookups)
+
+    def aggregate_providers(self, *lookups, **options):
+        "Aggregate the provider records matching the given lookups."
+        return self._run('aggregate_providers', *lookups, **options)
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        "Find the provider records matching the search query, best match first."
+        return self._run('search_providers', query, fields=fields, limit=limit, threshold=threshold)
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        "Find the changes made after the cursor."
+        options = {'after': after, 'limit': limit, 'chunk_size': chunk_size}
+        return self._filter('get_changes', (), options)
@@ -3,33 +3,270 @@ Healthcare data storage backend API. All backends should extend from this base.
 """
 from __future__ import absolute_import
 
+import base64
+import datetime
+import json
+import numbers
+import threading
+import weakref
+
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import importlib
+from django.utils.dateparse import parse_date, parse_datetime
+
+from ..exceptions import InvalidCursor
+from .aggregates import Aggregator
+from .duplicates import Deduplicator, blocking_keys, rank
+from .search import LIMIT, SEARCH_FIELDS, SearchQuery
 
 
 class InvalidBackendError(ImproperlyConfigured):
     pass
 
 
+# Backend classes and the shared backend instances by path
+_backend_classes = {}
+_shared_backends = {}
+# Reentrant as shared backends, such as ShardedStorage, get their own backends while created
+_backends_lock = threading.RLock()
+
+
+def get_backend_class(path):
+    "Return the backend class from the full Python path."
+    backend_cls = _backend_classes.get(path)
+    if backend_cls is None:
+        try:
+            # Trying to import the given backend
+            mod_path, cls_name = path.rsplit('.', 1)
+            mod = importlib.import_module(mod_path)
+            backend_cls = _backend_classes[path] = getattr(mod, cls_name)
+        except (AttributeError, ImportError, ValueError):
+            raise InvalidBackendError("Could not find backend '%s'" % path)
+    return backend_cls
+
+
 def get_backend(path):
-    "Return a backend instance from the full Python path."
-    try:
-        # Trying to import the given backend
-        mod_path, cls_name = path.rsplit('.', 1)
-        mod = importlib.import_module(mod_path)
-        backend_cls = getattr(mod, cls_name)
-    except (AttributeError, ImportError, ValueError):
-        raise InvalidBackendError("Could not find backend '%s'" % path)
-    else:
+    """
+    Return a backend instance from the full Python path. Backends which can be
+    shared are only created once for each path.
+    """
+    backend_cls = get_backend_class(path)
+    if not getattr(backend_cls, 'shared', False):
         return backend_cls()
+    with _backends_lock:
+        backend = _shared_backends.get(path)
+        if backend is None:
+            backend = _shared_backends[path] = backend_cls()
+    return backend
+
+
+def clear_backends():
+    "Close and forget the shared backend instances, such as after changing their settings."
+    with _backends_lock:
+        backends = list(_shared_backends.values())
+        _shared_backends.clear()
+    for backend in backends:
+        backend.close()
+
+
+def get_ordering(order_by=None):
+    """
+    Normalize the order_by option to a list of (field, descending) pairs. The id is
+    always included last so that the ordering is stable.
+    """
+    if order_by and not isinstance(order_by, (list, tuple)):
+        order_by = [order_by]
+    ordering = []
+    for name in order_by or []:
+        ordering.append((name.lstrip('-'), name.startswith('-')))
+    if 'id' not in [field for field, descending in ordering]:
+        ordering.append(('id', False))
+    return ordering
+
+
+def get_fields(fields, ordering=None):
+    """
+    Normalize the fields option to a list of field names. The id and any ordering
+    fields are always included so that the results can be paged.
+    """
+    if not isinstance(fields, (list, tuple)):
+        fields = [fields]
+    names = ['id']
+    for name in list(fields) + [field for field, descending in ordering or []]:
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def project(record, fields):
+    "Copy of the record with only the given fields which it has."
+    return dict((name, record[name]) for name in fields if name in record)
+
+
+def encode_cursor(values):
+    "Encode the ordering values of a record as an opaque cursor."
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime.datetime):
+            value = {'dt': value.isoformat()}
+        elif isinstance(value, datetime.date):
+            value = {'d': value.isoformat()}
+        encoded.append(value)
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    "Decode the ordering values from a cursor created by encode_cursor."
+    try:
+        encoded = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        values = []
+        for value in encoded:
+            if isinstance(value, dict):
+                if 'dt' in value:
+                    value = parse_datetime(value['dt'])
+                else:
+                    value = parse_date(value['d'])
+            values.append(value)
+    except (KeyError, TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor: {0}".format(cursor))
+    return values
+
+
+def change_sequence(after):
+    "Sequence of the last change seen from a change feed cursor or 0 to start from the beginning."
+    if after is None:
+        return 0
+    values = decode_cursor(after)
+    if len(values) != 1 or not isinstance(values[0], numbers.Integral):
+        raise InvalidCursor("Invalid cursor: {0}".format(after))
+    return values[0]
+
+
+def change_key(change):
+    return [change['sequence']]
+
+
+class ResultSet(object):
+    """
+    Lazily evaluated records returned by the filter methods. Iterating streams the
+    records from the backend while len() and indexing load them all into memory.
+
+    When given a key function, which returns the ordering values of a record, the
+    cursor attribute can be passed as ``after`` to fetch the records which follow
+    the last one iterated.
+    """
+
+    def __init__(self, generate, key=None):
+        self._generate = generate
+        self.key = key
+        self._cache = None
+        self._last = None
+        self._stream = None
+
+    def __iter__(self):
+        # The cache is checked once iteration starts since list() calls len() after iter()
+        records = self._cache if self._cache is not None else self._generate()
+        if hasattr(records, 'close'):
+            # Kept weakly so that an iteration which is dropped is still closed straight away
+            self._stream = weakref.ref(records)
+        for record in records:
+            self._last = record
+            yield record
+
+    def close(self):
+        "Stop streaming the records of an unfinished iteration."
+        stream = self._stream() if self._stream is not None else None
+        if stream is not None:
+            stream.close()
+        self._stream = None
+
+    def _fetch_all(self):
+        if self._cache is None:
+            self._cache = list(self._generate())
+            if self._cache:
+                self._last = self._cache[-1]
+        return self._cache
+
+    @property
+    def cursor(self):
+        "Cursor for the records after the last one iterated."
+        if self.key is None or self._last is None:
+            return None
+        return encode_cursor(self.key(self._last))
+
+    def copy(self):
+        "Loaded copy of the records which can be iterated and paged independently."
+        records = [dict(record) for record in self._fetch_all()]
+        result = ResultSet(lambda: records, key=self.key)
+        result._fetch_all()
+        return result
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def __getitem__(self, index):
+        return self._fetch_all()[index]
+
+    def __nonzero__(self):
+        return bool(self._fetch_all())
+
+    __bool__ = __nonzero__
+
+
+class PreparedFilter(object):
+    """
+    Filter prepared for a shape of lookups, a sequence of (field, comparison) pairs,
+    and the ``chunk_size``, ``order_by`` and ``fields`` options. This runs the filter
+    method with the lookups built from the values. Backends can return their own
+    plan which compiles the parts of the query that only depend on the shape.
+    """
+
+    def __init__(self, filter, shape, options):
+        self.filter, self.shape, self.options = filter, tuple(shape), options
+
+    def run(self, values, **options):
+        """
+        Return the ResultSet for the lookup values, given in the order of the shape,
+        with the ``limit``, ``offset`` and ``after`` options.
+        """
+        lookups = [(field, comparison, value) for (field, comparison), value in zip(self.shape, values)]
+        return self.filter(*lookups, **dict(self.options, **options))
 
 
 class HealthcareStorage(object):
 
-    def get_patient(self, id, source=None):
-        "Retrieve a patient record by ID."
+    # Whether one instance can be used by every client of the process, which
+    # get_backend then creates once for each path
+    shared = False
+
+    def get_patient(self, id, source=None, fields=None):
+        """
+        Retrieve a patient record by ID. If ``fields`` is given only those fields,
+        along with the id, are returned.
+        """
         raise NotImplementedError("Define in subclass")
 
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs as a dictionary keyed by ID."
+        result = {}
+        for id in ids:
+            patient = self.get_patient(id)
+            if patient is not None:
+                result[id] = patient
+        return result
+
+    def get_many_patients_by_source(self, pairs):
+        """
+        Retrieve patient records for a list of (source_id, source_name) pairs as a
+        dictionary keyed by pair.
+        """
+        result = {}
+        for source_id, source_name in pairs:
+            patient = self.get_patient(source_id, source=source_name)
+            if patient is not None:
+                result[(source_id, source_name)] = patient
+        return result
+
     def create_patient(self, data):
         "Create a patient record."
         raise NotImplementedError("Define in subclass")
@@ -42,10 +279,97 @@ class HealthcareStorage(object):
         "Delete a patient record."
         raise NotImplementedError("Define in subclass")
 
-    def filter_patients(self, *lookups):
-        "Find patient records matching the given lookups."
+    def bulk_create_patients(self, data):
+        """
+        Create patient records from a list of dictionaries. Returns the created records
+        in the same order with ``None`` for any which could not be created.
+        """
+        return [self.create_patient(item) for item in data]
+
+    def bulk_update_patients(self, updates):
+        "Update patient records from a list of (id, data) pairs. Returns a list of booleans."
+        return [bool(self.update_patient(id, data)) for id, data in updates]
+
+    def bulk_delete_patients(self, ids):
+        "Delete patient records from a list of IDs. Returns a list of booleans."
+        return [bool(self.delete_patient(id)) for id in ids]
+
+    def filter_patients(self, *lookups, **options):
+        """
+        Find patient records matching the given lookups. Returns a ResultSet which
+        fetches the records in chunks of the ``chunk_size`` option as it is iterated.
+        The ``order_by``, ``limit``, ``offset`` and ``after`` options select a page.
+        The ``fields`` option limits the fields returned for each record.
+        """
         raise NotImplementedError("Define in subclass")
 
+    def prepare_patients(self, shape, **options):
+        "Prepare a patient filter for a sequence of (field, comparison) pairs."
+        return PreparedFilter(self.filter_patients, shape, options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        return sum(1 for patient in self.filter_patients(*lookups))
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        for patient in self.filter_patients(*lookups, limit=1):
+            return True
+        return False
+
+    def aggregate_patients(self, *lookups, **options):
+        """
+        Aggregate the patient records matching the given lookups. The ``aggregates`` option
+        is a list of (name, function, field) and ``group_by`` a list of field names or
+        AgeBands. Returns a dictionary of the group values and aggregates by name for
+        each group, sorted by the group values.
+        """
+        aggregator = Aggregator(options.get('group_by'), options.get('aggregates', []))
+        for patient in self.filter_patients(*lookups):
+            aggregator.add(patient)
+        return aggregator.results()
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        """
+        Find the patient records whose ``fields``, by default the name and location, match the query text
+        by their words or trigrams. Returns at most ``limit`` records, best match first.
+        This checks every record so backends should use an index of the trigrams.
+        """
+        query = SearchQuery(query, threshold)
+        if not query:
+            return []
+        fields = fields or SEARCH_FIELDS['patient']
+        return query.rank(self.filter_patients(), fields, limit or LIMIT)
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        """
+        Find the patients which may be duplicates of a record, given as a dictionary of
+        patient fields or the id of a stored patient. Returns a list of (patient, score)
+        for at most ``limit`` patients scoring at least ``threshold``, best first. This
+        compares every patient so backends should only compare those sharing a blocking key.
+        """
+        if not isinstance(record, dict):
+            record = self.get_patient(record)
+            if record is None:
+                return []
+        return rank(record, self.filter_patients(), threshold, limit)
+
+    def dedupe_patients(self, threshold=None):
+        """
+        Find the pairs of patients which may be duplicates. Returns a list of
+        (first id, second id, score) for the pairs scoring at least ``threshold``,
+        best first. The patients are only compared with those sharing a blocking key.
+        """
+        blocks = {}
+        for patient in self.filter_patients():
+            for key in blocking_keys(patient):
+                blocks.setdefault(key, []).append(patient)
+        deduplicator = Deduplicator(threshold)
+        for block in blocks.values():
+            if len(block) > 1:
+                deduplicator.add(block)
+        return deduplicator.results()
+
     def link_patient(self, id, source_id, source_name):
         "Associated a source/id pair with this patient."
         raise NotImplementedError("Define in subclass")
@@ -54,10 +378,22 @@ class HealthcareStorage(object):
         "Remove association of a source/id pair with this patient."
         raise NotImplementedError("Define in subclass")
 
-    def get_provider(self, id):
-        "Retrieve a provider record by ID."
+    def get_provider(self, id, fields=None):
+        """
+        Retrieve a provider record by ID. If ``fields`` is given only those fields,
+        along with the id, are returned.
+        """
         raise NotImplementedError("Define in subclass")
 
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs as a dictionary keyed by ID."
+        result = {}
+        for id in ids:
+            provider = self.get_provider(id)
+            if provider is not None:
+                result[id] = provider
+        return result
+
     def create_provider(self, data):
         "Create a provider record."
         raise NotImplementedError("Define in subclass")
@@ -70,6 +406,83 @@ class HealthcareStorage(object):
         "Delete a provider record."
         raise NotImplementedError("Define in subclass")
 
-    def filter_providers(self, *lookups):
-        "Find provider records matching the given lookups."
+    def bulk_create_providers(self, data):
+        """
+        Create provider records from a list of dictionaries. Returns the created records
+        in the same order with ``None`` for any which could not be created.
+        """
+        return [self.create_provider(item) for item in data]
+
+    def bulk_update_providers(self, updates):
+        "Update provider records from a list of (id, data) pairs. Returns a list of booleans."
+        return [bool(self.update_provider(id, data)) for id, data in updates]
+
+    def bulk_delete_providers(self, ids):
+        "Delete provider records from a list of IDs. Returns a list of booleans."
+        return [bool(self.delete_provider(id)) for id in ids]
+
+    def filter_providers(self, *lookups, **options):
+        """
+        Find provider records matching the given lookups. Returns a ResultSet which
+        fetches the records in chunks of the ``chunk_size`` option as it is iterated.
+        The ``order_by``, ``limit``, ``offset`` and ``after`` options select a page.
+        The ``fields`` option limits the fields returned for each record.
+        """
+        raise NotImplementedError("Define in subclass")
+
+    def prepare_providers(self, shape, **options):
+        "Prepare a provider filter for a sequence of (field, comparison) pairs."
+        return PreparedFilter(self.filter_providers, shape, options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        return sum(1 for provider in self.filter_providers(*lookups))
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        for provider in self.filter_providers(*lookups, limit=1):
+            return True
+        return False
+
+    def aggregate_providers(self, *lookups, **options):
+        """
+        Aggregate the provider records matching the given lookups. The ``aggregates`` option
+        is a list of (name, function, field) and ``group_by`` a list of field names or
+        AgeBands. Returns a dictionary of the group values and aggregates by name for
+        each group, sorted by the group values.
+        """
+        aggregator = Aggregator(options.get('group_by'), options.get('aggregates', []))
+        for provider in self.filter_providers(*lookups):
+            aggregator.add(provider)
+        return aggregator.results()
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        """
+        Find the provider records whose ``fields``, by default the name, match the query text
+        by their words or trigrams. Returns at most ``limit`` records, best match first.
+        This checks every record so backends should use an index of the trigrams.
+        """
+        query = SearchQuery(query, threshold)
+        if not query:
+            return []
+        fields = fields or SEARCH_FIELDS['provider']
+        return query.rank(self.filter_providers(), fields, limit or LIMIT)
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        """
+        Find the creates, updates and deletes of patients and providers along with the
+        patient links and unlinks in the order they were made. Returns a ResultSet of
+        changes with a cursor which can be passed as ``after`` to continue the feed.
+        """
         raise NotImplementedError("Define in subclass")
+
+    def thread_call(self, function):
+        """
+        Wrap a function which another thread, such as one of a pool, calls with this
+        backend for the current thread. Backends which keep state for each thread, such
+        as their database connections, carry it over or clean it up here.
+        """
+        return function
+
+    def close(self):
+        "Release what the backend holds, such as worker threads, once it's no longer used."
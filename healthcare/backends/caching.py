@@ -0,0 +1,424 @@
+"""
+Read-through caching storage which wraps another storage backend.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+from .base import HealthcareStorage, get_backend, get_fields, project
+
+
+_missing = object()
+
+# Cached in place of a record for a short time after it's written
+WRITTEN = 'healthcare:written'
+
+
+def get_cache(alias):
+    "Return the Django cache for the given alias."
+    try:
+        from django.core.cache import caches
+    except ImportError:  # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    else:
+        return caches[alias]
+
+
+class LRUCache(object):
+    "Bounded in-process cache which evicts the least recently used entries."
+
+    # Positions in each entry of the linked list
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, max_size=1000, timeout=None):
+        self.max_size, self.timeout = max_size, timeout
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Sentinel of a circular linked list from least to most recently used
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def _unlink(self, entry):
+        entry[self.PREV][self.NEXT] = entry[self.NEXT]
+        entry[self.NEXT][self.PREV] = entry[self.PREV]
+
+    def _append(self, entry):
+        last = self._root[self.PREV]
+        entry[self.PREV], entry[self.NEXT] = last, self._root
+        last[self.NEXT] = self._root[self.PREV] = entry
+
+    def get(self, key, default=None):
+        "Return the cached value or default if it is missing or expired."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._unlink(entry)
+            if entry[self.EXPIRES] is not None and entry[self.EXPIRES] <= time.time():
+                del self._entries[key]
+                return default
+            self._append(entry)
+            return entry[self.VALUE]
+
+    def set(self, key, value, timeout=_missing):
+        "Cache a value, evicting the least recently used entry when full. timeout overrides the cache's."
+        with self._lock:
+            self._store(key, value, timeout)
+
+    def add(self, key, value):
+        "Cache a value unless one which hasn't expired is cached. Returns whether it was added."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[self.EXPIRES] is None or entry[self.EXPIRES] > time.time()):
+                return False
+            self._store(key, value)
+            return True
+
+    def _store(self, key, value, timeout=_missing):
+        if timeout is _missing:
+            timeout = self.timeout
+        expires = time.time() + timeout if timeout is not None else None
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._unlink(entry)
+        elif len(self._entries) >= self.max_size:
+            oldest = self._root[self.NEXT]
+            self._unlink(oldest)
+            del self._entries[oldest[self.KEY]]
+            self.evictions += 1
+        entry = [None, None, key, value, expires]
+        self._entries[key] = entry
+        self._append(entry)
+
+    def delete(self, key):
+        "Remove a value from the cache."
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+
+    def clear(self):
+        "Remove all values from the cache."
+        with self._lock:
+            self._entries = {}
+            self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachingStorage(HealthcareStorage):
+    """
+    Caches patient and provider lookups by ID and source ID for the backend given by
+    the HEALTHCARE_CACHING_BACKEND setting. Writes through this storage invalidate
+    the affected entries.
+    """
+
+    # One instance, and so one in-process cache, is used by every client so records
+    # cached by one are seen by the others and their writes invalidate them
+    shared = True
+    # Seconds after a write during which its records aren't cached, so that a read which
+    # started before the write or was served by a lagging replica doesn't cache the old record
+    write_settle = 5
+
+    def __init__(self):
+        self.backend = get_backend(getattr(
+            settings, 'HEALTHCARE_CACHING_BACKEND', 'healthcare.backends.djhealth.DjangoStorage'))
+        timeout = getattr(settings, 'HEALTHCARE_CACHE_TIMEOUT', 300)
+        self.local = LRUCache(getattr(settings, 'HEALTHCARE_CACHE_SIZE', 1000), timeout)
+        alias = getattr(settings, 'HEALTHCARE_CACHE_ALIAS', None)
+        self.cache_tier = get_cache(alias) if alias else None
+        self.timeout = timeout
+        self.hits = self.misses = 0
+        self.thread = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        "Cache hit, miss and eviction counts."
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.local.evictions}
+
+    def thread_stats(self):
+        "Cache hit and miss counts of the lookups made by the current thread."
+        return getattr(self.thread, 'hits', 0), getattr(self.thread, 'misses', 0)
+
+    def _key(self, *parts):
+        return ':'.join('{0}'.format(part) for part in parts)
+
+    def _tier_key(self, key):
+        # Hash the key to keep it safe for memcached
+        return 'healthcare:{0}'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def _get(self, key):
+        value = self.local.get(key, _missing)
+        if value is _missing and self.cache_tier is not None:
+            value = self.cache_tier.get(self._tier_key(key), _missing)
+            if value is not _missing and value != WRITTEN:
+                self.local.add(key, value)
+        if value is _missing or value == WRITTEN:
+            value = _missing
+            with self._lock:
+                self.misses += 1
+            self.thread.misses = getattr(self.thread, 'misses', 0) + 1
+        else:
+            with self._lock:
+                self.hits += 1
+            self.thread.hits = getattr(self.thread, 'hits', 0) + 1
+        return value
+
+    def _set(self, key, value):
+        "Cache a fetched value unless the key was written recently."
+        self.local.add(key, value)
+        if self.cache_tier is not None:
+            self.cache_tier.add(self._tier_key(key), value, self.timeout)
+
+    def _delete(self, *keys):
+        "Invalidate the keys after a write, keeping them from being cached for write_settle seconds."
+        for key in keys:
+            self.local.set(key, WRITTEN, self.write_settle)
+        if self.cache_tier is not None:
+            self.cache_tier.set_many(
+                dict((self._tier_key(key), WRITTEN) for key in keys), self.write_settle)
+
+    def _cached_record(self, category, id, fetch, fields=None):
+        """
+        Return a copy of the record from the cache or fetch and cache it. Only full
+        records are cached so a projection which isn't cached is fetched as is.
+        """
+        key = self._key(category, id)
+        record = self._get(key)
+        if record is _missing:
+            if fields is not None:
+                return fetch(id, fields=fields)
+            record = fetch(id)
+            if record is None:
+                return None
+            self._set(key, dict(record))
+        if fields is not None:
+            return project(record, get_fields(fields))
+        return dict(record)
+
+    def _cached_records(self, category, ids, fetch_many):
+        "Return copies of the records found in the cache and fetch the rest in one call."
+        result, missing = {}, []
+        for id in ids:
+            record = self._get(self._key(category, id))
+            if record is _missing:
+                missing.append(id)
+            else:
+                result[id] = dict(record)
+        if missing:
+            for id, record in fetch_many(missing).items():
+                self._set(self._key(category, id), dict(record))
+                result[id] = dict(record)
+        return result
+
+    def get_patient(self, id, source=None, fields=None):
+        "Retrieve a patient record by ID."
+        if source:
+            key = self._key('patient-source', source, id)
+            patient_id = self._get(key)
+            if patient_id is _missing and fields is not None:
+                return self.backend.get_patient(id, source=source, fields=fields)
+            if patient_id is _missing:
+                patient = self.backend.get_patient(id, source=source)
+                if patient is None:
+                    return None
+                self._set(key, patient['id'])
+                self._set(self._key('patient', patient['id']), dict(patient))
+                return dict(patient)
+            id = patient_id
+        return self._cached_record('patient', id, self.backend.get_patient, fields)
+
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs."
+        return self._cached_records('patient', ids, self.backend.get_many_patients)
+
+    def get_many_patients_by_source(self, pairs):
+        "Retrieve patient records for a list of (source_id, source_name) pairs."
+        result, found, missing = {}, {}, []
+        for pair in pairs:
+            patient_id = self._get(self._key('patient-source', pair[1], pair[0]))
+            if patient_id is _missing:
+                missing.append(pair)
+            else:
+                found.setdefault(patient_id, []).append(pair)
+        patients = self.get_many_patients(list(found))
+        for patient_id, pairs in found.items():
+            for pair in pairs:
+                if patient_id in patients:
+                    result[pair] = dict(patients[patient_id])
+        if missing:
+            for pair, patient in self.backend.get_many_patients_by_source(missing).items():
+                self._set(self._key('patient-source', pair[1], pair[0]), patient['id'])
+                self._set(self._key('patient', patient['id']), dict(patient))
+                result[pair] = dict(patient)
+        return result
+
+    def create_patient(self, data):
+        "Create a patient record."
+        return self.backend.create_patient(data)
+
+    def update_patient(self, id, data):
+        "Update a patient record by ID."
+        try:
+            return self.backend.update_patient(id, data)
+        finally:
+            self._delete(self._key('patient', id))
+
+    def delete_patient(self, id):
+        "Delete a patient record by ID."
+        try:
+            return self.backend.delete_patient(id)
+        finally:
+            self._delete(self._key('patient', id))
+
+    def bulk_create_patients(self, data):
+        "Create patient records from a list of dictionaries."
+        return self.backend.bulk_create_patients(data)
+
+    def bulk_update_patients(self, updates):
+        "Update patient records from a list of (id, data) pairs."
+        updates = list(updates)
+        try:
+            return self.backend.bulk_update_patients(updates)
+        finally:
+            self._delete(*[self._key('patient', id) for id, data in updates])
+
+    def bulk_delete_patients(self, ids):
+        "Delete patient records from a list of IDs."
+        ids = list(ids)
+        try:
+            return self.backend.bulk_delete_patients(ids)
+        finally:
+            self._delete(*[self._key('patient', id) for id in ids])
+
+    def filter_patients(self, *lookups, **options):
+        "Find patient records matching the given lookups."
+        return self.backend.filter_patients(*lookups, **options)
+
+    def prepare_patients(self, shape, **options):
+        "Prepare a patient filter for a sequence of (field, comparison) pairs."
+        return self.backend.prepare_patients(shape, **options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        return self.backend.count_patients(*lookups)
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        return self.backend.exists_patients(*lookups)
+
+    def aggregate_patients(self, *lookups, **options):
+        "Aggregate the patient records matching the given lookups."
+        return self.backend.aggregate_patients(*lookups, **options)
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        "Find the patient records matching the search query, best match first."
+        return self.backend.search_patients(query, fields=fields, limit=limit, threshold=threshold)
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        "Find the patients which may be duplicates of a record, best first."
+        return self.backend.find_duplicate_patients(record, limit=limit, threshold=threshold)
+
+    def dedupe_patients(self, threshold=None):
+        "Find the pairs of patients which may be duplicates."
+        return self.backend.dedupe_patients(threshold=threshold)
+
+    def link_patient(self, id, source_id, source_name):
+        "Associated a source/id pair with this patient."
+        try:
+            return self.backend.link_patient(id, source_id, source_name)
+        finally:
+            self._delete(self._key('patient-source', source_name, source_id))
+
+    def unlink_patient(self, id, source_id, source_name):
+        "Remove association of a source/id pair with this patient."
+        try:
+            return self.backend.unlink_patient(id, source_id, source_name)
+        finally:
+            self._delete(self._key('patient-source', source_name, source_id))
+
+    def get_provider(self, id, fields=None):
+        "Retrieve a provider record by ID."
+        return self._cached_record('provider', id, self.backend.get_provider, fields)
+
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs."
+        return self._cached_records('provider', ids, self.backend.get_many_providers)
+
+    def create_provider(self, data):
+        "Create a provider record."
+        return self.backend.create_provider(data)
+
+    def update_provider(self, id, data):
+        "Update a provider record by ID."
+        try:
+            return self.backend.update_provider(id, data)
+        finally:
+            self._delete(self._key('provider', id))
+
+    def delete_provider(self, id):
+        "Delete a provider record by ID."
+        try:
+            return self.backend.delete_provider(id)
+        finally:
+            self._delete(self._key('provider', id))
+
+    def bulk_create_providers(self, data):
+        "Create provider records from a list of dictionaries."
+        return self.backend.bulk_create_providers(data)
+
+    def bulk_update_providers(self, updates):
+        "Update provider records from a list of (id, data) pairs."
+        updates = list(updates)
+        try:
+            return self.backend.bulk_update_providers(updates)
+        finally:
+            self._delete(*[self._key('provider', id) for id, data in updates])
+
+    def bulk_delete_providers(self, ids):
+        "Delete provider records from a list of IDs."
+        ids = list(ids)
+        try:
+            return self.backend.bulk_delete_providers(ids)
+        finally:
+            self._delete(*[self._key('provider', id) for id in ids])
+
+    def filter_providers(self, *lookups, **options):
+        "Find provider records matching the given lookups."
+        return self.backend.filter_providers(*lookups, **options)
+
+    def prepare_providers(self, shape, **options):
+        "Prepare a provider filter for a sequence of (field, comparison) pairs."
+        return self.backend.prepare_providers(shape, **options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        return self.backend.count_providers(*lookups)
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        return self.backend.exists_providers(*lookups)
+
+    def aggregate_providers(self, *lookups, **options):
+        "Aggregate the provider records matching the given lookups."
+        return self.backend.aggregate_providers(*lookups, **options)
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        "Find the provider records matching the search query, best match first."
+        return self.backend.search_providers(query, fields=fields, limit=limit, threshold=threshold)
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        "Find the changes made after the cursor."
+        return self.backend.get_changes(after=after, limit=limit, chunk_size=chunk_size)
+
+    def thread_call(self, function):
+        "Wrap a function which another thread calls with this storage."
+        return self.backend.thread_call(function)
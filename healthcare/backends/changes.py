@@ -0,0 +1,9 @@
+"Change feed action constants."
+from __future__ import unicode_literals
+
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+LINK = 'link'
+UNLINK = 'unlink'
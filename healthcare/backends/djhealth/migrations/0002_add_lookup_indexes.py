@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'PatientID', fields ['updated_date']
+        db.create_index('djhealth_patientid', ['updated_date'])
+
+        # Adding index on 'PatientID', fields ['status']
+        db.create_index('djhealth_patientid', ['status'])
+
+        # Concurrent links could store the same source id/name pair more than once, which made
+        # getting the patient by source fail, so keep the first link of each pair and delete the
+        # others before adding the constraint.
+        # The ids to keep are selected through a derived table since MySQL can't select
+        # from the table being deleted from.
+        if not db.dry_run:
+            db.execute(
+                'DELETE FROM djhealth_patientid WHERE id NOT IN '
+                '(SELECT id FROM (SELECT MIN(id) AS id FROM djhealth_patientid GROUP BY uid, source) AS first)')
+
+        # Adding unique constraint on 'PatientID', fields ['uid', 'source']
+        db.create_unique('djhealth_patientid', ['uid', 'source'])
+
+        # Adding index on 'Patient', fields ['updated_date']
+        db.create_index('djhealth_patient', ['updated_date'])
+
+        # Adding index on 'Patient', fields ['status']
+        db.create_index('djhealth_patient', ['status'])
+
+        # Adding index on 'Patient', fields ['name']
+        db.create_index('djhealth_patient', ['name'])
+
+        # Adding index on 'Patient', fields ['location']
+        db.create_index('djhealth_patient', ['location'])
+
+        # Adding index on 'Provider', fields ['updated_date']
+        db.create_index('djhealth_provider', ['updated_date'])
+
+        # Adding index on 'Provider', fields ['status']
+        db.create_index('djhealth_provider', ['status'])
+
+        # Adding index on 'Provider', fields ['name']
+        db.create_index('djhealth_provider', ['name'])
+
+        # Adding index on 'Provider', fields ['location']
+        db.create_index('djhealth_provider', ['location'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'Provider', fields ['location']
+        db.delete_index('djhealth_provider', ['location'])
+
+        # Removing index on 'Provider', fields ['name']
+        db.delete_index('djhealth_provider', ['name'])
+
+        # Removing index on 'Provider', fields ['status']
+        db.delete_index('djhealth_provider', ['status'])
+
+        # Removing index on 'Provider', fields ['updated_date']
+        db.delete_index('djhealth_provider', ['updated_date'])
+
+        # Removing index on 'Patient', fields ['location']
+        db.delete_index('djhealth_patient', ['location'])
+
+        # Removing index on 'Patient', fields ['name']
+        db.delete_index('djhealth_patient', ['name'])
+
+        # Removing index on 'Patient', fields ['status']
+        db.delete_index('djhealth_patient', ['status'])
+
+        # Removing index on 'Patient', fields ['updated_date']
+        db.delete_index('djhealth_patient', ['updated_date'])
+
+        # Removing unique constraint on 'PatientID', fields ['uid', 'source']
+        db.delete_unique('djhealth_patientid', ['uid', 'source'])
+
+        # Removing index on 'PatientID', fields ['status']
+        db.delete_index('djhealth_patientid', ['status'])
+
+        # Removing index on 'PatientID', fields ['updated_date']
+        db.delete_index('djhealth_patientid', ['updated_date'])
+
+
+    models = {
+        'djhealth.patient': {
+            'Meta': {'object_name': 'Patient'},
+            'birth_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'death_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'sex': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '1', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.patientid': {
+            'Meta': {'unique_together': "((u'uid', u'source'),)", 'object_name': 'PatientID'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'patient': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['djhealth.Patient']"}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '512'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'uid': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.provider': {
+            'Meta': {'object_name': 'Provider'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['djhealth']
\ No newline at end of file
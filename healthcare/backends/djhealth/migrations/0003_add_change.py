@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Change'
+        db.create_table('djhealth_change', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('category', self.gf('django.db.models.fields.CharField')(max_length=16)),
+            ('action', self.gf('django.db.models.fields.CharField')(max_length=8)),
+            ('record_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('source_id', self.gf('django.db.models.fields.CharField')(default=u'', max_length=255, blank=True)),
+            ('source_name', self.gf('django.db.models.fields.CharField')(default=u'', max_length=512, blank=True)),
+            ('date', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now, db_index=True)),
+        ))
+        db.send_create_signal('djhealth', ['Change'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'Change'
+        db.delete_table('djhealth_change')
+
+
+    models = {
+        'djhealth.change': {
+            'Meta': {'object_name': 'Change'},
+            'action': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'category': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'record_id': ('django.db.models.fields.IntegerField', [], {}),
+            'source_id': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '255', 'blank': 'True'}),
+            'source_name': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'blank': 'True'})
+        },
+        'djhealth.patient': {
+            'Meta': {'object_name': 'Patient'},
+            'birth_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'death_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'sex': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '1', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.patientid': {
+            'Meta': {'unique_together': "((u'uid', u'source'),)", 'object_name': 'PatientID'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'patient': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['djhealth.Patient']"}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '512'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'uid': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.provider': {
+            'Meta': {'object_name': 'Provider'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['djhealth']
\ No newline at end of file
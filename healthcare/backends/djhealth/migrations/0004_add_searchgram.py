@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import datetime
+import re
+
+from south.db import db
+from south.v2 import SchemaMigration
+from django.conf import settings
+from django.db import models
+
+
+# Number of records whose trigrams are added at a time
+BATCH_SIZE = 500
+
+# GIN trigram indexes added instead of the trigram table when HEALTHCARE_TRIGRAM_SEARCH is set
+TRIGRAM_INDEXES = (
+    ('djhealth_patient', 'name'),
+    ('djhealth_patient', 'location'),
+    ('djhealth_provider', 'name'),
+)
+
+# The searched fields and trigrams of healthcare.backends.search when this was written,
+# kept here so later changes to them don't change the migration
+SEARCH_FIELDS = {
+    'patient': ('name', 'location'),
+    'provider': ('name', ),
+}
+
+_separators = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def trigrams(text):
+    "Set of the trigrams of each word of the text."
+    grams = set()
+    for word in _separators.split(u'{0}'.format(text or u'').lower()):
+        if word:
+            padded = u'  {0} '.format(word)
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class Migration(SchemaMigration):
+
+    def _trigram_search(self):
+        # Read by DjangoStorage too so the migration and the searches agree
+        return db.backend_name == 'postgres' and getattr(settings, 'HEALTHCARE_TRIGRAM_SEARCH', False)
+
+    def forwards(self, orm):
+        # Adding model 'SearchGram'
+        db.create_table('djhealth_searchgram', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('category', self.gf('django.db.models.fields.CharField')(max_length=16)),
+            ('field', self.gf('django.db.models.fields.CharField')(max_length=32)),
+            ('gram', self.gf('django.db.models.fields.CharField')(max_length=3)),
+            ('record_id', self.gf('django.db.models.fields.IntegerField')(db_index=True)),
+        ))
+        db.send_create_signal('djhealth', ['SearchGram'])
+
+        # Adding the covering index from sql/searchgram.sql
+        db.execute('CREATE INDEX djhealth_searchgram_lookup ON djhealth_searchgram (category, field, gram, record_id)')
+
+        if self._trigram_search():
+            # Searches use pg_trgm so only its indexes are needed
+            db.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for table, column in TRIGRAM_INDEXES:
+                db.execute('CREATE INDEX {0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(table, column))
+            return
+
+        # Adding the trigrams of the existing records
+        if not db.dry_run:
+            for category, model in (('patient', orm['djhealth.Patient']), ('provider', orm['djhealth.Provider'])):
+                fields = SEARCH_FIELDS[category]
+                rows = model.objects.order_by('pk').values_list('pk', *fields)
+                last = 0
+                while True:
+                    batch = list(rows.filter(pk__gt=last)[:BATCH_SIZE])
+                    if not batch:
+                        break
+                    orm['djhealth.SearchGram'].objects.bulk_create([
+                        orm['djhealth.SearchGram'](category=category, field=field, gram=gram, record_id=row[0])
+                        for row in batch
+                        for field, value in zip(fields, row[1:])
+                        for gram in trigrams(value)
+                    ], batch_size=BATCH_SIZE)
+                    last = batch[-1][0]
+
+
+    def backwards(self, orm):
+        if db.backend_name == 'postgres':
+            for table, column in TRIGRAM_INDEXES:
+                db.execute('DROP INDEX IF EXISTS {0}_{1}_trgm'.format(table, column))
+
+        # Deleting model 'SearchGram'
+        db.delete_table('djhealth_searchgram')
+
+
+    models = {
+        'djhealth.change': {
+            'Meta': {'object_name': 'Change'},
+            'action': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'category': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'record_id': ('django.db.models.fields.IntegerField', [], {}),
+            'source_id': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '255', 'blank': 'True'}),
+            'source_name': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'blank': 'True'})
+        },
+        'djhealth.patient': {
+            'Meta': {'object_name': 'Patient'},
+            'birth_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'death_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'sex': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '1', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.patientid': {
+            'Meta': {'unique_together': "((u'uid', u'source'),)", 'object_name': 'PatientID'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'patient': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['djhealth.Patient']"}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '512'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'uid': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.provider': {
+            'Meta': {'object_name': 'Provider'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.searchgram': {
+            'Meta': {'object_name': 'SearchGram'},
+            'category': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'field': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'gram': ('django.db.models.fields.CharField', [], {'max_length': '3'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'record_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['djhealth']
\ No newline at end of file
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import datetime
+import re
+
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+# Number of patients whose blocking keys are added at a time
+BATCH_SIZE = 500
+
+# The blocking keys of healthcare.backends.duplicates when this was written, kept here
+# so later changes to them don't change the migration
+KEY_FIELDS = ('name', 'birth_date', 'location')
+
+# Length of the key column
+KEY_LENGTH = 255
+
+_separators = re.compile(r'[\W_]+', re.UNICODE)
+
+_soundex_codes = {}
+for code, letters in enumerate(('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r')):
+    for letter in letters:
+        _soundex_codes[letter] = u'{0}'.format(code)
+
+
+def words(text):
+    "Lower case words of the text."
+    return [word for word in _separators.split(u'{0}'.format(text or u'').lower()) if word]
+
+
+def soundex(word):
+    "American Soundex code of a word, or an empty string if it has no letters from a to z."
+    letters = [letter for letter in word.lower() if letter in _soundex_codes]
+    if not letters:
+        return u''
+    result, last = [letters[0].upper()], _soundex_codes[letters[0]]
+    for letter in letters[1:]:
+        code = _soundex_codes[letter]
+        if code != u'0' and code != last:
+            result.append(code)
+        if letter not in u'hw':
+            last = code
+    return (u''.join(result) + u'000')[:4]
+
+
+def blocking_keys(record):
+    "Keys of the blocks of a patient."
+    birth_date = record.get('birth_date')
+    year = birth_date.year if isinstance(birth_date, datetime.date) else None
+    location = u' '.join(words(record.get('location')))
+    codes = set(code for code in map(soundex, words(record.get('name'))) if code)
+    keys = set()
+    if year is not None:
+        keys.update(u'{0}:{1}'.format(code, year) for code in codes)
+    if location and codes:
+        keys.add(u'{0}@{1}'.format(u' '.join(sorted(codes)), location)[:KEY_LENGTH])
+    if year is None and not location:
+        keys.update(codes)
+    return keys
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'DuplicateKey'
+        db.create_table('djhealth_duplicatekey', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('patient', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['djhealth.Patient'])),
+            ('key', self.gf('django.db.models.fields.CharField')(max_length=255, db_index=True)),
+        ))
+        db.send_create_signal('djhealth', ['DuplicateKey'])
+
+        # Adding the blocking keys of the existing patients
+        if not db.dry_run:
+            rows = orm['djhealth.Patient'].objects.order_by('pk').values('pk', *KEY_FIELDS)
+            last = 0
+            while True:
+                batch = list(rows.filter(pk__gt=last)[:BATCH_SIZE])
+                if not batch:
+                    break
+                orm['djhealth.DuplicateKey'].objects.bulk_create([
+                    orm['djhealth.DuplicateKey'](patient_id=row['pk'], key=key)
+                    for row in batch
+                    for key in blocking_keys(row)
+                ], batch_size=BATCH_SIZE)
+                last = batch[-1]['pk']
+
+
+    def backwards(self, orm):
+        # Deleting model 'DuplicateKey'
+        db.delete_table('djhealth_duplicatekey')
+
+
+    models = {
+        'djhealth.change': {
+            'Meta': {'object_name': 'Change'},
+            'action': ('django.db.models.fields.CharField', [], {'max_length': '8'}),
+            'category': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'record_id': ('django.db.models.fields.IntegerField', [], {}),
+            'source_id': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '255', 'blank': 'True'}),
+            'source_name': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'blank': 'True'})
+        },
+        'djhealth.patient': {
+            'Meta': {'object_name': 'Patient'},
+            'birth_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'death_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'sex': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '1', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.patientid': {
+            'Meta': {'unique_together': "((u'uid', u'source'),)", 'object_name': 'PatientID'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'patient': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['djhealth.Patient']"}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '512'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'uid': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.provider': {
+            'Meta': {'object_name': 'Provider'},
+            'created_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '512', 'db_index': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "u'A'", 'max_length': '1', 'db_index': 'True'}),
+            'updated_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'djhealth.searchgram': {
+            'Meta': {'object_name': 'SearchGram'},
+            'category': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'field': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'gram': ('django.db.models.fields.CharField', [], {'max_length': '3'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'record_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        'djhealth.duplicatekey': {
+            'Meta': {'object_name': 'DuplicateKey'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'patient': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['djhealth.Patient']"})
+        }
+    }
+
+    complete_apps = ['djhealth']
\ No newline at end of file
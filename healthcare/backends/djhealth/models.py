@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.db import models
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -13,8 +14,8 @@ class AuditModelBase(models.Model):
     )
 
     created_date = models.DateTimeField(auto_now_add=True)
-    updated_date = models.DateTimeField(auto_now=True)
-    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=ACTIVE)
+    updated_date = models.DateTimeField(auto_now=True, db_index=True)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=ACTIVE, db_index=True)
 
     class Meta:
         abstract = True
@@ -31,11 +32,11 @@ class Patient(AuditModelBase):
         (FEMALE, _('Female')),
     )
 
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
     sex = models.CharField(max_length=1, choices=SEX_CHOICES, blank=True, default='')
     birth_date = models.DateField(blank=True, null=True)
     death_date = models.DateField(blank=True, null=True)
-    location = models.CharField(max_length=512, blank=True, default='')
+    location = models.CharField(max_length=512, blank=True, default='', db_index=True)
 
     def __unicode__(self):
         return self.name
@@ -44,8 +45,8 @@ class Patient(AuditModelBase):
 class Provider(AuditModelBase):
     "Storage model for basic provider/health care worker information."
 
-    name = models.CharField(max_length=255)
-    location = models.CharField(max_length=512, blank=True, default='')
+    name = models.CharField(max_length=255, db_index=True)
+    location = models.CharField(max_length=512, blank=True, default='', db_index=True)
 
     def __unicode__(self):
         return self.name
@@ -58,5 +59,51 @@ class PatientID(AuditModelBase):
     patient = models.ForeignKey(Patient)
     source = models.CharField(max_length=512)
 
+    class Meta:
+        unique_together = (('uid', 'source'), )
+
     def __unicode__(self):
         return self.uid
+
+
+class Change(models.Model):
+    """
+    Entry in the log of patient, provider and patient id writes which is read by the
+    change feed in primary key order.
+    """
+
+    category = models.CharField(max_length=16)
+    action = models.CharField(max_length=8)
+    record_id = models.IntegerField()
+    source_id = models.CharField(max_length=255, blank=True, default='')
+    source_name = models.CharField(max_length=512, blank=True, default='')
+    date = models.DateTimeField(default=now, db_index=True)
+
+    def __unicode__(self):
+        return '{0} {1} {2}'.format(self.action, self.category, self.record_id)
+
+
+class SearchGram(models.Model):
+    """
+    Trigram of a word in a searched patient or provider field. Used to find the
+    records which share trigrams with a search unless HEALTHCARE_TRIGRAM_SEARCH is set. The
+    covering index of the searched columns is added by sql/searchgram.sql.
+    """
+
+    category = models.CharField(max_length=16)
+    field = models.CharField(max_length=32)
+    gram = models.CharField(max_length=3)
+    record_id = models.IntegerField(db_index=True)
+
+    def __unicode__(self):
+        return self.gram
+
+
+class DuplicateKey(models.Model):
+    "Blocking key of a patient used to find the patients which may be duplicates of it."
+
+    patient = models.ForeignKey(Patient)
+    key = models.CharField(max_length=255, db_index=True)
+
+    def __unicode__(self):
+        return self.key
@@ -0,0 +1,120 @@
+"""
+Choice of the database alias used by each DjangoStorage query. Writes go to the
+primary database and reads to one of the read replicas, unless the thread wrote
+recently and is pinned to the primary so that it reads its own writes.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import contextlib
+import itertools
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from django.db import connections
+
+
+ROUND_ROBIN = 'round-robin'
+LEAST_LOADED = 'least-loaded'
+
+timer = getattr(time, 'monotonic', time.time)
+
+# Primary databases the current thread wrote to, with the time its reads stop being pinned
+_pins = threading.local()
+
+
+def _pinned():
+    if not hasattr(_pins, 'until'):
+        _pins.until = {}
+    return _pins.until
+
+
+def unpin(**kwargs):
+    "Stop reading from the primary databases in the current thread, such as when a new request starts."
+    _pinned().clear()
+
+
+request_started.connect(unpin, dispatch_uid='healthcare.backends.djhealth.routing.unpin')
+
+
+def carry_pins(function):
+    """
+    Wrap a function which another thread, such as one of a pool, calls for the current
+    thread so that its reads use the current thread's pins and its writes pin this thread.
+    """
+    until = _pinned()
+
+    def call(*args, **kwargs):
+        own = _pinned()
+        _pins.until = until
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _pins.until = own
+
+    return call
+
+
+class ReplicaRouter(object):
+    """
+    Sends writes to the primary alias and spreads reads over the replica aliases
+    either in turn or to the one with the fewest reads in progress. After a write,
+    reads from the same thread use the primary for sticky seconds or until the
+    next request starts. Without replicas every query uses the primary.
+    """
+
+    def __init__(self, primary='default', replicas=(), routing=ROUND_ROBIN, sticky=5):
+        for alias in [primary] + list(replicas):
+            if alias not in connections.databases:
+                raise ImproperlyConfigured("Unknown database alias '%s'" % alias)
+        if routing not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ImproperlyConfigured("Unknown read routing '%s'" % routing)
+        self.primary, self.replicas = primary, list(replicas)
+        self.routing, self.sticky = routing, sticky
+        self.reads = dict((alias, 0) for alias in self.replicas)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def pin(self):
+        "Read from the primary in the current thread for the next sticky seconds."
+        if self.replicas and self.sticky:
+            _pinned()[self.primary] = timer() + self.sticky
+
+    @property
+    def pinned(self):
+        "Whether the current thread reads from the primary after a recent write."
+        until = _pinned().get(self.primary)
+        return until is not None and until > timer()
+
+    def db_for_write(self):
+        "Alias for a write, which pins the thread's reads to it."
+        self.pin()
+        return self.primary
+
+    def db_for_read(self):
+        "Alias of the database which should serve the next read."
+        if not self.replicas or self.pinned:
+            return self.primary
+        with self._lock:
+            # Start from the next replica in turn so ties are spread evenly
+            start = next(self._turn) % len(self.replicas)
+            ordered = self.replicas[start:] + self.replicas[:start]
+            if self.routing == LEAST_LOADED:
+                return min(ordered, key=lambda alias: self.reads[alias])
+            return ordered[0]
+
+    @contextlib.contextmanager
+    def read(self):
+        "Choose the alias for a read and count the read as in progress until it's done."
+        alias = self.db_for_read()
+        if alias not in self.reads:
+            yield alias
+            return
+        with self._lock:
+            self.reads[alias] += 1
+        try:
+            yield alias
+        finally:
+            with self._lock:
+                self.reads[alias] -= 1
@@ -0,0 +1,2 @@
+-- Covering index for finding the records with each trigram without reading the table
+CREATE INDEX djhealth_searchgram_lookup ON djhealth_searchgram (category, field, gram, record_id);
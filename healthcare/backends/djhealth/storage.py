@@ -1,18 +1,167 @@
 from __future__ import absolute_import, unicode_literals
 
+import contextlib
+import datetime
 import operator
 
-from django.db.models import Q
-from django.forms.models import model_to_dict
+from django.conf import settings
+from django.core.exceptions import FieldError, ValidationError
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Count, Max, Min, Q
 from django.utils.timezone import now
 
-from .. import comparisons
-from ..base import HealthcareStorage
-from .models import Patient, Provider, PatientID
+from .. import aggregates, changes, comparisons
+from ..aggregates import AgeBands, sort_value
+from ..duplicates import KEY_FIELDS, Deduplicator, blocking_keys, rank
+from ..expressions import And, Expression, Not, Or
+from ..search import LIMIT, SEARCH_FIELDS, SearchQuery, trigrams
+from ..base import (HealthcareStorage, ResultSet, change_key, change_sequence, decode_cursor,
+    get_fields, get_ordering)
+from ...utils import chunked
+from .models import Change, DuplicateKey, Patient, Provider, PatientID, SearchGram
+from .routing import ROUND_ROBIN, ReplicaRouter, carry_pins
+
+
+# Errors raised by the database or field conversion for a bad row of a write
+BULK_ERRORS = (DatabaseError, FieldError, ValidationError, TypeError, ValueError)
+
+
+@contextlib.contextmanager
+def write_transaction(using):
+    """
+    Make the writes of the block all or nothing. Before Django 1.6 commit_on_success
+    isn't nestable so inside the caller's own managed transaction, such as one of the
+    TransactionMiddleware, a savepoint is used rather than committing or rolling back
+    the caller's work. Databases without savepoints then leave a failed block's earlier
+    writes to the caller's rollback.
+    """
+    if hasattr(transaction, 'atomic'):
+        with transaction.atomic(using=using):
+            yield
+    elif transaction.is_managed(using=using):
+        sid = transaction.savepoint(using=using)
+        try:
+            yield
+        except:
+            transaction.savepoint_rollback(sid, using=using)
+            raise
+        transaction.savepoint_commit(sid, using=using)
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+
+class RecordSerializer(object):
+    """
+    Converts model instances or rows of values into record dictionaries using the
+    field names and accessor computed once for the model.
+    """
+
+    def __init__(self, model):
+        self.names = tuple(field.attname for field in model._meta.fields)
+        self._values = operator.attrgetter(*self.names)
+
+    def from_instance(self, instance):
+        return dict(zip(self.names, self._values(instance)))
+
+    def from_rows(self, rows, names=None):
+        names = names or self.names
+        return [dict(zip(names, row)) for row in rows]
+
+
+_serializers = {}
+
+
+def get_serializer(model):
+    "Return the serializer for the model, building it on first use."
+    serializer = _serializers.get(model)
+    if serializer is None:
+        serializer = _serializers[model] = RecordSerializer(model)
+    return serializer
+
+
+class CompiledFilter(object):
+    """
+    Filter of a model with the lookup keywords, ordering and selected columns built
+    once for a shape of (field, comparison) pairs so that running it only binds the
+    lookup values.
+    """
+
+    def __init__(self, storage, model, shape, chunk_size=None, order_by=None, fields=None):
+        self.storage, self.model = storage, model
+        # Expressions in the shape have no values to bind so their Q is built now
+        self.where = [storage._lookup_to_q(item) for item in shape if isinstance(item, Expression)]
+        self.keys = ['{0}__{1}'.format(field, storage._comparison_mapping[comparison])
+                     for field, comparison in [item for item in shape if not isinstance(item, Expression)]]
+        # Repeated keywords can't be passed to a single filter call
+        self.unique = len(set(self.keys)) == len(self.keys)
+        self.ordering = get_ordering(order_by)
+        self.order_by = ['-' + field if descending else field for field, descending in self.ordering]
+        self.names = storage._field_names(model, fields, self.ordering)
+        self.serializer = get_serializer(model)
+        self.size = chunk_size or storage.chunk_size
+
+    def key(self, record):
+        return [record[field] for field, _ in self.ordering]
+
+    def run(self, values, limit=None, offset=None, after=None):
+        "Stream the records matching the lookup values in ordered chunks."
+        if self.unique:
+            queryset = self.model.objects.filter(*self.where, **dict(zip(self.keys, values)))
+        else:
+            queryset = self.model.objects.filter(
+                *self.where + [Q(**{key: value}) for key, value in zip(self.keys, values)])
+        after = decode_cursor(after) if after is not None else None
+        # Select rows of values rather than building model instances
+        queryset = queryset.order_by(*self.order_by).values_list(*self.names)
+        ordering, names, serializer, size = self.ordering, self.names, self.serializer, self.size
+        keyset_q, router = self.storage._keyset_q, self.storage.router
+
+        def generate():
+            # Every chunk is read from the same database
+            with router.read() as using:
+                rows = queryset.using(using)
+                if after is not None:
+                    rows = rows.filter(keyset_q(ordering, after, using))
+                remaining, start, page = limit, offset or 0, rows
+                while remaining is None or remaining > 0:
+                    count = size if remaining is None else min(size, remaining)
+                    chunk = serializer.from_rows(page[start:start + count], names)
+                    for record in chunk:
+                        yield record
+                    if len(chunk) < count:
+                        break
+                    if remaining is not None:
+                        remaining -= count
+                    # Seek past the last row rather than using OFFSET so each chunk is an index range
+                    last = [chunk[-1][field] for field, _ in ordering]
+                    page, start = rows.filter(keyset_q(ordering, last, using)), 0
+
+        return ResultSet(generate, key=self.key)
 
 
 class DjangoStorage(HealthcareStorage):
 
+    # Records are kept in the database so one instance can be used by every client
+    shared = True
+    # Maximum number of values sent in a single IN clause or multi-row INSERT
+    batch_size = 500
+    # Default number of rows fetched per query when streaming filter results
+    chunk_size = 1000
+    # Longest time in seconds a transaction may take between a write and its commit. A gap
+    # in the change log newer than this may be a write still to commit, so the changes after
+    # it are held back until it is filled or older
+    change_settle = 5
+    # Candidate records ranked for each search result, chosen by their shared trigrams
+    search_pool = 10
+    # Whether to search with the pg_trgm extension rather than the SearchGram table,
+    # None uses the HEALTHCARE_TRIGRAM_SEARCH setting
+    trigram_search = None
+    # Alias of the database written to and the aliases of its read replicas, None uses
+    # the HEALTHCARE_DATABASE and HEALTHCARE_READ_DATABASES settings
+    database = None
+    read_databases = None
+
     _comparison_mapping = {
         comparisons.EQUAL: 'exact',
         comparisons.LIKE: 'contains',
@@ -23,62 +172,461 @@ class DjangoStorage(HealthcareStorage):
         comparisons.GTE: 'gte',
     }
 
+    _aggregate_mapping = {
+        aggregates.COUNT: Count,
+        aggregates.MIN: Min,
+        aggregates.MAX: Max,
+    }
+
+    def __init__(self):
+        database, read_databases = self.database, self.read_databases
+        if database is None:
+            database = getattr(settings, 'HEALTHCARE_DATABASE', 'default')
+        if read_databases is None:
+            read_databases = getattr(settings, 'HEALTHCARE_READ_DATABASES', ())
+        self.router = ReplicaRouter(
+            primary=database, replicas=read_databases,
+            routing=getattr(settings, 'HEALTHCARE_READ_ROUTING', ROUND_ROBIN),
+            sticky=getattr(settings, 'HEALTHCARE_STICKY_SECONDS', 5))
+        if self.trigram_search is None:
+            self.trigram_search = getattr(settings, 'HEALTHCARE_TRIGRAM_SEARCH', False)
+
     def _patient_to_dict(self, patient):
         "Convert a Patient model to a dictionary."
-        # Mapping of all fields
-        # Might need additional translation of field names
-        result = model_to_dict(patient)
-        result['created_date'] = patient.created_date
-        result['updated_date'] = patient.updated_date
-        return result
+        return get_serializer(Patient).from_instance(patient)
 
     def _provider_to_dict(self, provider):
         "Convert a Provider model to a dictionary."
-        # Mapping of all fields
-        # Might need additional translation of field names
-        result = model_to_dict(provider)
-        result['created_date'] = provider.created_date
-        result['updated_date'] = provider.updated_date
-        return result
+        return get_serializer(Provider).from_instance(provider)
+
+    def _field_names(self, model, fields=None, ordering=None):
+        "Names of the model fields to select for a full record or only the requested fields."
+        names = get_serializer(model).names
+        if fields is None:
+            return list(names)
+        return [name for name in get_fields(fields, ordering) if name in names]
+
+    def _get_row(self, queryset, names, prefix=''):
+        "Fetch the first record of the queryset with the given fields."
+        rows = list(queryset.values_list(*[prefix + name for name in names])[:1])
+        return dict(zip(names, rows[0])) if rows else None
 
     def _lookup_to_q(self, lookup):
-        field, operator, value = lookup
-        lookup_type = self._comparison_mapping[operator]
+        if isinstance(lookup, Not):
+            return ~self._lookup_to_q(lookup.child)
+        if isinstance(lookup, Or):
+            if not lookup.children:
+                return Q(pk__in=[])
+            return reduce(operator.or_, map(self._lookup_to_q, lookup.children))
+        if isinstance(lookup, And):
+            return self._lookups_to_q(lookup.children)
+        field, comparison, value = lookup
+        lookup_type = self._comparison_mapping[comparison]
         params = {'{0}__{1}'.format(field, lookup_type): value}
         return Q(**params)
 
-    def _get_patient_by_id(self, id):
-        "Get patient by pk."
-        try:
-            patient = Patient.objects.get(pk=id)
-        except (ValueError, Patient.DoesNotExist):
-            patient = None
-        return patient
+    def _log_changes(self, model, action, ids, source_id='', source_name=''):
+        """
+        Add the writes of the records to the change log unless HEALTHCARE_CHANGE_LOG is
+        disabled. This should be called in the same transaction as the writes.
+        """
+        if not getattr(settings, 'HEALTHCARE_CHANGE_LOG', True):
+            return
+        category = model._meta.object_name.lower()
+        entries = [
+            Change(category=category, action=action, record_id=id,
+                   source_id=source_id, source_name=source_name)
+            for id in ids
+        ]
+        Change.objects.using(self.router.primary).bulk_create(entries, batch_size=self.batch_size)
+
+    def _index_search(self, model, ids, fields=None, created=False):
+        """
+        Replace the search trigrams of the searched fields, or those of them given,
+        of the records. This should be called in the same transaction as the writes.
+        """
+        category = model._meta.object_name.lower()
+        fields = [field for field in SEARCH_FIELDS[category] if fields is None or field in fields]
+        if not fields or self.trigram_search:
+            return
+        using = self.router.primary
+        for chunk in chunked(ids, self.batch_size):
+            if not created:
+                SearchGram.objects.using(using).filter(
+                    category=category, field__in=fields, record_id__in=chunk).delete()
+            grams = [
+                SearchGram(category=category, field=field, gram=gram, record_id=row[0])
+                for row in model.objects.using(using).filter(pk__in=chunk).values_list('pk', *fields)
+                for field, value in zip(fields, row[1:])
+                for gram in trigrams(value)
+            ]
+            SearchGram.objects.using(using).bulk_create(grams, batch_size=self.batch_size)
+
+    def _index_duplicates(self, model, ids, fields=None, created=False):
+        """
+        Replace the blocking keys of the patients when any of the fields used by them
+        are written. This should be called in the same transaction as the writes.
+        """
+        if model is not Patient or (fields is not None and not any(field in fields for field in KEY_FIELDS)):
+            return
+        using = self.router.primary
+        for chunk in chunked(ids, self.batch_size):
+            if not created:
+                DuplicateKey.objects.using(using).filter(patient__in=chunk).delete()
+            keys = [
+                DuplicateKey(patient_id=row[0], key=key)
+                for row in Patient.objects.using(using).filter(pk__in=chunk).values_list('pk', *KEY_FIELDS)
+                for key in blocking_keys(dict(zip(KEY_FIELDS, row[1:])))
+            ]
+            DuplicateKey.objects.using(using).bulk_create(keys, batch_size=self.batch_size)
+
+    def _index(self, model, ids, fields=None, created=False):
+        "Update the search trigrams and blocking keys of the records which were written."
+        self._index_search(model, ids, fields, created)
+        self._index_duplicates(model, ids, fields, created)
 
-    def _get_patient_for_source(self, id, source):
-        "Get patient by source_id, source_name pair."
+    def _change_to_dict(self, row):
+        "Convert a row of the change log into a change."
+        sequence, category, action, id, source_id, source_name, date = row
+        if action not in (changes.LINK, changes.UNLINK):
+            source_id = source_name = None
+        return {
+            'sequence': sequence, 'category': category, 'action': action, 'id': id,
+            'source_id': source_id, 'source_name': source_name, 'date': date,
+        }
+
+    def _clean_pk(self, model, id):
+        "Convert an ID to the primary key type or None if it isn't valid."
         try:
-            patient = PatientID.objects.select_related('patient').get(
-                uid=id, source=source).patient
-        except (ValueError, PatientID.DoesNotExist):
-            patient = None
-        return patient
+            return model._meta.pk.get_prep_value(id)
+        except (TypeError, ValueError):
+            return None
+
+    def _insert(self, model, instances):
+        "Insert new model instances and make sure each has its primary key set."
+        using = self.router.primary
+        objects = model.objects.using(using)
+        # Instances given an id keep it so only the others need their new keys
+        given = [instance for instance in instances if instance.pk is not None]
+        if given:
+            objects.bulk_create(given, batch_size=self.batch_size)
+        for batch in chunked([instance for instance in instances if instance.pk is None], self.batch_size):
+            self._insert_new(model, batch, using)
+
+    def _insert_new(self, model, instances, using):
+        "Insert a batch of instances without ids with one statement where the keys can be recovered."
+        connection, objects = connections[using], model.objects.using(using)
+        if getattr(connection.features, 'can_return_ids_from_bulk_insert', False):
+            objects.bulk_create(instances)
+        elif connection.vendor == 'postgresql':
+            # Take the keys from the sequence of the primary key and insert the rows with them
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                [connection.ops.quote_name(model._meta.db_table), model._meta.pk.column, len(instances)])
+            for instance, row in zip(instances, cursor.fetchall()):
+                instance.pk = row[0]
+            objects.bulk_create(instances)
+        elif connection.vendor == 'sqlite':
+            # Rows without an id get one more than the largest rowid and SQLite holds the
+            # write lock until commit, so the keys of the batch are the largest ones
+            objects.bulk_create(instances)
+            last = objects.aggregate(last=Max('pk'))['last']
+            for pk, instance in zip(range(last - len(instances) + 1, last + 1), instances):
+                instance.pk = pk
+        else:
+            # Keys can't be recovered from a multi-row INSERT so
+            # fall back to one INSERT per row in a single transaction
+            for instance in instances:
+                instance.save(force_insert=True, using=using)
+
+    def _bulk_create(self, model, to_dict, create, data):
+        "Create a batch of records with as few queries as possible."
+        results = [None] * len(data)
+        instances, positions = [], []
+        for i, item in enumerate(data):
+            try:
+                instances.append(model(**item))
+            except (TypeError, ValueError):
+                # Unknown field names
+                continue
+            positions.append(i)
+        if instances:
+            try:
+                with write_transaction(self.router.db_for_write()):
+                    self._insert(model, instances)
+                    pks = [instance.pk for instance in instances]
+                    self._log_changes(model, changes.CREATE, pks)
+                    self._index(model, pks, created=True)
+            except BULK_ERRORS:
+                # Isolate the bad rows by creating the batch one at a time
+                for i in positions:
+                    results[i] = create(data[i])
+            else:
+                for i, instance in zip(positions, instances):
+                    results[i] = to_dict(instance)
+        return results
+
+    def _bulk_update(self, model, updates):
+        "Apply each distinct set of changes with one UPDATE per batch of IDs."
+        results = [False] * len(updates)
+        groups, pks = {}, set()
+        for i, (id, data) in enumerate(updates):
+            pk = self._clean_pk(model, id)
+            if pk is None:
+                continue
+            key = tuple(sorted(data.items()))
+            try:
+                group = groups.setdefault(key, (data, []))
+            except TypeError:
+                # Unhashable values can't be grouped
+                group = groups.setdefault(('__unhashable__', i), (data, []))
+            group[1].append((pk, i))
+            pks.add(pk)
+        using = self.router.db_for_write()
+        objects = model.objects.using(using)
+        existing = set()
+        for chunk in chunked(pks, self.batch_size):
+            existing.update(objects.filter(pk__in=chunk).values_list('pk', flat=True))
+        for data, members in groups.values():
+            members = [(pk, i) for pk, i in members if pk in existing]
+            values = dict(data, updated_date=now())
+            for chunk in chunked(members, self.batch_size):
+                try:
+                    with write_transaction(using):
+                        objects.filter(pk__in=[pk for pk, i in chunk]).update(**values)
+                        self._log_changes(model, changes.UPDATE, [pk for pk, i in chunk])
+                        self._index(model, [pk for pk, i in chunk], data)
+                except BULK_ERRORS:
+                    continue
+                for pk, i in chunk:
+                    results[i] = True
+        return results
+
+    def _bulk_delete(self, model, ids):
+        "Delete records in batches of IDs."
+        results = [False] * len(ids)
+        positions = {}
+        for i, id in enumerate(ids):
+            pk = self._clean_pk(model, id)
+            if pk is not None and pk not in positions:
+                positions[pk] = i
+        using = self.router.db_for_write()
+        objects = model.objects.using(using)
+        for chunk in chunked(positions, self.batch_size):
+            existing = list(objects.filter(pk__in=chunk).values_list('pk', flat=True))
+            if existing:
+                with write_transaction(using):
+                    objects.filter(pk__in=existing).delete()
+                    self._log_changes(model, changes.DELETE, existing)
+                    self._index_search(model, existing)
+            for pk in existing:
+                results[positions[pk]] = True
+        return results
+
+    def _lookups_to_q(self, lookups):
+        "Combine the lookups into a single Q object."
+        if lookups:
+            return reduce(operator.and_, map(self._lookup_to_q, lookups))
+        return Q()
+
+    def _keyset_q(self, ordering, values, using):
+        "Build a predicate for the rows which sort after the given ordering values."
+        # PostgreSQL and Oracle sort NULL after every value, SQLite and MySQL before
+        nulls_largest = connections[using].vendor in ('postgresql', 'oracle')
+        clauses = []
+        for i, (field, descending) in enumerate(ordering):
+            params = {}
+            for (previous, _), value in zip(ordering[:i], values[:i]):
+                params[previous] = value
+            value, nulls_first = values[i], descending == nulls_largest
+            if value is None:
+                # Only non-NULL values follow NULL, and only when NULL sorts first
+                if not nulls_first:
+                    continue
+                params['{0}__isnull'.format(field)] = False
+            else:
+                if not nulls_first:
+                    # NULL sorts after every value in this direction
+                    clauses.append(Q(**dict(params, **{'{0}__isnull'.format(field): True})))
+                params['{0}__{1}'.format(field, 'lt' if descending else 'gt')] = value
+            clauses.append(Q(**params))
+        if not clauses:
+            # Nothing sorts after this record
+            return Q(pk__in=[])
+        return reduce(operator.or_, clauses)
+
+    def _filter(self, model, lookups, chunk_size=None,
+                order_by=None, limit=None, offset=None, after=None, fields=None):
+        "Stream the records matching the lookups in ordered chunks."
+        expressions = [lookup for lookup in lookups if isinstance(lookup, Expression)]
+        plain = [lookup for lookup in lookups if not isinstance(lookup, Expression)]
+        plan = CompiledFilter(self, model, [lookup[:2] for lookup in plain] + expressions,
+            chunk_size=chunk_size, order_by=order_by, fields=fields)
+        return plan.run([lookup[2] for lookup in plain], limit=limit, offset=offset, after=after)
 
-    def get_patient(self, id, source=None):
+    def _bands_sql(self, model, bands, using):
+        "CASE expression which gives the label of the age band for each row."
+        field, connection = model._meta.get_field(bands.field), connections[using]
+        qn = connection.ops.quote_name
+        column = '{0}.{1}'.format(qn(model._meta.db_table), qn(field.column))
+        cases, params = [], []
+        for label, cutoff in bands.cutoffs:
+            # Compare before the next day so a datetime field includes the whole cutoff day
+            cases.append('WHEN {0} < %s THEN %s'.format(column))
+            params.extend([field.get_db_prep_value(cutoff + datetime.timedelta(days=1), connection), label])
+        return 'CASE {0} ELSE NULL END'.format(' '.join(cases)), params
+
+    def _aggregate(self, model, lookups, group_by=None, aggregates=()):
+        "Aggregate the records matching the lookups with a single GROUP BY query."
+        with self.router.read() as using:
+            queryset = model.objects.using(using).filter(self._lookups_to_q(lookups))
+            # Results are selected with generated aliases which can't clash with the model fields
+            groups = []
+            for i, group in enumerate(group_by or []):
+                if isinstance(group, AgeBands):
+                    alias = 'group_{0}'.format(i)
+                    sql, params = self._bands_sql(model, group, using)
+                    queryset = queryset.extra(select={alias: sql}, select_params=params)
+                    groups.append((alias, group.name))
+                else:
+                    groups.append((group, group))
+            functions = dict(
+                ('aggregate_{0}'.format(i), self._aggregate_mapping[function](field or 'pk'))
+                for i, (name, function, field) in enumerate(aggregates)
+            )
+            names = [(alias, name) for alias, name in groups] + [
+                ('aggregate_{0}'.format(i), name) for i, (name, function, field) in enumerate(aggregates)]
+            if not groups:
+                rows = [queryset.aggregate(**functions)]
+            else:
+                rows = queryset.values(*[alias for alias, name in groups]).annotate(**functions).order_by()
+            results = [dict((name, row[alias]) for alias, name in names) for row in rows]
+        results.sort(key=lambda result: tuple(sort_value(result[name]) for alias, name in groups))
+        return results
+
+    def _trigram_candidates(self, model, query, fields, count, using):
+        """
+        Ids of the records which share the most trigrams with the query using the pg_trgm
+        word similarity operator, which can use a GIN trigram index. Its threshold is set
+        to a single shared trigram so that, as with the SearchGram table, every value the
+        query threshold matches is a candidate. It is only set for the transaction of the
+        query so other queries of the connection keep the server setting. The operator
+        needs PostgreSQL 9.6 and pg_trgm 1.2.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        text = ' '.join(query.words)
+        where, shared = [], []
+        for field in fields:
+            column = '{0}.{1}'.format(qn(model._meta.db_table), qn(model._meta.get_field(field).column))
+            where.append('%s <%% {0}'.format(column))
+            shared.append(
+                'cardinality(ARRAY(SELECT unnest(show_trgm({0})) INTERSECT SELECT unnest(show_trgm(%s))))'
+                .format(column))
+        queryset = model.objects.using(using).extra(
+            where=['({0})'.format(' OR '.join(where))], params=[text] * len(fields),
+            select={'search_rank': 'GREATEST({0})'.format(', '.join(shared))},
+            select_params=[text] * len(fields))
+        rows = queryset.order_by('-search_rank').values_list('pk', 'search_rank')[:count]
+        with write_transaction(using):
+            connection.cursor().execute(
+                "SELECT set_config('pg_trgm.word_similarity_threshold', "
+                "(0.99 / GREATEST(cardinality(show_trgm(%s)), 1))::text, true)", [text])
+            return [pk for pk, rank in rows]
+
+    def _gram_candidates(self, model, query, fields, count, using):
+        """
+        Ids of the records which share the most selective trigrams of the query in the
+        SearchGram table. Every match has one of them so the common trigrams, such as
+        those of the first letters of a word, don't need to be read.
+        """
+        rows = SearchGram.objects.using(using).filter(
+            category=model._meta.object_name.lower(), field__in=fields, gram__in=query.selective
+        ).values('record_id').annotate(shared=Count('gram')).order_by('-shared')[:count]
+        return [row['record_id'] for row in rows]
+
+    def _search(self, model, query, fields=None, limit=None, threshold=None):
+        """
+        Rank the records found by the trigram index which best match the query. Only
+        search_pool candidates for each result are ranked so that the search doesn't
+        read every record sharing a common trigram.
+        """
+        query = SearchQuery(query, threshold)
+        if not query:
+            return []
+        fields = fields or SEARCH_FIELDS[model._meta.object_name.lower()]
+        limit = limit or LIMIT
+        candidates = self._trigram_candidates if self.trigram_search else self._gram_candidates
+        with self.router.read() as using:
+            ids = candidates(model, query, fields, limit * self.search_pool, using)
+            records = self._get_many(model, ids, using)
+        return query.rank(records.values(), fields, limit)
+
+    def _get_many(self, model, ids, using):
+        "Fetch records in batches of IDs keyed by the IDs as given."
+        given = {}
+        for id in ids:
+            pk = self._clean_pk(model, id)
+            if pk is not None:
+                given.setdefault(pk, []).append(id)
+        result = {}
+        serializer = get_serializer(model)
+        for chunk in chunked(given, self.batch_size):
+            rows = model.objects.using(using).filter(pk__in=chunk).values_list(*serializer.names)
+            for record in serializer.from_rows(rows):
+                for id in given[record['id']]:
+                    result[id] = record
+        return result
+
+    def get_patient(self, id, source=None, fields=None):
         "Retrieve a patient record by ID."
+        names = self._field_names(Patient, fields)
         if source:
-            patient = self._get_patient_for_source(id, source)
-        else:
-            patient = self._get_patient_by_id(id)
-        return self._patient_to_dict(patient) if patient is not None else None
+            with self.router.read() as using:
+                queryset = PatientID.objects.using(using).filter(uid=id, source=source)
+                return self._get_row(queryset, names, prefix='patient__')
+        pk = self._clean_pk(Patient, id)
+        if pk is None:
+            return None
+        with self.router.read() as using:
+            return self._get_row(Patient.objects.using(using).filter(pk=pk), names)
+
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs."
+        with self.router.read() as using:
+            return self._get_many(Patient, ids, using)
+
+    def get_many_patients_by_source(self, pairs):
+        "Retrieve patient records for a list of (source_id, source_name) pairs."
+        sources = {}
+        for source_id, source_name in pairs:
+            uids = sources.setdefault(source_name, {})
+            uids.setdefault('{0}'.format(source_id), []).append(source_id)
+        result = {}
+        serializer = get_serializer(Patient)
+        columns = ['uid'] + ['patient__{0}'.format(name) for name in serializer.names]
+        with self.router.read() as using:
+            for source_name, uids in sources.items():
+                for chunk in chunked(uids, self.batch_size):
+                    rows = PatientID.objects.using(using).filter(
+                        source=source_name, uid__in=chunk).values_list(*columns)
+                    for row in rows:
+                        record = dict(zip(serializer.names, row[1:]))
+                        for source_id in uids[row[0]]:
+                            result[(source_id, source_name)] = record
+        return result
 
     def create_patient(self, data):
         "Create a patient record."
         # FIXME: Might need additional translation of field names
         try:
-            patient = Patient.objects.create(**data)
-        except:
-            # FIXME: Can we make this exception tighter?
+            using = self.router.db_for_write()
+            with write_transaction(using):
+                patient = Patient.objects.using(using).create(**data)
+                self._log_changes(Patient, changes.CREATE, [patient.pk])
+                self._index(Patient, [patient.pk], created=True)
+        except BULK_ERRORS:
             patient = None
         return self._patient_to_dict(patient) if patient is not None else None
 
@@ -88,37 +636,115 @@ class DjangoStorage(HealthcareStorage):
         # FIXME: Might need additional error handling
         try:
             data['updated_date'] = now()
-            return Patient.objects.filter(pk=id).update(**data)
+            using = self.router.db_for_write()
+            with write_transaction(using):
+                updated = Patient.objects.using(using).filter(pk=id).update(**data)
+                if updated:
+                    self._log_changes(Patient, changes.UPDATE, [id])
+                    self._index(Patient, [id], data)
+            return updated
         except ValueError:
             return False
 
     def delete_patient(self, id):
         "Delete a patient record by ID."
+        using = self.router.db_for_write()
         try:
-            patient = Patient.objects.filter(pk=id)
+            patient = Patient.objects.using(using).filter(pk=id)
         except ValueError:
             return False
         else:
             if patient.exists():
-                patient.delete()
+                with write_transaction(using):
+                    patient.delete()
+                    self._log_changes(Patient, changes.DELETE, [id])
+                    self._index_search(Patient, [id])
                 return True
             return False
 
-    def filter_patients(self, *lookups):
+    def bulk_create_patients(self, data):
+        "Create patient records from a list of dictionaries."
+        return self._bulk_create(Patient, self._patient_to_dict, self.create_patient, data)
+
+    def bulk_update_patients(self, updates):
+        "Update patient records from a list of (id, data) pairs."
+        return self._bulk_update(Patient, updates)
+
+    def bulk_delete_patients(self, ids):
+        "Delete patient records from a list of IDs."
+        return self._bulk_delete(Patient, ids)
+
+    def filter_patients(self, *lookups, **options):
         "Find patient records matching the given lookups."
-        # Construct Q objects from lookups
-        if lookups:
-            q = reduce(operator.and_, map(self._lookup_to_q, lookups))
-        else:
-            q = Q()
-        return map(self._patient_to_dict, Patient.objects.filter(q))
+        return self._filter(Patient, lookups, **options)
+
+    def prepare_patients(self, shape, **options):
+        "Compile a patient filter for a sequence of (field, comparison) pairs."
+        return CompiledFilter(self, Patient, shape, **options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        with self.router.read() as using:
+            return Patient.objects.using(using).filter(self._lookups_to_q(lookups)).count()
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        with self.router.read() as using:
+            return Patient.objects.using(using).filter(self._lookups_to_q(lookups)).exists()
+
+    def aggregate_patients(self, *lookups, **options):
+        "Aggregate the patient records matching the given lookups."
+        return self._aggregate(Patient, lookups, **options)
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        "Find the patient records matching the search query using the trigram index."
+        return self._search(Patient, query, fields, limit, threshold)
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        "Find the patients which may be duplicates of a record sharing one of its blocking keys."
+        if not isinstance(record, dict):
+            record = self.get_patient(record)
+            if record is None:
+                return []
+        keys = list(blocking_keys(record))
+        if not keys:
+            return []
+        with self.router.read() as using:
+            ids = DuplicateKey.objects.using(using).filter(
+                key__in=keys).values_list('patient', flat=True).distinct()
+            records = self._get_many(Patient, list(ids), using)
+        return rank(record, records.values(), threshold, limit)
+
+    def dedupe_patients(self, threshold=None):
+        """
+        Find the pairs of patients which may be duplicates by comparing the patients of
+        each blocking key shared by more than one of them, a batch of keys at a time.
+        Keys shared by more than the Deduplicator's max_block patients aren't read.
+        """
+        deduplicator = Deduplicator(threshold)
+        with self.router.read() as using:
+            keys = DuplicateKey.objects.using(using)
+            shared = keys.values('key').annotate(patients=Count('id')).filter(
+                patients__gt=1, patients__lte=deduplicator.max_block)
+            for chunk in chunked([row['key'] for row in shared], self.batch_size):
+                blocks = {}
+                for key, id in keys.filter(key__in=chunk).values_list('key', 'patient'):
+                    blocks.setdefault(key, []).append(id)
+                records = self._get_many(Patient, set(id for ids in blocks.values() for id in ids), using)
+                for ids in blocks.values():
+                    deduplicator.add([records[id] for id in ids if id in records])
+        return deduplicator.results()
 
     def link_patient(self, id, source_id, source_name):
         "Associated a source/id pair with this patient."
+        using = self.router.db_for_write()
         try:
-            patient_id, created = PatientID.objects.get_or_create(
-                uid=source_id, source=source_name, defaults={'patient_id': id}
-            )
+            with write_transaction(using):
+                patient_id, created = PatientID.objects.using(using).get_or_create(
+                    uid=source_id, source=source_name, defaults={'patient_id': id}
+                )
+                if created:
+                    self._log_changes(Patient, changes.LINK, [id], source_id, source_name)
         except ValueError:
             return False
         else:
@@ -126,33 +752,45 @@ class DjangoStorage(HealthcareStorage):
 
     def unlink_patient(self, id, source_id, source_name):
         "Remove association of a source/id pair with this patient."
+        using = self.router.db_for_write()
         try:
-            patient_id = PatientID.objects.filter(
+            patient_id = PatientID.objects.using(using).filter(
                 uid=source_id, source=source_name, patient=id
             )
         except ValueError:
             return False
         else:
             if patient_id.exists():
-                patient_id.delete()
+                with write_transaction(using):
+                    patient_id.delete()
+                    self._log_changes(Patient, changes.UNLINK, [id], source_id, source_name)
                 return True
             return False
 
-    def get_provider(self, id):
+    def get_provider(self, id, fields=None):
         "Retrieve a provider record by ID."
-        try:
-            provider = Provider.objects.get(pk=id)
-        except (ValueError, Provider.DoesNotExist):
-            provider = None
-        return self._provider_to_dict(provider) if provider is not None else None
+        pk = self._clean_pk(Provider, id)
+        if pk is None:
+            return None
+        names = self._field_names(Provider, fields)
+        with self.router.read() as using:
+            return self._get_row(Provider.objects.using(using).filter(pk=pk), names)
+
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs."
+        with self.router.read() as using:
+            return self._get_many(Provider, ids, using)
 
     def create_provider(self, data):
         "Create a provider record."
         # FIXME: Might need additional translation of field names
         try:
-            provider = Provider.objects.create(**data)
-        except:
-            # FIXME: Can we make this exception tighter?
+            using = self.router.db_for_write()
+            with write_transaction(using):
+                provider = Provider.objects.using(using).create(**data)
+                self._log_changes(Provider, changes.CREATE, [provider.pk])
+                self._index(Provider, [provider.pk], created=True)
+        except BULK_ERRORS:
             provider = None
         return self._provider_to_dict(provider) if provider is not None else None
 
@@ -162,27 +800,114 @@ class DjangoStorage(HealthcareStorage):
         # FIXME: Might need additional error handling
         try:
             data['updated_date'] = now()
-            return Provider.objects.filter(pk=id).update(**data)
+            using = self.router.db_for_write()
+            with write_transaction(using):
+                updated = Provider.objects.using(using).filter(pk=id).update(**data)
+                if updated:
+                    self._log_changes(Provider, changes.UPDATE, [id])
+                    self._index(Provider, [id], data)
+            return updated
         except ValueError:
             return False
 
     def delete_provider(self, id):
         "Delete a provider record by ID."
+        using = self.router.db_for_write()
         try:
-            provider = Provider.objects.filter(pk=id)
+            provider = Provider.objects.using(using).filter(pk=id)
         except ValueError:
             return False
         else:
             if provider.exists():
-                provider.delete()
+                with write_transaction(using):
+                    provider.delete()
+                    self._log_changes(Provider, changes.DELETE, [id])
+                    self._index_search(Provider, [id])
                 return True
             return False
 
-    def filter_providers(self, *lookups):
+    def bulk_create_providers(self, data):
+        "Create provider records from a list of dictionaries."
+        return self._bulk_create(Provider, self._provider_to_dict, self.create_provider, data)
+
+    def bulk_update_providers(self, updates):
+        "Update provider records from a list of (id, data) pairs."
+        return self._bulk_update(Provider, updates)
+
+    def bulk_delete_providers(self, ids):
+        "Delete provider records from a list of IDs."
+        return self._bulk_delete(Provider, ids)
+
+    def filter_providers(self, *lookups, **options):
         "Find provider records matching the given lookups."
-        # Construct Q objects from lookups
-        if lookups:
-            q = reduce(operator.and_, map(self._lookup_to_q, lookups))
-        else:
-            q = Q()
-        return map(self._provider_to_dict, Provider.objects.filter(q))
\ No newline at end of file
+        return self._filter(Provider, lookups, **options)
+
+    def prepare_providers(self, shape, **options):
+        "Compile a provider filter for a sequence of (field, comparison) pairs."
+        return CompiledFilter(self, Provider, shape, **options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        with self.router.read() as using:
+            return Provider.objects.using(using).filter(self._lookups_to_q(lookups)).count()
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        with self.router.read() as using:
+            return Provider.objects.using(using).filter(self._lookups_to_q(lookups)).exists()
+
+    def aggregate_providers(self, *lookups, **options):
+        "Aggregate the provider records matching the given lookups."
+        return self._aggregate(Provider, lookups, **options)
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        "Find the provider records matching the search query using the trigram index."
+        return self._search(Provider, query, fields, limit, threshold)
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        "Find the changes made after the cursor by reading the change log in key order."
+        start = change_sequence(after)
+        size = chunk_size or self.chunk_size
+        columns = ('pk', 'category', 'action', 'record_id', 'source_id', 'source_name', 'date')
+
+        def generate():
+            settled = now() - datetime.timedelta(seconds=self.change_settle)
+            last, remaining = start, limit
+            with self.router.read() as using:
+                log = Change.objects.using(using).order_by('pk').values_list(*columns)
+                while remaining is None or remaining > 0:
+                    count = size if remaining is None else min(size, remaining)
+                    # Seek past the last entry so each chunk is a range of the primary key
+                    rows = list(log.filter(pk__gt=last)[:count])
+                    for row in rows:
+                        if row[0] != last + 1 and row[-1] > settled:
+                            # Keys are assigned on insert so a gap before a recent change, including
+                            # one before the first change read without a cursor, may still be
+                            # filled by a transaction which commits later
+                            return
+                        last = row[0]
+                        yield self._change_to_dict(row)
+                    if len(rows) < count:
+                        break
+                    if remaining is not None:
+                        remaining -= count
+
+        return ResultSet(generate, key=change_key)
+
+    def thread_call(self, function):
+        """
+        Wrap a function which another thread calls with this storage so that its reads use
+        the current thread's pins and its writes pin this thread. Pools keep their threads,
+        which get no request_finished signal, so the connections it opens are closed after it.
+        """
+        pinned = carry_pins(function)
+        aliases = [self.router.primary] + self.router.replicas
+
+        def call(*args, **kwargs):
+            try:
+                return pinned(*args, **kwargs)
+            finally:
+                for alias in aliases:
+                    connections[alias].close()
+
+        return call
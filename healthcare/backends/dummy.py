@@ -1,20 +1,347 @@
 from __future__ import absolute_import
 
+import bisect
+import heapq
+import itertools
 import operator
 import uuid
 
+from django.conf import settings
 from django.utils.timezone import now
 
-from . import comparisons
-from .base import HealthcareStorage
+from . import changes, comparisons
+from .aggregates import Aggregator, sort_value
+from .duplicates import KEY_FIELDS, Deduplicator, blocking_keys, rank
+from .expressions import And, Expression, Not, Or
+from .search import LIMIT, SEARCH_FIELDS, SearchQuery, trigrams
+from .base import (HealthcareStorage, ResultSet, change_key, change_sequence, decode_cursor,
+    get_fields, get_ordering, project)
+
+
+class Descending(object):
+    "Sort key wrapper which reverses the comparison of the wrapped value."
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __le__(self, other):
+        return self.value >= other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __ge__(self, other):
+        return self.value <= other.value
+
+
+class Last(object):
+    "Sort key sentinel which compares greater than any other value."
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return self is other
+
+    def __gt__(self, other):
+        return self is not other
+
+    def __ge__(self, other):
+        return True
+
+    __hash__ = object.__hash__
+
+
+LAST = Last()
+
+
+class MemoryTable(object):
+    """
+    Records keyed by ID. Hash indexes for equality lookups, sorted indexes for range
+    lookups and ordering and trigram indexes for searches are built the first time a
+    field needs them and are kept up to date on each write after that. When given
+    a blocking function, the ids of the records with each of the blocking keys it
+    returns for a record are kept from the start.
+    """
+
+    def __init__(self, category=None, blocking=None):
+        self.category = category
+        self.blocking = blocking
+        self.records = {}
+        # field -> {value: set of ids}
+        self._hashes = {}
+        # Fields with values which can't be hashed
+        self._unhashable = set()
+        # ordering -> (sorted keys, ids in the same order)
+        self._sorted = {}
+        # field -> {trigram: set of ids}
+        self._grams = {}
+        # blocking key -> set of ids
+        self.blocks = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, id):
+        return id in self.records
+
+    def get(self, id):
+        return self.records.get(id)
+
+    def insert(self, id, record):
+        self.records[id] = record
+        self._add(id, record)
+
+    def update(self, id, changes):
+        record = self.records[id]
+        self._remove(id, record, changes)
+        record.update(changes)
+        self._add(id, record, changes)
+
+    def delete(self, id):
+        record = self.records.pop(id)
+        self._remove(id, record)
+
+    def sort_key(self, ordering, record):
+        "Build a comparable key for the record with empty values first."
+        return tuple(
+            Descending(sort_value(record.get(field))) if descending else sort_value(record.get(field))
+            for field, descending in ordering
+        )
+
+    def hash_index(self, field):
+        "Return the ids for each value of the field or None if they can't be hashed."
+        if field in self._unhashable:
+            return None
+        if field not in self._hashes:
+            index = {}
+            try:
+                for id, record in self.records.items():
+                    value = record.get(field)
+                    if value is not None:
+                        index.setdefault(value, set()).add(id)
+            except TypeError:
+                self._unhashable.add(field)
+                return None
+            self._hashes[field] = index
+        return self._hashes[field]
+
+    def gram_index(self, field):
+        "Return the ids of the records with each trigram in the words of the field."
+        if field not in self._grams:
+            index = {}
+            for id, record in self.records.items():
+                for gram in trigrams(record.get(field)):
+                    index.setdefault(gram, set()).add(id)
+            self._grams[field] = index
+        return self._grams[field]
+
+    def sorted_index(self, ordering):
+        "Return the sorted keys and the matching ids for an ordering."
+        ordering = tuple(ordering)
+        if ordering not in self._sorted:
+            entries = sorted((self.sort_key(ordering, record), id) for id, record in self.records.items())
+            self._sorted[ordering] = ([key for key, _ in entries], [id for _, id in entries])
+        return self._sorted[ordering]
+
+    def lookup_ids(self, lookup):
+        "Return the set of ids matching an equality lookup or None if it needs a scan."
+        field, operator, value = lookup
+        if operator not in (comparisons.EQUAL, comparisons.IN):
+            return None
+        index = self.hash_index(field)
+        if index is None:
+            return None
+        try:
+            if operator == comparisons.EQUAL:
+                return set(index.get(value, ()))
+            result = set()
+            for item in value:
+                result.update(index.get(item, ()))
+            return result
+        except TypeError:
+            # Unhashable lookup value
+            return None
+
+    def range_ids(self, field, bounds):
+        """
+        Return the ids sorted by the field with the start and end positions of those
+        within all of the (operator, value) bounds or None if they can't be compared.
+        """
+        keys, ids = self.sorted_index(((field, False), ('id', False)))
+        # Records without a value never match a range
+        start, end = bisect.bisect_left(keys, ((1, ), )), len(keys)
+        try:
+            for operator, value in bounds:
+                if operator == comparisons.LT:
+                    end = min(end, bisect.bisect_left(keys, ((1, value), )))
+                elif operator == comparisons.LTE:
+                    end = min(end, bisect.bisect_left(keys, ((1, value), LAST)))
+                elif operator == comparisons.GT:
+                    start = max(start, bisect.bisect_left(keys, ((1, value), LAST)))
+                else:
+                    start = max(start, bisect.bisect_left(keys, ((1, value), )))
+        except TypeError:
+            return None
+        return ids, start, max(start, end)
+
+    def _add(self, id, record, fields=None):
+        for field, index in list(self._hashes.items()):
+            if fields is None or field in fields:
+                value = record.get(field)
+                if value is not None:
+                    try:
+                        index.setdefault(value, set()).add(id)
+                    except TypeError:
+                        del self._hashes[field]
+                        self._unhashable.add(field)
+        for field, index in self._grams.items():
+            if fields is None or field in fields:
+                for gram in trigrams(record.get(field)):
+                    index.setdefault(gram, set()).add(id)
+        if self.blocking is not None and (fields is None or any(field in fields for field in KEY_FIELDS)):
+            for key in self.blocking(record):
+                self.blocks.setdefault(key, set()).add(id)
+        for ordering, (keys, ids) in list(self._sorted.items()):
+            if fields is None or any(field in fields for field, _ in ordering):
+                key = self.sort_key(ordering, record)
+                try:
+                    position = bisect.bisect_left(keys, key)
+                except TypeError:
+                    # Rebuilt, and fails like any sort would, when next used
+                    del self._sorted[ordering]
+                else:
+                    keys.insert(position, key)
+                    ids.insert(position, id)
+
+    def _remove(self, id, record, fields=None):
+        for field, index in self._hashes.items():
+            if fields is None or field in fields:
+                value = record.get(field)
+                if value is not None:
+                    matching = index.get(value)
+                    if matching is not None:
+                        matching.discard(id)
+                        if not matching:
+                            del index[value]
+        for field, index in self._grams.items():
+            if fields is None or field in fields:
+                for gram in trigrams(record.get(field)):
+                    matching = index.get(gram)
+                    if matching is not None:
+                        matching.discard(id)
+                        if not matching:
+                            del index[gram]
+        if self.blocking is not None and (fields is None or any(field in fields for field in KEY_FIELDS)):
+            for key in self.blocking(record):
+                matching = self.blocks.get(key)
+                if matching is not None:
+                    matching.discard(id)
+                    if not matching:
+                        del self.blocks[key]
+        for ordering, (keys, ids) in list(self._sorted.items()):
+            if fields is None or any(field in fields for field, _ in ordering):
+                try:
+                    position = bisect.bisect_left(keys, self.sort_key(ordering, record))
+                except TypeError:
+                    del self._sorted[ordering]
+                else:
+                    if position < len(ids) and ids[position] == id:
+                        del keys[position]
+                        del ids[position]
+
+
+class CompiledFilter(object):
+    """
+    Filter of a table with the ordering and fields resolved once for a shape of
+    (field, comparison) pairs. The indexes used depend on the lookup values so
+    they are still chosen when the filter is run.
+    """
+
+    def __init__(self, storage, table, shape, chunk_size=None, order_by=None, fields=None):
+        self.storage, self.table = storage, table
+        # Expressions in the shape have no values to bind
+        self.expressions = [item for item in shape if isinstance(item, Expression)]
+        self.shape = tuple(item for item in shape if not isinstance(item, Expression))
+        self.ordering = tuple(get_ordering(order_by))
+        self.fields = [field for field, _ in self.ordering]
+        self.names = get_fields(fields, self.ordering) if fields is not None else None
+        self.size = chunk_size or storage.chunk_size
+
+    def key(self, record):
+        return [record.get(field) for field in self.fields]
+
+    def run(self, values, limit=None, offset=None, after=None):
+        "Lazily find the records matching the lookup values in sorted order."
+        storage, table, ordering, names, size = (
+            self.storage, self.table, self.ordering, self.names, self.size)
+        lookups = [(field, comparison, value) for (field, comparison), value in zip(self.shape, values)]
+        lookups.extend(self.expressions)
+        cursor = decode_cursor(after) if after is not None else None
+
+        def matching():
+            candidates, filters = storage._plan(table, lookups)
+            if candidates is not None and len(candidates) <= len(table) * storage.sort_fraction:
+                entries = sorted(
+                    (table.sort_key(ordering, table.records[id]), id) for id in candidates)
+                keys, ids = [key for key, _ in entries], [id for _, id in entries]
+            else:
+                keys, ids = table.sorted_index(ordering)
+            position = 0
+            if cursor is not None:
+                position = bisect.bisect_right(
+                    keys, table.sort_key(ordering, dict(zip(self.fields, cursor))))
+            while True:
+                # Seek from the last key between chunks so writes made while
+                # iterating don't shift the position
+                chunk_keys, chunk_ids = keys[position:position + size], ids[position:position + size]
+                if not chunk_ids:
+                    return
+                for id in chunk_ids:
+                    if candidates is not None and id not in candidates:
+                        continue
+                    record = table.get(id)
+                    if record is not None and all(f(record) for f in filters):
+                        yield project(record, names) if names else dict(record)
+                position = bisect.bisect_right(keys, chunk_keys[-1])
+
+        def generate():
+            stop = None if limit is None else (offset or 0) + limit
+            return itertools.islice(matching(), offset or 0, stop)
+
+        return ResultSet(generate, key=self.key)
 
 
 class DummyStorage(HealthcareStorage):
-    "In-memory storage. This should only be used for testing."
+    """
+    In-memory storage. Each instance keeps its own indexed records so it can also
+    be used as a fast local store.
+    """
 
-    _patients = {}
-    _patient_ids = {}
-    _providers = {}
+    # Sort the candidates from the indexes rather than walking the ordering
+    # when they are at most this fraction of the records
+    sort_fraction = 0.1
+    # Number of ids read from an ordering at a time
+    chunk_size = 1000
+    # Candidate records ranked for each search result, chosen by their shared trigrams
+    search_pool = 10
 
     _comparison_mapping = {
         comparisons.EQUAL: operator.eq,
@@ -29,21 +356,222 @@ class DummyStorage(HealthcareStorage):
         comparisons.GT: operator.gt,
         comparisons.GTE: operator.ge,
     }
+    _range_comparisons = (comparisons.LT, comparisons.LTE, comparisons.GT, comparisons.GTE)
+
+    def __init__(self):
+        self._patients = MemoryTable('patient', blocking=blocking_keys)
+        self._providers = MemoryTable('provider')
+        self._patient_ids = {}
+        # Change feed entries in order; the sequence of each is its position plus one
+        self._changes = []
+
+    def _log_change(self, category, action, id, source_id=None, source_name=None):
+        "Add a write to the change feed unless HEALTHCARE_CHANGE_LOG is disabled."
+        if getattr(settings, 'HEALTHCARE_CHANGE_LOG', True):
+            self._changes.append({
+                'sequence': len(self._changes) + 1, 'category': category, 'action': action,
+                'id': id, 'source_id': source_id, 'source_name': source_name, 'date': now(),
+            })
 
     def _lookup_to_filter(self, lookup):
+        if isinstance(lookup, Expression):
+            return self._expression_to_filter(lookup)
+        field, operator, value = lookup
+        comparison_func = self._comparison_mapping[operator]
+
         def filter_func(item):
-            field, operator, value = lookup
-            comparison_func = self._comparison_mapping[operator]
             field_value = item.get(field)
             if field_value is None:
                 return False
             return comparison_func(field_value, value)
         return filter_func
 
+    def _expression_to_filter(self, expression):
+        "Filter which stops checking the children once the result is known."
+        children = [self._lookup_to_filter(child) for child in expression.children]
+        if isinstance(expression, Not):
+            child = children[0]
+            return lambda item: not child(item)
+        if isinstance(expression, Or):
+            return lambda item: any(f(item) for f in children)
+        return lambda item: all(f(item) for f in children)
+
+    def _expression_ids(self, table, expression):
+        """
+        Ids of the records matching an Or of indexed lookups or None if any of its
+        children can't be answered from the indexes.
+        """
+        ids = set()
+        for child in expression.children:
+            if isinstance(child, Or):
+                found = self._expression_ids(table, child)
+            elif isinstance(child, Expression):
+                found = None
+            else:
+                found = table.lookup_ids(child)
+            if found is None:
+                return None
+            ids |= found
+        return ids
+
+    def _flatten(self, lookups):
+        "Expand the children of And expressions into the list of lookups."
+        for lookup in lookups:
+            if isinstance(lookup, And):
+                for child in self._flatten(lookup.children):
+                    yield child
+            else:
+                yield lookup
+
+    def _plan(self, table, lookups):
+        "Split the lookups into the ids matched by the indexes and the filters left to scan."
+        matched, filters, ranges = [], [], {}
+        for lookup in self._flatten(lookups):
+            if isinstance(lookup, Expression):
+                ids = self._expression_ids(table, lookup) if isinstance(lookup, Or) else None
+                if ids is None:
+                    filters.append(self._expression_to_filter(lookup))
+                else:
+                    matched.append(ids)
+                continue
+            field, operator, value = lookup
+            if operator in self._range_comparisons and value is not None:
+                ranges.setdefault(field, []).append(lookup)
+                continue
+            ids = table.lookup_ids(lookup)
+            if ids is None:
+                filters.append(self._lookup_to_filter(lookup))
+            else:
+                matched.append(ids)
+        candidates = None
+        for ids in sorted(matched, key=len):
+            candidates = ids if candidates is None else candidates & ids
+        slices = []
+        for field, field_lookups in ranges.items():
+            found = None
+            try:
+                found = table.range_ids(field, [lookup[1:] for lookup in field_lookups])
+            except TypeError:
+                # Values of the field can't be sorted
+                pass
+            if found is None:
+                filters.extend(self._lookup_to_filter(lookup) for lookup in field_lookups)
+            else:
+                slices.append((found, field_lookups))
+        for (ids, start, end), field_lookups in sorted(slices, key=lambda s: s[0][2] - s[0][1]):
+            if candidates is not None and end - start > len(candidates):
+                # Checking the few candidates is cheaper than collecting the range
+                filters.extend(self._lookup_to_filter(lookup) for lookup in field_lookups)
+            else:
+                ids = set(ids[start:end])
+                candidates = ids if candidates is None else candidates & ids
+        return candidates, filters
+
+    def _filter(self, table, lookups, chunk_size=None,
+                order_by=None, limit=None, offset=None, after=None, fields=None):
+        "Lazily find the records matching all of the lookups in sorted order."
+        expressions = [lookup for lookup in lookups if isinstance(lookup, Expression)]
+        plain = [lookup for lookup in lookups if not isinstance(lookup, Expression)]
+        plan = CompiledFilter(self, table, [lookup[:2] for lookup in plain] + expressions,
+            chunk_size=chunk_size, order_by=order_by, fields=fields)
+        return plan.run([lookup[2] for lookup in plain], limit=limit, offset=offset, after=after)
+
+    def _matching(self, table, lookups):
+        "Generate the ids of the records matching all of the lookups without sorting."
+        candidates, filters = self._plan(table, lookups)
+        ids = table.records if candidates is None else candidates
+        if not filters:
+            return ids
+        return (id for id in ids if all(f(table.records[id]) for f in filters))
+
+    def _count(self, table, lookups):
+        "Count the records matching all of the lookups."
+        ids = self._matching(table, lookups)
+        if isinstance(ids, (dict, set)):
+            return len(ids)
+        return sum(1 for id in ids)
+
+    def _exists(self, table, lookups):
+        "Check whether any of the records match all of the lookups."
+        for id in self._matching(table, lookups):
+            return True
+        return False
+
+    def _aggregate(self, table, lookups, group_by=None, aggregates=()):
+        "Aggregate the records matching all of the lookups in a single pass."
+        aggregator = Aggregator(group_by, aggregates)
+        records = table.records
+        for id in self._matching(table, lookups):
+            aggregator.add(records[id])
+        return aggregator.results()
+
+    def _search(self, table, query, fields=None, limit=None, threshold=None):
+        """
+        Rank the records sharing the most trigrams with the query in any of the fields.
+        A record sharing the minimum number of trigrams has at least one of the rarest
+        of them so only their ids are read from the index and the others are checked
+        for those ids.
+        """
+        query = SearchQuery(query, threshold)
+        if not query:
+            return []
+        fields = fields or SEARCH_FIELDS[table.category]
+        limit = limit or LIMIT
+        shared = {}
+        for field in fields:
+            index = table.gram_index(field)
+            postings = sorted((index.get(gram, ()) for gram in query.lookup), key=len)
+            for id in set().union(*query.prefix(postings)):
+                count = sum(1 for ids in postings if id in ids)
+                if count >= query.minimum:
+                    shared[id] = max(shared.get(id, 0), count)
+        candidates = heapq.nlargest(limit * self.search_pool, shared, key=shared.get)
+        return query.rank([dict(table.records[id]) for id in candidates], fields, limit)
+
+    def _get_many(self, table, ids):
+        result = {}
+        for id in ids:
+            record = table.get(id)
+            if record is not None:
+                result[id] = dict(record)
+        return result
+
+    def _create(self, table, data):
+        record = dict(data)
+        record['created_date'] = now()
+        record['updated_date'] = now()
+        if 'status' not in record:
+            record['status'] = 'A'
+        record['id'] = uuid.uuid4().int
+        table.insert(record['id'], record)
+        self._log_change(table.category, changes.CREATE, record['id'])
+        return dict(record)
+
+    def _update(self, table, id, data):
+        if id in table:
+            values = dict(data)
+            values['updated_date'] = now()
+            table.update(id, values)
+            self._log_change(table.category, changes.UPDATE, id)
+            return True
+        return False
+
+    def _delete(self, table, id):
+        if id in table:
+            table.delete(id)
+            self._log_change(table.category, changes.DELETE, id)
+            return True
+        return False
+
     def _build_source_id(self, source_id, source_name):
        return '{0}-{1}'.format(source_id, source_name)
 
-    def get_patient(self, id, source=None):
+    def _copy(self, record, fields=None):
+        if record is None:
+            return None
+        return project(record, get_fields(fields)) if fields is not None else dict(record)
+
+    def get_patient(self, id, source=None, fields=None):
         "Retrieve a patient record by ID."
         patient = None
         if source:
@@ -53,38 +581,77 @@ class DummyStorage(HealthcareStorage):
                 patient = self._patients.get(patient_id)
         else:
             patient = self._patients.get(id)
-        return patient
+        return self._copy(patient, fields)
+
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs."
+        return self._get_many(self._patients, ids)
+
+    def get_many_patients_by_source(self, pairs):
+        "Retrieve patient records for a list of (source_id, source_name) pairs."
+        result = {}
+        for source_id, source_name in pairs:
+            patient = self._patients.get(
+                self._patient_ids.get(self._build_source_id(source_id, source_name)))
+            if patient is not None:
+                result[(source_id, source_name)] = dict(patient)
+        return result
 
     def create_patient(self, data):
         "Create a patient record."
-        uid = uuid.uuid4().int
-        data['created_date'] = now()
-        data['updated_date'] = now()
-        if 'status' not in data:
-            data['status'] = 'A'
-        self._patients[uid] = data
-        data['id'] = uid
-        return data
+        return self._create(self._patients, data)
 
     def update_patient(self, id, data):
         "Update a patient record by ID."
-        if id in self._patients:
-            data['updated_date'] = now()
-            self._patients[id].update(data)
-            return True
-        return False
+        return self._update(self._patients, id, data)
 
     def delete_patient(self, id):
         "Delete a patient record by ID."
-        if id in self._patients:
-            del self._patients[id]
-            return True
-        return False
+        return self._delete(self._patients, id)
 
-    def filter_patients(self, *lookups):
+    def filter_patients(self, *lookups, **options):
         "Find patient records matching the given lookups."
-        filters = map(self._lookup_to_filter, lookups)
-        return filter(lambda t: all(f(t) for f in filters), self._patients.values())
+        return self._filter(self._patients, lookups, **options)
+
+    def prepare_patients(self, shape, **options):
+        "Compile a patient filter for a sequence of (field, comparison) pairs."
+        return CompiledFilter(self, self._patients, shape, **options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        return self._count(self._patients, lookups)
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        return self._exists(self._patients, lookups)
+
+    def aggregate_patients(self, *lookups, **options):
+        "Aggregate the patient records matching the given lookups."
+        return self._aggregate(self._patients, lookups, **options)
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        "Find the patient records matching the search query using the trigram indexes."
+        return self._search(self._patients, query, fields, limit, threshold)
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        "Find the patients which may be duplicates of a record in the blocks of its keys."
+        if not isinstance(record, dict):
+            record = self._patients.get(record)
+            if record is None:
+                return []
+        ids = set()
+        for key in blocking_keys(record):
+            ids.update(self._patients.blocks.get(key, ()))
+        return rank(record, [dict(self._patients.records[id]) for id in ids], threshold, limit)
+
+    def dedupe_patients(self, threshold=None):
+        "Find the pairs of patients which may be duplicates by comparing those in each block."
+        deduplicator = Deduplicator(threshold)
+        records = self._patients.records
+        for ids in self._patients.blocks.values():
+            if len(ids) > 1:
+                deduplicator.add([records[id] for id in ids])
+        return deduplicator.results()
 
     def link_patient(self, id, source_id, source_name):
         "Associated a source/id pair with this patient."
@@ -94,6 +661,7 @@ class DummyStorage(HealthcareStorage):
         if id not in self._patients:
             return False
         self._patient_ids[uid] = id
+        self._log_change('patient', changes.LINK, id, source_id, source_name)
         return True
 
     def unlink_patient(self, id, source_id, source_name):
@@ -101,40 +669,60 @@ class DummyStorage(HealthcareStorage):
         uid = self._build_source_id(source_id, source_name)
         if uid in self._patient_ids:
             del self._patient_ids[uid]
+            self._log_change('patient', changes.UNLINK, id, source_id, source_name)
             return True
         return False
 
-    def get_provider(self, id):
+    def get_provider(self, id, fields=None):
         "Retrieve a provider record by ID."
-        return self._providers.get(id)
+        return self._copy(self._providers.get(id), fields)
+
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs."
+        return self._get_many(self._providers, ids)
 
     def create_provider(self, data):
         "Create a provider record."
-        uid = uuid.uuid4().int
-        data['created_date'] = now()
-        data['updated_date'] = now()
-        if 'status' not in data:
-            data['status'] = 'A'
-        self._providers[uid] = data
-        data['id'] = uid
-        return data
+        return self._create(self._providers, data)
 
     def update_provider(self, id, data):
         "Update a provider record by ID."
-        if id in self._providers:
-            data['updated_date'] = now()
-            self._providers[id].update(data)
-            return True
-        return False
+        return self._update(self._providers, id, data)
 
     def delete_provider(self, id):
         "Delete a provider record by ID."
-        if id in self._providers:
-            del self._providers[id]
-            return True
-        return False
+        return self._delete(self._providers, id)
 
-    def filter_providers(self, *lookups):
+    def filter_providers(self, *lookups, **options):
         "Find provider records matching the given lookups."
-        filters = map(self._lookup_to_filter, lookups)
-        return filter(lambda t: all(f(t) for f in filters), self._providers.values())
+        return self._filter(self._providers, lookups, **options)
+
+    def prepare_providers(self, shape, **options):
+        "Compile a provider filter for a sequence of (field, comparison) pairs."
+        return CompiledFilter(self, self._providers, shape, **options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        return self._count(self._providers, lookups)
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        return self._exists(self._providers, lookups)
+
+    def aggregate_providers(self, *lookups, **options):
+        "Aggregate the provider records matching the given lookups."
+        return self._aggregate(self._providers, lookups, **options)
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        "Find the provider records matching the search query using the trigram indexes."
+        return self._search(self._providers, query, fields, limit, threshold)
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        "Find the changes made after the cursor."
+        start = change_sequence(after)
+
+        def generate():
+            stop = None if limit is None else start + limit
+            return (dict(change) for change in itertools.islice(self._changes, start, stop))
+
+        return ResultSet(generate, key=change_key)
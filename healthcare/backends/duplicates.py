@@ -0,0 +1,224 @@
+"""
+Blocking keys and scoring of the duplicate patient candidates found by the backend
+duplicate methods. Patients which may be duplicates share a blocking key, made of
+the Soundex code of a word of their name and their birth year or location, so only
+the patients of the same blocks need to be compared.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+from .search import trigrams, words
+
+
+# Patient fields used by the blocking keys
+KEY_FIELDS = ('name', 'birth_date', 'location')
+
+# Lowest score of the patients returned as duplicates
+THRESHOLD = 0.75
+
+# Weight of each field's similarity in the score of a pair of patients
+WEIGHTS = (
+    ('name', 0.6),
+    ('birth_date', 0.3),
+    ('location', 0.1),
+)
+
+# Name similarity when every word of the shorter name sounds like a word of the other
+PHONETIC_MATCH = 0.9
+
+# Factor applied to the score when both patients have a different sex
+SEX_MISMATCH = 0.5
+
+# Longest blocking key
+KEY_LENGTH = 255
+
+# Most patients of a block compared by dedupe
+MAX_BLOCK = 200
+
+_soundex_codes = {}
+for code, letters in enumerate(('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r')):
+    for letter in letters:
+        _soundex_codes[letter] = '{0}'.format(code)
+
+
+def soundex(word):
+    "American Soundex code of a word, or an empty string if it has no letters from a to z."
+    letters = [letter for letter in word.lower() if letter in _soundex_codes]
+    if not letters:
+        return ''
+    result, last = [letters[0].upper()], _soundex_codes[letters[0]]
+    for letter in letters[1:]:
+        code = _soundex_codes[letter]
+        if code != '0' and code != last:
+            result.append(code)
+        # Letters with the same code separated by h or w are coded once
+        if letter not in 'hw':
+            last = code
+    return (''.join(result) + '000')[:4]
+
+
+def name_codes(name):
+    "Soundex codes of the words of a name."
+    return set(code for code in map(soundex, words(name)) if code)
+
+
+def blocking_keys(record):
+    """
+    Keys of the blocks of a patient: the code of each word of the name with the
+    birth year, the codes of the whole name with the location and, if it has neither
+    birth date nor location, the code of each word alone.
+    """
+    birth_date = record.get('birth_date')
+    year = birth_date.year if isinstance(birth_date, datetime.date) else None
+    location = ' '.join(words(record.get('location')))
+    codes = name_codes(record.get('name'))
+    keys = set()
+    if year is not None:
+        keys.update('{0}:{1}'.format(code, year) for code in codes)
+    if location and codes:
+        # Keys are limited to the length of the DjangoStorage column
+        keys.add('{0}@{1}'.format(' '.join(sorted(codes)), location)[:KEY_LENGTH])
+    if year is None and not location:
+        keys.update(codes)
+    return keys
+
+
+def name_similarity(first, second):
+    "Trigram similarity of two names, or the phonetic match of their words if higher."
+    return _name_similarity(trigrams(first), name_codes(first), trigrams(second), name_codes(second))
+
+
+def _name_similarity(first_grams, first_codes, second_grams, second_codes):
+    if not first_grams or not second_grams:
+        return 0.0
+    similarity = len(first_grams & second_grams) / float(len(first_grams | second_grams))
+    shorter, longer = sorted([first_codes, second_codes], key=len)
+    if shorter:
+        phonetic = len(shorter & longer) / float(len(shorter))
+        similarity = max(similarity, PHONETIC_MATCH * phonetic)
+    return similarity
+
+
+def date_similarity(first, second):
+    "Similarity of two dates allowing for swapped days and months and single digit typos."
+    if first == second:
+        return 1.0
+    if first.year == second.year and (first.month, first.day) == (second.day, second.month):
+        return 0.9
+    first_digits, second_digits = first.strftime('%Y%m%d'), second.strftime('%Y%m%d')
+    different = [i for i, (a, b) in enumerate(zip(first_digits, second_digits)) if a != b]
+    if len(different) == 1:
+        return 0.8
+    if len(different) == 2 and different[1] == different[0] + 1 and \
+            first_digits[different[0]] == second_digits[different[1]] and \
+            first_digits[different[1]] == second_digits[different[0]]:
+        # Adjacent digits transposed
+        return 0.8
+    if first.year == second.year:
+        return 0.4
+    return 0.0
+
+
+class Comparable(object):
+    "Patient record with the parts of its fields which are compared worked out once."
+
+    __slots__ = ('record', 'grams', 'codes', 'birth_date', 'location', 'sex')
+
+    def __init__(self, record):
+        self.record = record
+        name = record.get('name')
+        self.grams, self.codes = trigrams(name), name_codes(name)
+        birth_date = record.get('birth_date')
+        self.birth_date = birth_date if isinstance(birth_date, datetime.date) else None
+        self.location = words(record.get('location')) or None
+        self.sex = record.get('sex') or None
+
+
+def _score(first, second):
+    total = weights = 0.0
+    for field, weight in WEIGHTS:
+        if field == 'name':
+            similarity = _name_similarity(first.grams, first.codes, second.grams, second.codes)
+        else:
+            a, b = getattr(first, field), getattr(second, field)
+            if a is None or b is None:
+                continue
+            if field == 'birth_date':
+                similarity = date_similarity(a, b)
+            else:
+                similarity = 1.0 if a == b else 0.0
+        total += weight * similarity
+        weights += weight
+    result = total / weights
+    if first.sex and second.sex and first.sex != second.sex:
+        result *= SEX_MISMATCH
+    return result
+
+
+def score(first, second):
+    """
+    Likelihood from 0 to 1 that two patient records are the same patient. Fields
+    missing from either record don't count towards the score.
+    """
+    return _score(Comparable(first), Comparable(second))
+
+
+def rank(record, candidates, threshold=None, limit=None):
+    """
+    (patient, score) of the candidates scoring at least the threshold against the
+    record, best first. The record itself is left out when it has an id.
+    """
+    threshold = THRESHOLD if threshold is None else threshold
+    comparable, results = Comparable(record), []
+    for candidate in candidates:
+        if record.get('id') is not None and candidate['id'] == record['id']:
+            continue
+        similarity = _score(comparable, Comparable(candidate))
+        if similarity >= threshold:
+            results.append((candidate, similarity))
+    results.sort(key=lambda item: (-item[1], item[0]['id']))
+    return results[:limit]
+
+
+class Deduplicator(object):
+    """
+    Compares the patients of each block added and keeps the pairs of ids, lowest id
+    first, scoring at least the threshold. Pairs found in more than one block are
+    only compared once. Blocks of more than max_block patients, such as those of a
+    common name at a large location, are skipped since comparing every pair of them
+    is slow and a duplicate pair usually also shares a smaller block.
+    """
+
+    def __init__(self, threshold=None, max_block=MAX_BLOCK):
+        self.threshold = THRESHOLD if threshold is None else threshold
+        self.max_block = max_block
+        self.pairs = {}
+        self.skipped = 0
+        self._comparables = {}
+
+    def _comparable(self, record):
+        comparable = self._comparables.get(record['id'])
+        if comparable is None:
+            comparable = self._comparables[record['id']] = Comparable(record)
+        return comparable
+
+    def add(self, block):
+        "Compare each pair of the patient records in a block."
+        if self.max_block is not None and len(block) > self.max_block:
+            self.skipped += 1
+            return
+        block = sorted((self._comparable(record) for record in block), key=lambda c: c.record['id'])
+        for i, first in enumerate(block):
+            for second in block[i + 1:]:
+                pair = (first.record['id'], second.record['id'])
+                if pair in self.pairs:
+                    continue
+                similarity = _score(first, second)
+                self.pairs[pair] = similarity if similarity >= self.threshold else None
+
+    def results(self):
+        "List of (first id, second id, score) of the duplicates, best first."
+        results = [pair + (similarity, ) for pair, similarity in self.pairs.items() if similarity is not None]
+        results.sort(key=lambda item: (-item[2], item[0], item[1]))
+        return results
@@ -0,0 +1,46 @@
+"""
+Boolean expressions of lookups which can be passed to the backend filter methods
+along with plain (field_name, operator, value) lookups.
+"""
+from __future__ import unicode_literals
+
+from ..utils import freeze
+
+
+class Expression(object):
+    "Combination of lookups and other expressions."
+
+    def __init__(self, *children):
+        self.children = tuple(children)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.children == other.children
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__, freeze(self.children)))
+
+    def __repr__(self):
+        return '{0}{1!r}'.format(type(self).__name__, self.children)
+
+
+class And(Expression):
+    "Matches the records which match all of the children."
+
+
+class Or(Expression):
+    "Matches the records which match any of the children."
+
+
+class Not(Expression):
+    "Matches the records which don't match the child."
+
+    def __init__(self, child):
+        super(Not, self).__init__(child)
+
+    @property
+    def child(self):
+        return self.children[0]
+
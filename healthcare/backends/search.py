@@ -0,0 +1,126 @@
+"""
+Trigram matching and ranking of the patient and provider name searches shared by
+the backend search methods.
+"""
+from __future__ import unicode_literals
+
+import math
+import re
+
+
+# Fields of each category which can be searched, the first are searched by default
+SEARCH_FIELDS = {
+    'patient': ('name', 'location'),
+    'provider': ('name', ),
+}
+
+# Default number of results of a search
+LIMIT = 20
+
+# Fewest of the query trigrams, as a fraction, which a value must share to match
+# when it doesn't contain every word of the query
+THRESHOLD = 0.5
+
+_separators = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def words(text):
+    "Lower case words of the text."
+    return [word for word in _separators.split('{0}'.format(text or '').lower()) if word]
+
+
+def word_trigrams(word):
+    "Trigrams of a word padded with two spaces before and one after, as pg_trgm does."
+    padded = '  {0} '.format(word)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def trigrams(text):
+    "Set of the trigrams of each word of the text."
+    grams = set()
+    for word in words(text):
+        grams |= word_trigrams(word)
+    return grams
+
+
+class SearchQuery(object):
+    """
+    Search text parsed into its words and trigrams. A value matches when each word of
+    the query is found in one of its words, anywhere for words of three or more letters
+    and at the start for shorter ones, or when it shares at least the threshold fraction
+    of the query trigrams. Backends find candidates with an index of the trigrams in
+    lookup which share at least minimum of them and then rank them with score.
+    """
+
+    def __init__(self, text, threshold=None):
+        self.words = words(text)
+        self.threshold = THRESHOLD if threshold is None else threshold
+        self.grams = trigrams(text)
+        # Trigrams which any value containing every word must have
+        self.anchors = set()
+        for word in self.words:
+            if len(word) >= 3:
+                self.anchors.update(word[i:i + 3] for i in range(len(word) - 2))
+            else:
+                # Only the trigrams of the start of a word
+                self.anchors.update(gram for gram in word_trigrams(word) if not gram.endswith(' '))
+        self.lookup = self.grams | self.anchors
+        self.minimum = max(1, min(
+            len(self.anchors), int(math.ceil(self.threshold * len(self.grams)))))
+
+    def prefix(self, grams):
+        """
+        The fewest of the lookup trigrams, in the order given, such that every value
+        sharing the minimum number of trigrams has at least one of them.
+        """
+        return list(grams)[:len(self.lookup) - self.minimum + 1]
+
+    @property
+    def selective(self):
+        "The prefix of the trigrams inside words, which are usually the rarest, first."
+        return self.prefix(sorted(self.lookup, key=lambda gram: (gram.count(' '), gram)))
+
+    def __bool__(self):
+        return bool(self.words)
+
+    __nonzero__ = __bool__
+
+    def _contains(self, value_words):
+        for word in self.words:
+            if len(word) >= 3:
+                found = any(word in value_word for value_word in value_words)
+            else:
+                found = any(value_word.startswith(word) for value_word in value_words)
+            if not found:
+                return False
+        return True
+
+    def score(self, value):
+        "Relevance of a value to the query from 0 to 1 or None if it doesn't match."
+        if not self.words or value is None:
+            return None
+        value_words = words(value)
+        grams = set()
+        for word in value_words:
+            grams |= word_trigrams(word)
+        shared = len(self.grams & grams)
+        if self._contains(value_words):
+            containment = 1.0
+        else:
+            containment = shared / float(len(self.grams))
+            if containment < self.threshold:
+                return None
+        # Values with fewer trigrams besides those of the query rank higher
+        similarity = shared / float(len(self.grams | grams))
+        return (containment + similarity) / 2
+
+    def rank(self, records, fields, limit=None):
+        "The matching records, best first and then by id, using the best score of the fields."
+        scored = []
+        for record in records:
+            scores = [self.score(record.get(field)) for field in fields]
+            scores = [score for score in scores if score is not None]
+            if scores:
+                scored.append((-max(scores), record['id'], record))
+        scored.sort(key=lambda item: item[:2])
+        return [record for _, _, record in scored[:limit]]
@@ -0,0 +1,525 @@
+"""
+Storage backend which partitions patients and providers over several child backends.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import functools
+import heapq
+import itertools
+import numbers
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import importlib
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without futures
+    ThreadPoolExecutor = None
+
+from ..exceptions import InvalidCursor
+from .aggregates import COUNT, MIN, group_name, sort_value
+from .base import (HealthcareStorage, ResultSet, decode_cursor, encode_cursor, get_backend,
+    get_ordering)
+from .dummy import Descending
+from .search import LIMIT, SEARCH_FIELDS, SearchQuery
+
+
+class ShardKey(object):
+    "Chooses the shard of each new record."
+
+    def shard(self, category, record, count):
+        "Index of the shard, from 0 to count - 1, which stores the new record."
+        raise NotImplementedError("Define in subclass")
+
+
+class LocationShardKey(ShardKey):
+    """
+    Places records by their location. A location starting with one of the prefixes
+    of the HEALTHCARE_SHARD_LOCATIONS setting, a dictionary of location prefixes and
+    shard indexes, goes to the shard of the longest such prefix. Other locations are
+    spread over the shards by a hash of the location.
+    """
+
+    def __init__(self, prefixes=None):
+        if prefixes is None:
+            prefixes = getattr(settings, 'HEALTHCARE_SHARD_LOCATIONS', {})
+        self.prefixes = sorted(prefixes.items(), key=lambda item: -len(item[0]))
+
+    def shard(self, category, record, count):
+        location = record.get('location') or ''
+        for prefix, index in self.prefixes:
+            if location.startswith(prefix):
+                return index
+        return zlib.crc32(location.lower().encode('utf-8')) % count
+
+
+def get_shard_key(path):
+    "Return a ShardKey instance from the full Python path."
+    try:
+        mod_path, cls_name = path.rsplit('.', 1)
+        return getattr(importlib.import_module(mod_path), cls_name)()
+    except (AttributeError, ImportError, ValueError):
+        raise ImproperlyConfigured("Could not find shard key '%s'" % path)
+
+
+class ShardedStorage(HealthcareStorage):
+    """
+    Stores each record in one of the backends given by the HEALTHCARE_SHARDS setting,
+    chosen by the HEALTHCARE_SHARD_KEY when it's created. Record ids encode the index
+    of the shard, as ``id * max_shards + index``, so calls for an id go straight to its
+    shard. Other calls are made on every shard at once and their results merged. Those
+    run on worker threads, with their own database connections, so they are outside of
+    the calling thread's transaction: they don't see its uncommitted writes and their
+    writes are committed on their own.
+    """
+
+    # One instance, and so one pool of worker threads, is used by every client
+    shared = True
+    # Shards which can be addressed by the ids, which can't change once records exist
+    max_shards = 100
+    # Records read from each shard at a time when merging unlimited filters
+    chunk_size = 1000
+
+    def __init__(self):
+        paths = list(getattr(settings, 'HEALTHCARE_SHARDS', []))
+        if not paths:
+            raise ImproperlyConfigured("ShardedStorage requires HEALTHCARE_SHARDS.")
+        if len(paths) > self.max_shards:
+            raise ImproperlyConfigured("ShardedStorage supports at most %s shards." % self.max_shards)
+        self.shards = [get_backend(path) for path in paths]
+        self.key = get_shard_key(getattr(
+            settings, 'HEALTHCARE_SHARD_KEY', 'healthcare.backends.sharded.LocationShardKey'))
+        workers = getattr(settings, 'HEALTHCARE_SHARD_WORKERS', None) or len(self.shards)
+        self.executor = None
+        if workers > 1 and len(self.shards) > 1 and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(workers)
+
+    def encode_id(self, index, id):
+        "Id of a record with the given id in the shard with the given index."
+        return int(id) * self.max_shards + index
+
+    def decode_id(self, id):
+        "(shard index, id in the shard) for an id or None if it isn't valid."
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+        index = id % self.max_shards
+        if id < 0 or index >= len(self.shards):
+            return None
+        return index, id // self.max_shards
+
+    def _encode(self, index, record):
+        "Copy of a shard's record with the id of this storage."
+        if record is None:
+            return None
+        return dict(record, id=self.encode_id(index, record['id']))
+
+    def _map(self, function, indexes=None):
+        """
+        Call function(index, shard) for each of the shards, in parallel, and return the results
+        in order. Each call is wrapped by its shard's thread_call for the calling thread.
+        """
+        indexes = range(len(self.shards)) if indexes is None else list(indexes)
+        if self.executor is None or len(indexes) < 2:
+            return [function(index, self.shards[index]) for index in indexes]
+        futures = [
+            self.executor.submit(self.shards[index].thread_call(
+                functools.partial(function, index, self.shards[index])))
+            for index in indexes
+        ]
+        return [future.result() for future in futures]
+
+    def close(self):
+        "Stop the worker threads once the calls already made are done."
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _method(self, shard, name, category):
+        return getattr(shard, name.format(category))
+
+    def _get(self, category, id, fields=None):
+        decoded = self.decode_id(id)
+        if decoded is None:
+            return None
+        index, shard_id = decoded
+        return self._encode(index, self._method(self.shards[index], 'get_{0}', category)(shard_id, fields=fields))
+
+    def _get_many(self, category, ids):
+        grouped = {}
+        for id in ids:
+            decoded = self.decode_id(id)
+            if decoded is not None:
+                grouped.setdefault(decoded[0], {}).setdefault(decoded[1], []).append(id)
+
+        def fetch(index, shard):
+            return self._method(shard, 'get_many_{0}s', category)(list(grouped[index]))
+
+        result = {}
+        for index, records in zip(sorted(grouped), self._map(fetch, sorted(grouped))):
+            for shard_id, record in records.items():
+                if record:
+                    for id in grouped[index][shard_id]:
+                        result[id] = self._encode(index, record)
+        return result
+
+    def _create(self, category, data):
+        index = self.key.shard(category, data, len(self.shards))
+        return self._encode(index, self._method(self.shards[index], 'create_{0}', category)(data))
+
+    def _write(self, category, name, id, *args):
+        decoded = self.decode_id(id)
+        if decoded is None:
+            return False
+        index, shard_id = decoded
+        return self._method(self.shards[index], name, category)(shard_id, *args)
+
+    def _bulk_create(self, category, data):
+        data = list(data)
+        placed = {}
+        for position, item in enumerate(data):
+            placed.setdefault(self.key.shard(category, item, len(self.shards)), []).append(position)
+
+        def create(index, shard):
+            return self._method(shard, 'bulk_create_{0}s', category)([data[i] for i in placed[index]])
+
+        results = [None] * len(data)
+        for index, records in zip(sorted(placed), self._map(create, sorted(placed))):
+            for position, record in zip(placed[index], records):
+                results[position] = self._encode(index, record)
+        return results
+
+    def _bulk_write(self, category, name, items, updates=False):
+        "Pass the ids, or (id, data) pairs for updates, to the bulk method of their shards."
+        items = list(items)
+        placed = {}
+        for position, item in enumerate(items):
+            decoded = self.decode_id(item[0] if updates else item)
+            if decoded is not None:
+                index, shard_id = decoded
+                placed.setdefault(index, []).append(
+                    (position, (shard_id, item[1]) if updates else shard_id))
+
+        def write(index, shard):
+            return self._method(shard, name, category)([item for position, item in placed[index]])
+
+        results = [False] * len(items)
+        for index, outcomes in zip(sorted(placed), self._map(write, sorted(placed))):
+            for (position, item), outcome in zip(placed[index], outcomes):
+                results[position] = outcome
+        return results
+
+    def _sort_key(self, ordering, record):
+        return tuple(
+            Descending(sort_value(record.get(field))) if descending else sort_value(record.get(field))
+            for field, descending in ordering
+        )
+
+    def _filter(self, category, lookups, chunk_size=None,
+                order_by=None, limit=None, offset=None, after=None, fields=None):
+        """
+        Merge the records matching the lookups from each shard in order. The ids
+        encode the shard so ordering by them matches ordering by the id in each
+        shard and then the shard, which lets a cursor be turned into one per shard.
+        """
+        ordering = get_ordering(order_by)
+        # Fields after the unique id can't change the order
+        ordering = ordering[:[field for field, descending in ordering].index('id') + 1]
+        values = None
+        if after is not None:
+            values = decode_cursor(after)
+            if len(values) != len(ordering):
+                raise InvalidCursor("Invalid cursor: {0}".format(after))
+        options = {'order_by': ['-' + field if descending else field for field, descending in ordering]}
+        if fields is not None:
+            options['fields'] = fields
+        if chunk_size is not None:
+            options['chunk_size'] = chunk_size
+        count = None if limit is None else limit + (offset or 0)
+        if count is not None:
+            options['limit'] = count
+        size = min(count, chunk_size or self.chunk_size) if count is not None else chunk_size or self.chunk_size
+
+        def shard_after(index):
+            if values is None:
+                return None
+            decoded = self.decode_id(values[-1])
+            if decoded is None:
+                raise InvalidCursor("Invalid cursor: {0}".format(after))
+            last, shard_id = decoded
+            # Records of the shards after the last one can have the same id in the shard
+            descending = ordering[-1][1]
+            if not descending and index > last:
+                shard_id -= 1
+            elif descending and index < last:
+                shard_id += 1
+            return encode_cursor(values[:-1] + [shard_id])
+
+        def read(index, shard):
+            # The first records of every shard are fetched at the same time and in full
+            # so that no stream is left open on the worker thread
+            shard_options = dict(options, limit=size)
+            if values is not None:
+                shard_options['after'] = shard_after(index)
+            result = self._method(shard, 'filter_{0}s', category)(*lookups, **shard_options)
+            first = list(result)
+            return first, result.cursor if len(first) == size else None
+
+        def rest(index, cursor, fetched):
+            "Stream the records of a shard after its first ones from the calling thread."
+            if cursor is None or (count is not None and fetched >= count):
+                return
+            shard_options = dict(options, after=cursor)
+            if count is not None:
+                shard_options['limit'] = count - fetched
+            for record in self._method(self.shards[index], 'filter_{0}s', category)(*lookups, **shard_options):
+                yield record
+
+        def key(record):
+            return [record[field] for field, descending in ordering]
+
+        def keyed(index, records):
+            for record in records:
+                record = self._encode(index, record)
+                yield self._sort_key(ordering, record), record
+
+        def generate():
+            streams = [keyed(index, itertools.chain(first, rest(index, cursor, len(first))))
+                       for index, (first, cursor) in enumerate(self._map(read))]
+            merged = (record for sort_key, record in heapq.merge(*streams))
+            return itertools.islice(merged, offset or 0, count)
+
+        return ResultSet(generate, key=key)
+
+    def _count(self, category, lookups):
+        return sum(self._map(lambda index, shard: self._method(shard, 'count_{0}s', category)(*lookups)))
+
+    def _exists(self, category, lookups):
+        return any(self._map(lambda index, shard: self._method(shard, 'exists_{0}s', category)(*lookups)))
+
+    def _aggregate(self, category, lookups, group_by=None, aggregates=()):
+        "Combine the aggregates of each group from every shard."
+        group_by, aggregates = list(group_by or []), list(aggregates)
+        names = [group_name(group) for group in group_by]
+
+        def aggregate(index, shard):
+            return self._method(shard, 'aggregate_{0}s', category)(
+                *lookups, group_by=group_by, aggregates=aggregates)
+
+        groups = {}
+        for results in self._map(aggregate):
+            for result in results:
+                key = tuple(result[name] for name in names)
+                combined = groups.get(key)
+                if combined is None:
+                    groups[key] = dict(result)
+                    continue
+                for name, function, field in aggregates:
+                    value, other = combined[name], result[name]
+                    if function == COUNT:
+                        combined[name] = value + other
+                    elif value is None or other is None:
+                        combined[name] = other if value is None else value
+                    elif function == MIN:
+                        combined[name] = min(value, other)
+                    else:
+                        combined[name] = max(value, other)
+        return [groups[key] for key in sorted(groups, key=lambda key: tuple(sort_value(value) for value in key))]
+
+    def _search(self, category, query, fields=None, limit=None, threshold=None):
+        "Rank the best matches of every shard together."
+        def search(index, shard):
+            records = self._method(shard, 'search_{0}s', category)(
+                query, fields=fields, limit=limit, threshold=threshold)
+            return [self._encode(index, record) for record in records]
+
+        search_query = SearchQuery(query, threshold)
+        if not search_query:
+            return []
+        records = itertools.chain.from_iterable(self._map(search))
+        return search_query.rank(records, fields or SEARCH_FIELDS[category], limit or LIMIT)
+
+    def get_patient(self, id, source=None, fields=None):
+        "Retrieve a patient record by ID from its shard or by source ID from any shard."
+        if source:
+            def get(index, shard):
+                return self._encode(index, shard.get_patient(id, source=source, fields=fields))
+
+            for record in self._map(get):
+                if record is not None:
+                    return record
+            return None
+        return self._get('patient', id, fields)
+
+    def get_many_patients(self, ids):
+        "Retrieve patient records for a list of IDs from each of their shards."
+        return self._get_many('patient', ids)
+
+    def get_many_patients_by_source(self, pairs):
+        "Retrieve patient records for a list of (source_id, source_name) pairs from every shard."
+        pairs = list(pairs)
+        result = {}
+        for index, records in enumerate(self._map(lambda index, shard: shard.get_many_patients_by_source(pairs))):
+            for pair, record in records.items():
+                if record and pair not in result:
+                    result[pair] = self._encode(index, record)
+        return result
+
+    def create_patient(self, data):
+        "Create a patient record in the shard chosen by the shard key."
+        return self._create('patient', data)
+
+    def update_patient(self, id, data):
+        "Update a patient record by ID."
+        return self._write('patient', 'update_{0}', id, data)
+
+    def delete_patient(self, id):
+        "Delete a patient record by ID."
+        return self._write('patient', 'delete_{0}', id)
+
+    def bulk_create_patients(self, data):
+        "Create patient records from a list of dictionaries in each of their shards."
+        return self._bulk_create('patient', data)
+
+    def bulk_update_patients(self, updates):
+        "Update patient records from a list of (id, data) pairs."
+        return self._bulk_write('patient', 'bulk_update_{0}s', updates, updates=True)
+
+    def bulk_delete_patients(self, ids):
+        "Delete patient records from a list of IDs."
+        return self._bulk_write('patient', 'bulk_delete_{0}s', ids)
+
+    def filter_patients(self, *lookups, **options):
+        "Find patient records matching the given lookups in every shard."
+        return self._filter('patient', lookups, **options)
+
+    def count_patients(self, *lookups):
+        "Count the patient records matching the given lookups."
+        return self._count('patient', lookups)
+
+    def exists_patients(self, *lookups):
+        "Check whether any patient records match the given lookups."
+        return self._exists('patient', lookups)
+
+    def aggregate_patients(self, *lookups, **options):
+        "Aggregate the patient records matching the given lookups."
+        return self._aggregate('patient', lookups, **options)
+
+    def search_patients(self, query, fields=None, limit=None, threshold=None):
+        "Find the patient records matching the search query in every shard."
+        return self._search('patient', query, fields, limit, threshold)
+
+    def find_duplicate_patients(self, record, limit=None, threshold=None):
+        "Find the patients which may be duplicates of a record in every shard."
+        if not isinstance(record, dict):
+            record = self.get_patient(record)
+            if record is None:
+                return []
+        record = dict(record)
+        own = record.pop('id', None)
+
+        def find(index, shard):
+            # The record itself may be one of the results
+            count = None if limit is None else limit + 1
+            return [(self._encode(index, patient), score)
+                    for patient, score in shard.find_duplicate_patients(record, limit=count, threshold=threshold)]
+
+        results = [(patient, score) for patient, score in itertools.chain.from_iterable(self._map(find))
+                   if own is None or patient['id'] != own]
+        results.sort(key=lambda item: (-item[1], item[0]['id']))
+        return results[:limit]
+
+    def link_patient(self, id, source_id, source_name):
+        "Associated a source/id pair with this patient in its shard."
+        return self._write('patient', 'link_{0}', id, source_id, source_name)
+
+    def unlink_patient(self, id, source_id, source_name):
+        "Remove association of a source/id pair with this patient in its shard."
+        return self._write('patient', 'unlink_{0}', id, source_id, source_name)
+
+    def get_provider(self, id, fields=None):
+        "Retrieve a provider record by ID from its shard."
+        return self._get('provider', id, fields)
+
+    def get_many_providers(self, ids):
+        "Retrieve provider records for a list of IDs from each of their shards."
+        return self._get_many('provider', ids)
+
+    def create_provider(self, data):
+        "Create a provider record in the shard chosen by the shard key."
+        return self._create('provider', data)
+
+    def update_provider(self, id, data):
+        "Update a provider record by ID."
+        return self._write('provider', 'update_{0}', id, data)
+
+    def delete_provider(self, id):
+        "Delete a provider record by ID."
+        return self._write('provider', 'delete_{0}', id)
+
+    def bulk_create_providers(self, data):
+        "Create provider records from a list of dictionaries in each of their shards."
+        return self._bulk_create('provider', data)
+
+    def bulk_update_providers(self, updates):
+        "Update provider records from a list of (id, data) pairs."
+        return self._bulk_write('provider', 'bulk_update_{0}s', updates, updates=True)
+
+    def bulk_delete_providers(self, ids):
+        "Delete provider records from a list of IDs."
+        return self._bulk_write('provider', 'bulk_delete_{0}s', ids)
+
+    def filter_providers(self, *lookups, **options):
+        "Find provider records matching the given lookups in every shard."
+        return self._filter('provider', lookups, **options)
+
+    def count_providers(self, *lookups):
+        "Count the provider records matching the given lookups."
+        return self._count('provider', lookups)
+
+    def exists_providers(self, *lookups):
+        "Check whether any provider records match the given lookups."
+        return self._exists('provider', lookups)
+
+    def aggregate_providers(self, *lookups, **options):
+        "Aggregate the provider records matching the given lookups."
+        return self._aggregate('provider', lookups, **options)
+
+    def search_providers(self, query, fields=None, limit=None, threshold=None):
+        "Find the provider records matching the search query in every shard."
+        return self._search('provider', query, fields, limit, threshold)
+
+    def _dated(self, index, changes):
+        for change in changes:
+            yield change['date'], index, change['sequence'], change
+
+    def get_changes(self, after=None, limit=None, chunk_size=None):
+        """
+        Merge the change feeds of the shards by date. The cursor holds the sequence
+        of the last change seen from each shard.
+        """
+        positions = [0] * len(self.shards)
+        if after is not None:
+            values = decode_cursor(after)
+            if len(values) != len(self.shards) or not all(isinstance(value, numbers.Integral) for value in values):
+                raise InvalidCursor("Invalid cursor: {0}".format(after))
+            positions = values
+        current = list(positions)
+
+        def read(index, shard):
+            start = encode_cursor([positions[index]]) if positions[index] else None
+            return shard.get_changes(after=start, limit=limit, chunk_size=chunk_size)
+
+        def generate():
+            current[:] = positions
+            # The feeds are streamed from the calling thread as they are merged
+            streams = [self._dated(index, read(index, shard)) for index, shard in enumerate(self.shards)]
+            merged = itertools.islice(heapq.merge(*streams), limit)
+            for date, index, sequence, change in merged:
+                current[index] = change['sequence']
+                yield dict(change, id=self.encode_id(index, change['id']),
+                           sequence=self.encode_id(index, change['sequence']))
+
+        return ResultSet(generate, key=lambda change: list(current))
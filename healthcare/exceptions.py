@@ -14,4 +14,8 @@ class PatientDoesNotExist(APIError):
 
 
 class ProviderDoesNotExist(APIError):
-    "Provider record does not exist exception."
\ No newline at end of file
+    "Provider record does not exist exception."
+
+
+class InvalidCursor(APIError):
+    "Pagination cursor could not be decoded."
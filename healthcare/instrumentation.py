@@ -0,0 +1,253 @@
+"""
+Instrumentation of the backend calls made by the API client. Each call is timed and
+described by a Call which is passed to the configured sinks.
+"""
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import importlib
+
+from .backends.base import ResultSet
+from .signals import backend_call
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+logger = logging.getLogger(__name__)
+
+
+def row_count(name, result):
+    "Number of records returned or changed by the backend method."
+    if result is None:
+        return 0
+    if name.startswith(('count_', 'exists_')):
+        return None
+    if name.startswith(('get_many_', 'bulk_', 'aggregate_', 'search_', 'find_duplicate_', 'dedupe_')):
+        records = result.values() if isinstance(result, dict) else result
+        return len([record for record in records if record])
+    return int(bool(result))
+
+
+class Call(object):
+    "Description of one backend call."
+
+    __slots__ = ('backend', 'category', 'method', 'duration', 'rows', 'error', 'hits', 'misses')
+
+    def __init__(self, backend, category, method):
+        self.backend, self.category, self.method = backend, category, method
+        self.duration = 0.0
+        self.rows = self.error = self.hits = self.misses = None
+
+    @property
+    def name(self):
+        return '{0}.{1}'.format(type(self.backend).__name__, self.method)
+
+
+class Instrumentation(object):
+    """
+    Times backend calls and passes a Call for each to the sinks. The records of a
+    filter are returned as an InstrumentedResultSet which sends its Call.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def wrap(self, backend, category, name, method=None):
+        """
+        Return the backend method, or the method given for it, which records a Call
+        each time it's called.
+        """
+        method = method or getattr(backend, name)
+        thread_stats = getattr(backend, 'thread_stats', None)
+
+        def instrumented(*args, **kwargs):
+            call = Call(backend, category, name)
+            before = thread_stats() if thread_stats is not None else None
+            start = timer()
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                call.duration, call.error = timer() - start, e
+                self.emit(call)
+                raise
+            call.duration = timer() - start
+            if before is not None:
+                hits, misses = thread_stats()
+                call.hits, call.misses = hits - before[0], misses - before[1]
+            if isinstance(result, ResultSet):
+                result = InstrumentedResultSet(result, call, self)
+            elif hasattr(result, 'add_done_callback'):
+                # Futures of an asynchronous backend are timed until they are done
+                result.add_done_callback(lambda future: self._done(call, start, future))
+            else:
+                call.rows = row_count(name, result)
+                self.emit(call)
+            return result
+
+        return instrumented
+
+    def _done(self, call, start, future):
+        call.duration = timer() - start
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            call.error = future.exception()
+        else:
+            result = future.result()
+            if isinstance(result, ResultSet):
+                result = list(result)
+            call.rows = row_count(call.method, result)
+        self.emit(call)
+
+    def emit(self, call):
+        "Pass the Call to each sink. A failing sink doesn't affect the backend call."
+        for sink in self.sinks:
+            try:
+                sink.emit(call)
+            except Exception:
+                logger.exception("Instrumentation sink %r failed", sink)
+
+
+class InstrumentedResultSet(ResultSet):
+    """
+    Records of an instrumented filter. They are counted as they are streamed and the
+    Call, whose duration only includes the time spent fetching them, is sent once when
+    the first iteration finishes or is closed.
+    """
+
+    def __init__(self, result, call, instrumentation):
+        super(InstrumentedResultSet, self).__init__(self._counted, key=result.key)
+        self.result, self.call, self.instrumentation = result, call, instrumentation
+        self.sent = False
+
+    def _counted(self):
+        if self.sent:
+            # Only the first iteration is reported
+            for record in self.result:
+                yield record
+            return
+        records, rows = iter(self.result), 0
+        try:
+            while True:
+                start = timer()
+                try:
+                    record = next(records)
+                except StopIteration:
+                    break
+                finally:
+                    self.call.duration += timer() - start
+                rows += 1
+                yield record
+        except Exception as e:
+            self.call.error = e
+            raise
+        finally:
+            records.close()
+            self.call.rows = rows
+            self.send()
+
+    def send(self):
+        "Pass the Call to the sinks unless it has already been sent."
+        if not self.sent:
+            self.sent = True
+            self.instrumentation.emit(self.call)
+
+    def close(self):
+        "Stop streaming the records and send the Call of those fetched so far."
+        super(InstrumentedResultSet, self).close()
+        if not self.sent:
+            # Closed before any records were fetched
+            self.call.rows = 0
+            self.send()
+
+
+class Sink(object):
+    "Receives a Call for each instrumented backend call."
+
+    def emit(self, call):
+        raise NotImplementedError("Define in subclass")
+
+
+class SignalSink(Sink):
+    "Sends the healthcare.signals.backend_call signal for each call."
+
+    def emit(self, call):
+        backend_call.send(sender=type(call.backend), call=call)
+
+
+class LoggingSink(Sink):
+    "Logs each call to the healthcare.instrumentation logger, or the one given."
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def emit(self, call):
+        level = logging.WARNING if call.error is not None else self.level
+        if not self.logger.isEnabledFor(level):
+            return
+        self.logger.log(
+            level, "%s took %.2fms rows=%s hits=%s misses=%s error=%r", call.name,
+            call.duration * 1000, call.rows, call.hits, call.misses, call.error)
+
+
+class MemoryStatsClient(object):
+    "StatsD style client which keeps the counters and timings in memory."
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, stat, count=1):
+        self.counters[stat] = self.counters.get(stat, 0) + count
+
+    def timing(self, stat, delta):
+        self.timings.setdefault(stat, []).append(delta)
+
+    def reset(self):
+        self.counters.clear()
+        self.timings.clear()
+
+
+class StatsSink(Sink):
+    """
+    Sends the timing, row, cache and error counts of each call to a StatsD style
+    client with ``incr(stat, count)`` and ``timing(stat, milliseconds)`` methods.
+    A MemoryStatsClient is used when no client is given.
+    """
+
+    def __init__(self, client=None, prefix='healthcare'):
+        self.client = client if client is not None else MemoryStatsClient()
+        self.prefix = prefix
+
+    def emit(self, call):
+        stat = '{0}.{1}'.format(self.prefix, call.method)
+        self.client.timing(stat, call.duration * 1000)
+        self.client.incr('{0}.calls'.format(stat))
+        for name, count in (('rows', call.rows), ('hits', call.hits), ('misses', call.misses)):
+            if count:
+                self.client.incr('{0}.{1}'.format(stat, name), count)
+        if call.error is not None:
+            self.client.incr('{0}.errors'.format(stat))
+
+
+def get_instrumentation(sinks):
+    """
+    Return Instrumentation for a list of sinks or their full Python paths, or None
+    when there are no sinks.
+    """
+    if not sinks:
+        return None
+    instances = []
+    for sink in sinks:
+        if not hasattr(sink, 'emit'):
+            try:
+                mod_path, cls_name = sink.rsplit('.', 1)
+                sink = getattr(importlib.import_module(mod_path), cls_name)()
+            except (AttributeError, ImportError, ValueError):
+                raise ImproperlyConfigured("Could not find instrumentation sink '%s'" % sink)
+        instances.append(sink)
+    return Instrumentation(instances)
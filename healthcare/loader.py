@@ -0,0 +1,152 @@
+"""
+Loaders which combine many single record gets into a few batched backend calls.
+"""
+from __future__ import unicode_literals
+
+from .backends.asynchronous import completed, get_asyncio, settle
+from .backends.base import get_fields, project
+
+
+def split_keys(keys):
+    "Separate (id, source) keys into the plain ids and the (source_id, source_name) pairs."
+    ids = [id for id, source in keys if not source]
+    pairs = [(id, source) for id, source in keys if source]
+    return ids, pairs
+
+
+def by_key(ids, pairs):
+    "Map the get_many results for ids and the get_many_by_source results for pairs to keys."
+    found = dict(((id, None), record) for id, record in ids.items())
+    found.update(pairs)
+    return found
+
+
+class Pending(object):
+    "A record requested from a loader which is fetched along with the rest of its batch."
+
+    def __init__(self, loader, key, fields=None):
+        self.loader, self.key, self.fields = loader, key, fields
+
+    def result(self):
+        """
+        Return the record, dispatching the queued gets first if needed. Raises the
+        same DoesNotExist exception as get if the record was not found.
+        """
+        return self.loader.result(self.key, self.fields)
+
+
+class CategoryLoader(object):
+    "Queues the gets for a category until they are dispatched as one batch."
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self._queue = []
+        self._results = {}
+
+    def _record(self, key, record, fields=None):
+        "Copy of the found record for one caller or the wrapper's DoesNotExist error."
+        id, source = key
+        record = self.wrapper._found(record, *((id, source) if source else (id, )))
+        return project(record, get_fields(fields)) if fields is not None else dict(record)
+
+    def _fetch(self, keys):
+        "Fetch the records for the keys with one backend call for ids and one for pairs."
+        ids, pairs = split_keys(keys)
+        return (
+            self.wrapper.get_many(ids) if ids else {},
+            self.wrapper.get_many_by_source(pairs) if pairs else {},
+        )
+
+    def get(self, id, source=None, fields=None):
+        "Queue a get and return a Pending for its record."
+        key = (id, source or None)
+        if key not in self._results:
+            self._queue.append(key)
+        return Pending(self, key, fields)
+
+    def dispatch(self):
+        "Fetch all of the queued records."
+        keys = list(set(self._queue))
+        if keys:
+            found = by_key(*self._fetch(keys))
+            for key in keys:
+                self._results[key] = found.get(key)
+        # Cleared once fetched so the gets of a failed fetch are tried again
+        self._queue = []
+
+    def result(self, key, fields=None):
+        if key not in self._results:
+            self.dispatch()
+        return self._record(key, self._results[key], fields)
+
+
+class DataLoader(object):
+    """
+    Collects the patient and provider gets made through it so that they are fetched
+    with a few backend calls. Each get returns a Pending whose result is available
+    once the loader is dispatched, which happens when a result is first read or the
+    with block ends.
+    """
+
+    def __init__(self, client):
+        self.patients = CategoryLoader(client.patients)
+        self.providers = CategoryLoader(client.providers)
+
+    def dispatch(self):
+        "Fetch all of the queued records."
+        self.patients.dispatch()
+        self.providers.dispatch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.dispatch()
+
+
+class AsyncCategoryLoader(CategoryLoader):
+    """
+    Collects the gets for a category made during one iteration of the event loop and
+    fetches them as one batch. Each get returns a future for its record.
+    """
+
+    def __init__(self, wrapper):
+        super(AsyncCategoryLoader, self).__init__(wrapper)
+        self._waiting = {}
+
+    def get(self, id, source=None, fields=None):
+        loop = self.wrapper.backend.get_loop()
+        future = get_asyncio().Future(loop=loop)
+        if not self._waiting:
+            loop.call_soon(self.dispatch)
+        self._waiting.setdefault((id, source or None), []).append((future, fields))
+        return future
+
+    def dispatch(self):
+        waiting, self._waiting = self._waiting, {}
+        if not waiting:
+            return
+        loop = self.wrapper.backend.get_loop()
+        fetched = [
+            completed(result, loop) if isinstance(result, dict) else result
+            for result in self._fetch(list(waiting))
+        ]
+        settle(fetched, loop).add_done_callback(
+            lambda future: self._resolve(future.result(), waiting))
+
+    def _resolve(self, outcomes, waiting):
+        "Pass each waiting caller its record or the error from fetching the batch."
+        errors = [error for result, error in outcomes if error is not None]
+        found = by_key(*[result for result, error in outcomes]) if not errors else {}
+        for key, callers in waiting.items():
+            for future, fields in callers:
+                if future.done():
+                    continue
+                if errors:
+                    future.set_exception(errors[0])
+                    continue
+                try:
+                    future.set_result(self._record(key, found.get(key), fields))
+                except Exception as e:
+                    future.set_exception(e)
@@ -0,0 +1,45 @@
+"Shared options and helpers of the export and import commands."
+from __future__ import unicode_literals
+
+import sys
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ...api import HealthcareAPI, get_storage_backend
+from ...transfer import get_format
+
+
+class TransferCommand(BaseCommand):
+    args = '<patients|providers> <file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format',
+            help='File format: ndjson, csv or columnar. Defaults to the format of the file extension.'),
+        make_option('--backend', dest='backend',
+            help='Full Python path of the storage backend. Defaults to HEALTHCARE_STORAGE_BACKEND.'),
+    )
+
+    def parse(self, args, options):
+        "Return the client category, file path and format for the command arguments."
+        if len(args) != 2:
+            raise CommandError("Expected a category and a file: {0}".format(self.args))
+        category, path = args
+        if category not in ('patients', 'providers'):
+            raise CommandError("Unknown category '{0}', use patients or providers".format(category))
+        if path == '-' and not options.get('format'):
+            raise CommandError("The --format is required when using standard input or output")
+        try:
+            format = get_format(options.get('format'), path)
+        except ImproperlyConfigured as e:
+            raise CommandError('{0}'.format(e))
+        client = HealthcareAPI(options.get('backend') or get_storage_backend())
+        return getattr(client, category), path, format
+
+    def open(self, path, mode):
+        "Open the file, or standard input or output for '-', in binary mode."
+        if path == '-':
+            stream = sys.stdin if 'r' in mode else sys.stdout
+            return getattr(stream, 'buffer', stream), False
+        return open(path, mode), True
@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+
+import time
+from optparse import make_option
+
+from ...transfer import export_records
+from ._transfer import TransferCommand
+
+
+class Command(TransferCommand):
+    help = "Export the patient or provider records of a storage backend to a file, or '-' for standard output."
+
+    option_list = TransferCommand.option_list + (
+        make_option('--fields', dest='fields', help='Comma separated names of the fields to export.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            help='Number of records fetched from the backend at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        wrapper, path, format = self.parse(args, options)
+        fields = options.get('fields')
+        fields = [name.strip() for name in fields.split(',')] if fields else None
+        stream, close = self.open(path, 'wb')
+        start = time.time()
+        try:
+            count = export_records(
+                wrapper, stream, format, fields=fields, chunk_size=options.get('chunk_size'))
+        finally:
+            if close:
+                stream.close()
+        seconds = time.time() - start
+        if int(options.get('verbosity', 1)) > 0:
+            self.stderr.write("Exported {0} {1} in {2:.2f}s ({3:.0f} rows/s)\n".format(
+                count, wrapper.category + 's', seconds, count / seconds if seconds else 0))
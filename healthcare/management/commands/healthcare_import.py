@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from ...transfer import import_records
+from ._transfer import TransferCommand
+
+
+class Command(TransferCommand):
+    help = "Import patient or provider records from a file, or '-' for standard input, into a storage backend."
+
+    option_list = TransferCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            help='Number of records passed to the backend in each bulk create.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Number of threads creating batches at the same time.'),
+    )
+
+    def handle(self, *args, **options):
+        wrapper, path, format = self.parse(args, options)
+        stream, close = self.open(path, 'rb')
+        try:
+            result = import_records(wrapper, stream, format,
+                batch_size=options.get('batch_size'), workers=options.get('workers') or 1)
+        finally:
+            if close:
+                stream.close()
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity > 0:
+            self.stderr.write("Imported {0} of {1} {2} in {3:.2f}s ({4:.0f} rows/s)\n".format(
+                result.created, result.rows, wrapper.category + 's', result.seconds, result.rate))
+        if verbosity > 1:
+            for position in sorted(result.errors):
+                self.stderr.write("Record {0}: {1}\n".format(position + 1, result.errors[position]))
@@ -0,0 +1,8 @@
+"Signals sent by the healthcare API client."
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+
+# Sent after each instrumented backend call with the Call describing it
+backend_call = Signal(providing_args=['call'])
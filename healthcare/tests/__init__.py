@@ -1,3 +1,9 @@
-from .backends.test_django import DjangoBackendTestCase
+from .backends.test_caching import CachingBackendTestCase, LRUCacheTestCase
+from .backends.test_django import (DjangoBackendTestCase, DjangoRoutingTestCase, DjangoTrigramTestCase,
+    SerializerBenchmarkTestCase)
 from .backends.test_dummy import DummyBackendTestCase
-from .test_api import APIClientTestCase
\ No newline at end of file
+from .backends.test_sharded import ShardedBackendTestCase, ShardedDatabaseTestCase, ShardedWorkersTestCase
+from .test_api import APIClientTestCase, CoalescingTestCase, DataLoaderTestCase, DefaultClientTestCase
+from .test_async import AsyncAPIClientTestCase
+from .test_instrumentation import InstrumentationTestCase
+from .test_transfer import TransferCommandTestCase, TransferTestCase
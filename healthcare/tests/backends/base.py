@@ -1,8 +1,13 @@
 import datetime
 import operator
 
-from ...backends import comparisons
-from ...backends.base import get_backend
+from django.test.utils import override_settings
+
+from ...backends import aggregates, changes, comparisons
+from ...backends.aggregates import AgeBands
+from ...backends.base import clear_backends, get_backend
+from ...backends.expressions import And, Not, Or
+from ...exceptions import InvalidCursor
 
 
 class BackendTestMixin(object):
@@ -11,6 +16,8 @@ class BackendTestMixin(object):
     backend = None
 
     def setUp(self):
+        # Tests change the backend so shared backends are created again for each
+        clear_backends()
         self.backend = get_backend(self.backend)
 
     def test_create_patient(self):
@@ -37,6 +44,37 @@ class BackendTestMixin(object):
         self.assertEqual(patient['name'], 'Jane')
         self.assertTrue(patient['updated_date'] > updated)
 
+    def test_get_patient_fields(self):
+        "Retrieve only some fields of a patient."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'location': 'Durham'})
+        self.backend.link_patient(patient['id'], 'FOO', 'BAR')
+        expected = {'id': patient['id'], 'name': 'Joe'}
+        self.assertEqual(expected, self.backend.get_patient(patient['id'], fields=['name']))
+        self.assertEqual(expected, self.backend.get_patient('FOO', source='BAR', fields=['name', 'xxx']))
+        self.assertEqual(None, self.backend.get_patient('XXX', fields=['name']))
+
+    def test_get_many_patients(self):
+        "Retrieve several patients at once."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        other_patient = self.backend.create_patient({'name': 'Jane', 'sex': 'F'})
+        result = self.backend.get_many_patients([patient['id'], 'XXX', other_patient['id']])
+        self.assertEqual({patient['id']: patient, other_patient['id']: other_patient}, result)
+        self.assertEqual({}, self.backend.get_many_patients([]))
+
+    def test_get_many_patients_by_source(self):
+        "Retrieve several patients at once by source id/name pairs."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        other_patient = self.backend.create_patient({'name': 'Jane', 'sex': 'F'})
+        self.backend.link_patient(patient['id'], 'FOO', 'BAR')
+        self.backend.link_patient(other_patient['id'], 'FOO', 'BAZ')
+        self.backend.link_patient(other_patient['id'], 'ABC', 'BAR')
+        result = self.backend.get_many_patients_by_source(
+            [('FOO', 'BAR'), ('FOO', 'BAZ'), ('ABC', 'BAR'), ('XXX', 'BAR'), ('ABC', 'BAZ')])
+        self.assertEqual(3, len(result))
+        self.assertEqual(patient['id'], result[('FOO', 'BAR')]['id'])
+        self.assertEqual(other_patient['id'], result[('FOO', 'BAZ')]['id'])
+        self.assertEqual(other_patient['id'], result[('ABC', 'BAR')]['id'])
+
     def test_get_missing_patient(self):
         "Backend should return None if the patient was not found."
         fetched = self.backend.get_patient('XXX')
@@ -60,6 +98,40 @@ class BackendTestMixin(object):
         result = self.backend.delete_patient('XXX')
         self.assertFalse(result)
 
+    def test_bulk_create_patients(self):
+        "Store a batch of new patients."
+        result = self.backend.bulk_create_patients([
+            {'name': 'Joe', 'sex': 'M'},
+            {'name': 'Jane', 'sex': 'F'},
+        ])
+        self.assertEqual(['Joe', 'Jane'], [p['name'] for p in result])
+        for patient in result:
+            self.assertTrue(patient['id'])
+            self.assertEqual(patient['created_date'].date(), datetime.date.today())
+            self.assertEqual(patient, self.backend.get_patient(patient['id']))
+
+    def test_bulk_update_patients(self):
+        "Update a batch of patients with a missing patient in the middle."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        other_patient = self.backend.create_patient({'name': 'Jane', 'sex': 'F'})
+        result = self.backend.bulk_update_patients([
+            (patient['id'], {'location': 'Durham'}),
+            ('XXX', {'location': 'Durham'}),
+            (other_patient['id'], {'name': 'Janet'}),
+        ])
+        self.assertEqual([True, False, True], result)
+        self.assertEqual('Durham', self.backend.get_patient(patient['id'])['location'])
+        self.assertEqual('Janet', self.backend.get_patient(other_patient['id'])['name'])
+
+    def test_bulk_delete_patients(self):
+        "Delete a batch of patients with a missing patient in the middle."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        other_patient = self.backend.create_patient({'name': 'Jane', 'sex': 'F'})
+        result = self.backend.bulk_delete_patients([patient['id'], 'XXX', other_patient['id']])
+        self.assertEqual([True, False, True], result)
+        self.assertEqual(None, self.backend.get_patient(patient['id']))
+        self.assertEqual(None, self.backend.get_patient(other_patient['id']))
+
     def test_create_provider(self):
         "Store a new provider."
         provider = self.backend.create_provider({'name': 'Joe'})
@@ -84,6 +156,18 @@ class BackendTestMixin(object):
         self.assertEqual(provider['name'], 'Jane')
         self.assertTrue(provider['updated_date'] > updated)
 
+    def test_get_provider_fields(self):
+        "Retrieve only some fields of a provider."
+        provider = self.backend.create_provider({'name': 'Joe', 'location': 'Durham'})
+        fetched = self.backend.get_provider(provider['id'], fields=['location'])
+        self.assertEqual({'id': provider['id'], 'location': 'Durham'}, fetched)
+
+    def test_get_many_providers(self):
+        "Retrieve several providers at once."
+        provider = self.backend.create_provider({'name': 'Joe'})
+        result = self.backend.get_many_providers([provider['id'], 'XXX'])
+        self.assertEqual({provider['id']: provider}, result)
+
     def test_get_missing_provider(self):
         "Backend should return None if the provider was not found."
         fetched = self.backend.get_provider('XXX')
@@ -107,6 +191,28 @@ class BackendTestMixin(object):
         result = self.backend.delete_provider('XXX')
         self.assertFalse(result)
 
+    def test_bulk_create_providers(self):
+        "Store a batch of new providers."
+        result = self.backend.bulk_create_providers([{'name': 'Joe'}, {'name': 'Jane'}])
+        self.assertEqual(['Joe', 'Jane'], [p['name'] for p in result])
+        for provider in result:
+            self.assertEqual(provider, self.backend.get_provider(provider['id']))
+
+    def test_bulk_update_providers(self):
+        "Update a batch of providers."
+        provider = self.backend.create_provider({'name': 'Joe'})
+        result = self.backend.bulk_update_providers([
+            (provider['id'], {'name': 'Jack'}), ('XXX', {'name': 'Jack'})])
+        self.assertEqual([True, False], result)
+        self.assertEqual('Jack', self.backend.get_provider(provider['id'])['name'])
+
+    def test_bulk_delete_providers(self):
+        "Delete a batch of providers."
+        provider = self.backend.create_provider({'name': 'Joe'})
+        result = self.backend.bulk_delete_providers([provider['id'], 'XXX'])
+        self.assertEqual([True, False], result)
+        self.assertEqual(None, self.backend.get_provider(provider['id']))
+
     def test_all_patients(self):
         "Get all patients with no filtering."
         patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
@@ -150,6 +256,97 @@ class BackendTestMixin(object):
             result = self.backend.filter_patients(('birth_date', op, val))
             self.assertItemsEqual(expected, result)
 
+    def test_order_patients(self):
+        "Order patients by one or more fields."
+        joe = self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'location': 'B'})
+        jane = self.backend.create_patient({'name': 'Jane', 'sex': 'F', 'location': 'A'})
+        jack = self.backend.create_patient({'name': 'Jack', 'sex': 'M', 'location': 'A'})
+        tests = (
+            # Ordering, Expected
+            ('name', [jack, jane, joe]),
+            ('-name', [joe, jane, jack]),
+            (['location', 'name'], [jack, jane, joe]),
+            (['-sex', '-name'], [joe, jack, jane]),
+        )
+        for order_by, expected in tests:
+            result = self.backend.filter_patients(order_by=order_by)
+            self.assertEqual(expected, list(result))
+
+    def test_limit_offset_patients(self):
+        "Select a slice of the ordered patients."
+        patients = [self.backend.create_patient({'name': name}) for name in ('A', 'B', 'C', 'D')]
+        result = self.backend.filter_patients(order_by='name', limit=2)
+        self.assertEqual(patients[:2], list(result))
+        result = self.backend.filter_patients(order_by='name', limit=2, offset=1, chunk_size=1)
+        self.assertEqual(patients[1:3], list(result))
+        result = self.backend.filter_patients(('name', comparisons.GT, 'A'), order_by='-name', offset=2)
+        self.assertEqual([patients[1]], list(result))
+
+    def test_filter_fields(self):
+        "Filter results should include only the requested, id and ordering fields."
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'location': 'Durham'})
+        self.backend.create_patient({'name': 'Jane', 'sex': 'F', 'location': 'Durham'})
+        page = self.backend.filter_patients(
+            ('location', comparisons.EQUAL, 'Durham'), fields=['name'], order_by='-sex', limit=1)
+        records = list(page)
+        self.assertEqual(1, len(records))
+        self.assertEqual(set(['id', 'name', 'sex']), set(records[0]))
+        self.assertEqual('Joe', records[0]['name'])
+        rest = self.backend.filter_patients(fields='name', order_by='-sex', after=page.cursor)
+        self.assertEqual(['Jane'], [record['name'] for record in rest])
+
+    def test_paginate_patients(self):
+        "Page through the patients with cursors."
+        today = datetime.date.today()
+        for i in range(5):
+            self.backend.create_patient({'name': 'Joe', 'birth_date': today - datetime.timedelta(days=i % 2)})
+        expected = list(self.backend.filter_patients(order_by=['birth_date', '-id']))
+        pages, after = [], None
+        while True:
+            page = self.backend.filter_patients(order_by=['birth_date', '-id'], limit=2, after=after)
+            records = list(page)
+            if not records:
+                break
+            pages.extend(records)
+            after = page.cursor
+        self.assertEqual(expected, pages)
+
+    def test_invalid_cursor(self):
+        "Passing a cursor which can't be decoded is an error."
+        self.assertRaises(InvalidCursor, lambda: list(self.backend.filter_patients(after='XXX')))
+
+    def test_count_patients(self):
+        "Count the patients matching lookups."
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'location': 'Durham'})
+        self.backend.create_patient({'name': 'Jane', 'sex': 'F', 'location': 'Durham'})
+        self.backend.create_patient({'name': 'Jack', 'sex': 'M', 'location': 'Raleigh'})
+        self.assertEqual(3, self.backend.count_patients())
+        self.assertEqual(2, self.backend.count_patients(('location', comparisons.EQUAL, 'Durham')))
+        self.assertEqual(1, self.backend.count_patients(
+            ('location', comparisons.EQUAL, 'Durham'), ('sex', comparisons.EQUAL, 'M')))
+        self.assertEqual(0, self.backend.count_patients(('name', comparisons.EQUAL, 'Jill')))
+
+    def test_patients_exist(self):
+        "Check whether any patients match lookups."
+        self.assertFalse(self.backend.exists_patients())
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.assertTrue(self.backend.exists_patients())
+        self.assertTrue(self.backend.exists_patients(('name', comparisons.LIKE, 'J')))
+        self.assertFalse(self.backend.exists_patients(('name', comparisons.EQUAL, 'Jane')))
+
+    def test_count_providers(self):
+        "Count the providers matching lookups."
+        self.backend.create_provider({'name': 'Joe'})
+        self.backend.create_provider({'name': 'Jane'})
+        self.assertEqual(2, self.backend.count_providers())
+        self.assertEqual(1, self.backend.count_providers(('name', comparisons.EQUAL, 'Joe')))
+
+    def test_providers_exist(self):
+        "Check whether any providers match lookups."
+        self.backend.create_provider({'name': 'Joe'})
+        self.assertTrue(self.backend.exists_providers(('name', comparisons.EQUAL, 'Joe')))
+        self.assertFalse(self.backend.exists_providers(('name', comparisons.EQUAL, 'Jane')))
+
     def test_all_providers(self):
         "Get all providers with no filtering."
         provider = self.backend.create_provider({'name': 'Joe'})
@@ -157,6 +354,198 @@ class BackendTestMixin(object):
         result = self.backend.filter_providers()
         self.assertItemsEqual([provider, other_provider], result)
 
+    def test_filter_expressions(self):
+        "Lookups can be combined with And, Or and Not expressions."
+        joe = self.backend.create_patient({'name': 'Joe', 'location': 'Durham', 'status': 'A'})
+        jane = self.backend.create_patient({'name': 'Jane', 'location': 'Raleigh', 'status': 'A'})
+        self.backend.create_patient({'name': 'Jill', 'location': 'Durham', 'status': 'I'})
+        self.backend.create_patient({'name': 'Jack', 'location': 'Cary', 'status': 'A'})
+        in_triangle = Or(
+            ('location', comparisons.EQUAL, 'Durham'), ('location', comparisons.EQUAL, 'Raleigh'))
+        active = Not(('status', comparisons.EQUAL, 'I'))
+        result = self.backend.filter_patients(
+            in_triangle, active, ('name', comparisons.LIKE, 'J'), order_by='name')
+        self.assertEqual([jane['id'], joe['id']], [patient['id'] for patient in result])
+        nested = Or(And(('location', comparisons.EQUAL, 'Cary'), ('name', comparisons.EQUAL, 'Jack')),
+                    Not(Or(active, ('name', comparisons.IN, ['Jane']))))
+        result = self.backend.filter_patients(nested, order_by='name')
+        self.assertEqual(['Jack', 'Jill'], [patient['name'] for patient in result])
+        self.assertEqual(3, self.backend.count_patients(in_triangle))
+        self.assertFalse(self.backend.exists_patients(in_triangle, Not(in_triangle)))
+        self.assertEqual([], list(self.backend.filter_patients(Or())))
+
+    def test_aggregate_patients(self):
+        "Count patients and find the earliest and latest values for each group."
+        first, last = datetime.date(1980, 1, 1), datetime.date(1990, 1, 1)
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'location': 'Durham', 'birth_date': first})
+        self.backend.create_patient({'name': 'Jane', 'sex': 'F', 'location': 'Durham', 'birth_date': last})
+        self.backend.create_patient({'name': 'Jack', 'sex': 'M', 'location': 'Raleigh'})
+        functions = [('count', aggregates.COUNT, None), ('born', aggregates.COUNT, 'birth_date'),
+                     ('min', aggregates.MIN, 'birth_date'), ('max', aggregates.MAX, 'birth_date')]
+        result = self.backend.aggregate_patients(group_by=['location'], aggregates=functions)
+        self.assertEqual([
+            {'location': 'Durham', 'count': 2, 'born': 2, 'min': first, 'max': last},
+            {'location': 'Raleigh', 'count': 1, 'born': 0, 'min': None, 'max': None},
+        ], result)
+        result = self.backend.aggregate_patients(
+            ('sex', comparisons.EQUAL, 'M'), group_by=['location', 'sex'], aggregates=functions[:1])
+        self.assertEqual([
+            {'location': 'Durham', 'sex': 'M', 'count': 1},
+            {'location': 'Raleigh', 'sex': 'M', 'count': 1},
+        ], result)
+        self.assertEqual([{'count': 3, 'min': first}],
+            self.backend.aggregate_patients(aggregates=functions[:1] + functions[2:3]))
+        self.assertEqual([{'count': 0}], self.backend.aggregate_patients(
+            ('name', comparisons.EQUAL, 'Jill'), aggregates=functions[:1]))
+
+    def test_aggregate_age_bands(self):
+        "Patients can be grouped by the age band of their birth date."
+        today = datetime.date(2014, 6, 15)
+        for birth_date in (datetime.date(2014, 1, 1), datetime.date(2009, 6, 16),
+                           datetime.date(2009, 6, 15), datetime.date(1940, 1, 1), None):
+            self.backend.create_patient({'name': 'Joe', 'birth_date': birth_date})
+        bands = AgeBands('birth_date', (0, 5, 65), as_of=today)
+        result = self.backend.aggregate_patients(
+            group_by=[bands], aggregates=[('count', aggregates.COUNT, None)])
+        self.assertEqual([
+            {'birth_date__age': None, 'count': 1},
+            {'birth_date__age': '0-4', 'count': 2},
+            {'birth_date__age': '5-64', 'count': 1},
+            {'birth_date__age': '65+', 'count': 1},
+        ], result)
+
+    def test_aggregate_providers(self):
+        "Count providers for each location."
+        self.backend.create_provider({'name': 'Joe', 'location': 'Durham'})
+        self.backend.create_provider({'name': 'Jane', 'location': 'Durham'})
+        result = self.backend.aggregate_providers(
+            group_by=['location'], aggregates=[('count', aggregates.COUNT, None)])
+        self.assertEqual([{'location': 'Durham', 'count': 2}], result)
+
+    def test_search_patients(self):
+        "Patients are found by the words of their name or location, best match first."
+        smith = self.backend.create_patient({'name': 'Jon Smith', 'location': 'Durham'})
+        smyth = self.backend.create_patient({'name': 'Joan Smyth', 'location': 'Raleigh'})
+        jones = self.backend.create_patient({'name': 'Mary Jones', 'location': 'Smithfield'})
+
+        def search(*args, **kwargs):
+            return [patient['id'] for patient in self.backend.search_patients(*args, **kwargs)]
+
+        self.assertEqual([smith['id'], smyth['id']], search('smith', fields=['name']))
+        self.assertEqual(set([smith['id'], smyth['id'], jones['id']]), set(search('smith')))
+        self.assertEqual([jones['id']], search('mary jon'))
+        self.assertEqual([smith['id']], search('MIT', fields=['name']))
+        self.assertEqual(
+            set([smith['id'], smyth['id'], jones['id']]), set(search('jo', fields=['name'])))
+        self.assertEqual(1, len(search('smith', limit=1)))
+        self.assertEqual([smith['id']], search('smith', fields=['name'], threshold=1))
+        self.assertEqual([], search('xyz'))
+        self.assertEqual([], search(' '))
+
+    def test_search_follows_writes(self):
+        "Searches should reflect the records as they are changed."
+        joe = self.backend.create_patient({'name': 'Joe Smith'})
+        jane = self.backend.create_patient({'name': 'Jane Smith'})
+        self.assertEqual(2, len(self.backend.search_patients('smith')))
+        self.backend.update_patient(joe['id'], {'name': 'Joe Brown'})
+        self.backend.delete_patient(jane['id'])
+        jill, = self.backend.bulk_create_patients([{'name': 'Jill Smith'}])
+        self.assertEqual([jill['id']], [p['id'] for p in self.backend.search_patients('smith')])
+        self.assertEqual([joe['id']], [p['id'] for p in self.backend.search_patients('brown')])
+        self.backend.bulk_update_patients([(jill['id'], {'name': 'Jill Brown'})])
+        self.backend.bulk_delete_patients([joe['id']])
+        self.assertEqual([jill['id']], [p['id'] for p in self.backend.search_patients('brown')])
+        self.assertEqual('Jill Brown', self.backend.search_patients('brown')[0]['name'])
+
+    def test_search_providers(self):
+        "Providers are found by name."
+        joe = self.backend.create_provider({'name': 'Joe Smith', 'location': 'Durham'})
+        self.backend.create_provider({'name': 'Jane Doe', 'location': 'Smithfield'})
+        self.assertEqual([joe['id']], [p['id'] for p in self.backend.search_providers('smiht')])
+
+    def test_find_duplicate_patients(self):
+        "Patients with a similar name, birth date and location are possible duplicates."
+        mohamed = self.backend.create_patient(
+            {'name': 'Mohamed Ali', 'birth_date': datetime.date(1980, 3, 12), 'location': 'Durham'})
+        muhammad = self.backend.create_patient(
+            {'name': 'Muhammad Ali', 'birth_date': datetime.date(1980, 12, 3), 'location': 'Durham'})
+        self.backend.create_patient(
+            {'name': 'Muhammad Ali', 'birth_date': datetime.date(1955, 1, 1), 'location': 'Raleigh'})
+        self.backend.create_patient(
+            {'name': 'Mary Jones', 'birth_date': datetime.date(1980, 3, 12), 'location': 'Durham'})
+
+        def find(*args, **kwargs):
+            return [patient['id'] for patient, score in self.backend.find_duplicate_patients(*args, **kwargs)]
+
+        self.assertEqual([muhammad['id']], find(mohamed['id']))
+        registration = {'name': 'Mohammed Aly', 'birth_date': datetime.date(1980, 3, 21), 'location': 'Durham'}
+        self.assertEqual([mohamed['id'], muhammad['id']], find(registration))
+        self.assertEqual([mohamed['id']], find(registration, limit=1))
+        self.assertEqual([mohamed['id']], find(registration, threshold=0.85))
+        self.assertEqual([], find(registration, threshold=0.85, limit=0) or [])
+        self.assertEqual([], find(123))
+        patient, score = self.backend.find_duplicate_patients(mohamed['id'])[0]
+        self.assertEqual('Muhammad Ali', patient['name'])
+        self.assertTrue(0.75 <= score <= 1)
+
+    def test_dedupe_patients(self):
+        "Dedupe returns each pair of possible duplicates once."
+        birth_date = datetime.date(1980, 3, 12)
+        mohamed = self.backend.create_patient({'name': 'Mohamed Ali', 'birth_date': birth_date, 'location': 'Durham'})
+        muhammad = self.backend.create_patient({'name': 'Muhammad Ali', 'birth_date': birth_date, 'location': 'Durham'})
+        self.backend.create_patient({'name': 'Mary Jones', 'sex': 'F', 'birth_date': birth_date})
+        self.backend.create_patient({'name': 'Mary Jones', 'sex': 'M', 'birth_date': birth_date})
+        result = self.backend.dedupe_patients()
+        self.assertEqual([tuple(sorted([mohamed['id'], muhammad['id']]))], [pair[:2] for pair in result])
+        self.assertEqual(2, len(self.backend.dedupe_patients(threshold=0.5)))
+
+    def test_duplicates_follow_writes(self):
+        "Blocking keys should be kept up to date as patients are changed."
+        birth_date = datetime.date(1980, 3, 12)
+        joe = self.backend.create_patient({'name': 'Joe Smith', 'birth_date': birth_date})
+        jane = self.backend.create_patient({'name': 'Jane Doe', 'birth_date': birth_date})
+        registration = {'name': 'Jo Smyth', 'birth_date': birth_date}
+        self.assertEqual([joe['id']], [p['id'] for p, score in self.backend.find_duplicate_patients(registration)])
+        self.backend.update_patient(joe['id'], {'name': 'Joe Brown'})
+        self.backend.bulk_update_patients([(jane['id'], {'name': 'Jo Smith'})])
+        self.assertEqual([jane['id']], [p['id'] for p, score in self.backend.find_duplicate_patients(registration)])
+        self.backend.delete_patient(jane['id'])
+        self.assertEqual([], self.backend.find_duplicate_patients(registration))
+
+    def test_prepare_patients(self):
+        "Prepared filters should bind the lookup values each time they are run."
+        joe = self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        jane = self.backend.create_patient({'name': 'Jane', 'location': 'Durham'})
+        self.backend.create_patient({'name': 'Jill', 'location': 'Raleigh'})
+        plan = self.backend.prepare_patients(
+            [('location', comparisons.EQUAL), ('name', comparisons.IN)], order_by='-name', fields=['name'])
+        result = plan.run(['Durham', ['Joe', 'Jane', 'Jill']])
+        self.assertEqual([joe['id'], jane['id']], [patient['id'] for patient in result])
+        self.assertEqual(set(['id', 'name']), set(result[0]))
+        page = plan.run(['Durham', ['Joe', 'Jane']], limit=1)
+        self.assertEqual(['Joe'], [patient['name'] for patient in page])
+        rest = plan.run(['Durham', ['Joe', 'Jane']], after=page.cursor)
+        self.assertEqual(['Jane'], [patient['name'] for patient in rest])
+        self.assertEqual([], list(plan.run(['Raleigh', ['Joe']])))
+
+    def test_prepare_repeated_field(self):
+        "Prepared filters can have more than one lookup on a field."
+        today = datetime.date.today()
+        self.backend.create_patient({'name': 'Joe', 'birth_date': today})
+        self.backend.create_patient({'name': 'Jane', 'birth_date': today - datetime.timedelta(days=7)})
+        plan = self.backend.prepare_patients(
+            [('birth_date', comparisons.GT), ('birth_date', comparisons.LTE)])
+        result = plan.run([today - datetime.timedelta(days=1), today])
+        self.assertEqual(['Joe'], [patient['name'] for patient in result])
+
+    def test_prepare_providers(self):
+        "Providers can also be filtered with prepared filters."
+        self.backend.create_provider({'name': 'Joe'})
+        self.backend.create_provider({'name': 'Jane'})
+        plan = self.backend.prepare_providers([('name', comparisons.LIKE)], order_by='name')
+        self.assertEqual(['Jane', 'Joe'], [provider['name'] for provider in plan.run(['J'])])
+        self.assertEqual(['Joe'], [provider['name'] for provider in plan.run(['Jo'])])
+
     def test_filter_providers_by_name(self):
         "Filter providers by common string expressions."
         provider = self.backend.create_provider({'name': 'Joe'})
@@ -173,6 +562,46 @@ class BackendTestMixin(object):
             result = self.backend.filter_providers(('name', op, val))
             self.assertItemsEqual(expected, result)
 
+    def test_changes(self):
+        "Writes should be returned by the change feed in the order they were made."
+        patient = self.backend.create_patient({'name': 'Joe'})
+        provider = self.backend.create_provider({'name': 'Jane'})
+        self.backend.update_patient(patient['id'], {'name': 'Jack'})
+        self.backend.link_patient(patient['id'], 'FOO', 'BAR')
+        self.backend.unlink_patient(patient['id'], 'FOO', 'BAR')
+        self.backend.delete_provider(provider['id'])
+        self.backend.update_provider(provider['id'], {'name': 'Jill'})
+        result = list(self.backend.get_changes())
+        self.assertEqual([
+            ('patient', changes.CREATE, patient['id'], None),
+            ('provider', changes.CREATE, provider['id'], None),
+            ('patient', changes.UPDATE, patient['id'], None),
+            ('patient', changes.LINK, patient['id'], 'FOO'),
+            ('patient', changes.UNLINK, patient['id'], 'FOO'),
+            ('provider', changes.DELETE, provider['id'], None),
+        ], [(c['category'], c['action'], c['id'], c['source_id']) for c in result])
+        self.assertEqual('BAR', result[3]['source_name'])
+
+    def test_changes_cursor(self):
+        "The change feed cursor should continue from the last change seen."
+        self.backend.bulk_create_patients([{'name': 'Joe'}, {'name': 'Jane'}])
+        page = self.backend.get_changes(limit=1)
+        self.assertEqual(1, len(list(page)))
+        self.assertEqual(1, len(list(self.backend.get_changes(after=page.cursor))))
+        patient = self.backend.create_patient({'name': 'Jack'})
+        self.backend.bulk_delete_patients([patient['id']])
+        rest = self.backend.get_changes(after=page.cursor, chunk_size=1)
+        self.assertEqual([changes.CREATE, changes.CREATE, changes.DELETE],
+            [change['action'] for change in rest])
+        self.assertEqual([], list(self.backend.get_changes(after=rest.cursor)))
+        self.assertRaises(InvalidCursor, lambda: list(self.backend.get_changes(after='XXX')))
+
+    @override_settings(HEALTHCARE_CHANGE_LOG=False)
+    def test_changes_disabled(self):
+        "Writes aren't logged when the change log is disabled."
+        self.backend.create_patient({'name': 'Joe'})
+        self.assertEqual([], list(self.backend.get_changes()))
+
     def test_link_patient_identifier(self):
         "Link a patient with an additional id."
         patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
@@ -0,0 +1,190 @@
+from __future__ import absolute_import
+
+import time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import unittest
+
+from mock import patch
+
+from ...api import HealthcareAPI
+from ...backends.caching import LRUCache
+from .base import BackendTestMixin
+from .test_django import reset_change_log
+
+
+@override_settings(HEALTHCARE_CACHING_BACKEND='healthcare.backends.djhealth.DjangoStorage')
+class CachingBackendTestCase(BackendTestMixin, TestCase):
+    backend = 'healthcare.backends.caching.CachingStorage'
+
+    def setUp(self):
+        super(CachingBackendTestCase, self).setUp()
+        reset_change_log()
+
+    def test_cached_patient(self):
+        "Repeated patient lookups should be answered from the cache."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.backend.get_patient(patient['id'])
+        with self.assertNumQueries(0):
+            fetched = self.backend.get_patient(patient['id'])
+        self.assertEqual(patient, fetched)
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0}, self.backend.stats)
+
+    def test_cached_copies(self):
+        "Changing a returned record should not change the cached record."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.backend.get_patient(patient['id'])['name'] = 'Jack'
+        self.assertEqual('Joe', self.backend.get_patient(patient['id'])['name'])
+
+    def test_cached_fields(self):
+        "Only some fields of a cached record can be returned without a query."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.assertEqual(['id', 'name'], sorted(self.backend.get_patient(patient['id'], fields=['name'])))
+        self.backend.get_patient(patient['id'])
+        with self.assertNumQueries(0):
+            fetched = self.backend.get_patient(patient['id'], fields=['name'])
+        self.assertEqual({'id': patient['id'], 'name': 'Joe'}, fetched)
+
+    def test_cached_source(self):
+        "Repeated lookups by source id should be answered from the cache."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        # Linked without invalidating so the lookup can be cached straight away
+        self.backend.backend.link_patient(patient['id'], 'FOO', 'BAR')
+        self.backend.get_patient('FOO', source='BAR')
+        with self.assertNumQueries(0):
+            fetched = self.backend.get_patient('FOO', source='BAR')
+        self.assertEqual(patient['id'], fetched['id'])
+
+    def test_cached_many(self):
+        "Only records missing from the cache should be fetched."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        other_patient = self.backend.create_patient({'name': 'Jane', 'sex': 'F'})
+        self.backend.backend.link_patient(other_patient['id'], 'FOO', 'BAR')
+        self.backend.get_patient(patient['id'])
+        with patch.object(self.backend.backend, 'get_many_patients') as get_many:
+            get_many.return_value = {}
+            self.backend.get_many_patients([patient['id'], other_patient['id']])
+            get_many.assert_called_once_with([other_patient['id']])
+        self.backend.get_many_patients_by_source([('FOO', 'BAR')])
+        with self.assertNumQueries(0):
+            result = self.backend.get_many_patients_by_source([('FOO', 'BAR')])
+        self.assertEqual(other_patient['id'], result[('FOO', 'BAR')]['id'])
+
+    def test_update_invalidates(self):
+        "Updating a patient should remove it from the cache."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.backend.get_patient(patient['id'])
+        self.backend.update_patient(patient['id'], {'name': 'Jack'})
+        self.assertEqual('Jack', self.backend.get_patient(patient['id'])['name'])
+        self.backend.bulk_update_patients([(patient['id'], {'name': 'Jill'})])
+        self.assertEqual('Jill', self.backend.get_patient(patient['id'])['name'])
+
+    def test_delete_invalidates(self):
+        "Deleting a provider should remove it from the cache."
+        provider = self.backend.create_provider({'name': 'Joe'})
+        self.backend.get_provider(provider['id'])
+        self.backend.delete_provider(provider['id'])
+        self.assertEqual(None, self.backend.get_provider(provider['id']))
+
+    def test_fetch_racing_write(self):
+        "A record fetched before a write isn't cached once the write has invalidated it."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        fetch = self.backend.backend.get_patient
+
+        def racing(id, **kwargs):
+            record = fetch(id, **kwargs)
+            self.backend.update_patient(patient['id'], {'name': 'Jack'})
+            return record
+
+        with patch.object(self.backend.backend, 'get_patient', side_effect=racing):
+            self.assertEqual('Joe', self.backend.get_patient(patient['id'])['name'])
+        self.assertEqual('Jack', self.backend.get_patient(patient['id'])['name'])
+
+    def test_cached_after_write_settles(self):
+        "Records written recently are only cached again after write_settle seconds."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.backend.update_patient(patient['id'], {'name': 'Jack'})
+        self.backend.get_patient(patient['id'])
+        with self.assertNumQueries(1):
+            self.backend.get_patient(patient['id'])
+        with patch('healthcare.backends.caching.time') as clock:
+            clock.time.return_value = time.time() + self.backend.write_settle
+            self.backend.get_patient(patient['id'])
+            with self.assertNumQueries(0):
+                self.assertEqual('Jack', self.backend.get_patient(patient['id'])['name'])
+
+    def test_unlink_invalidates(self):
+        "Unlinking a source id should remove the association from the cache."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        other_patient = self.backend.create_patient({'name': 'Jane', 'sex': 'F'})
+        self.backend.link_patient(patient['id'], 'FOO', 'BAR')
+        self.backend.get_patient('FOO', source='BAR')
+        self.backend.unlink_patient(patient['id'], 'FOO', 'BAR')
+        self.assertEqual(None, self.backend.get_patient('FOO', source='BAR'))
+        self.backend.link_patient(other_patient['id'], 'FOO', 'BAR')
+        self.assertEqual(other_patient['id'], self.backend.get_patient('FOO', source='BAR')['id'])
+
+    def test_shared_by_clients(self):
+        "Clients share one instance so a record cached by one is served to the others."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        HealthcareAPI('healthcare.backends.caching.CachingStorage').patients.get(patient['id'])
+        with self.assertNumQueries(0):
+            fetched = HealthcareAPI('healthcare.backends.caching.CachingStorage').patients.get(patient['id'])
+        self.assertEqual(patient, fetched)
+
+    @override_settings(
+        HEALTHCARE_CACHE_ALIAS='default',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_cache(self):
+        "Records should be shared through the Django cache."
+        backend = self.backend.__class__()
+        other_backend = self.backend.__class__()
+        patient = backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        backend.get_patient(patient['id'])
+        with self.assertNumQueries(0):
+            fetched = other_backend.get_patient(patient['id'])
+        self.assertEqual(patient, fetched)
+        backend.update_patient(patient['id'], {'name': 'Jack'})
+        # Other processes keep their local copy until it times out
+        other_backend.local.clear()
+        self.assertEqual('Jack', other_backend.get_patient(patient['id'])['name'])
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_eviction(self):
+        "The least recently used entry should be evicted when full."
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, len(cache))
+
+    def test_expiration(self):
+        "Entries should expire after the timeout."
+        cache = LRUCache(max_size=2, timeout=10)
+        with patch('healthcare.backends.caching.time') as clock:
+            clock.time.return_value = 100
+            cache.set('a', 1)
+            clock.time.return_value = 109
+            self.assertEqual(1, cache.get('a'))
+            clock.time.return_value = 110
+            self.assertEqual(None, cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_delete(self):
+        "Deleted entries should no longer be returned."
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('b')
+        self.assertEqual(None, cache.get('a'))
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(0, cache.evictions)
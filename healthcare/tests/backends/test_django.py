@@ -1,9 +1,450 @@
 from __future__ import absolute_import
 
-from django.test import TestCase
+import datetime
+import os
+import sys
+import threading
+import time
 
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from django.core.management.color import no_style
+from django.db import DatabaseError, IntegrityError, connection, connections
+from django.forms.models import model_to_dict
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import unittest
+from django.utils.timezone import now
+
+from mock import patch
+
+from ...api import HealthcareAPI
+from ...backends import aggregates, comparisons
+from ...backends.aggregates import AgeBands
+from ...backends.djhealth import DjangoStorage
+from ...backends.expressions import Not, Or
+from ...backends.djhealth.models import Change, DuplicateKey, Patient, PatientID, SearchGram
+from ...backends.djhealth.routing import LEAST_LOADED, ReplicaRouter, carry_pins, unpin
+from ...backends.djhealth.storage import get_serializer
 from .base import BackendTestMixin
 
 
+def reset_change_log():
+    """
+    Restart the change log keys from 1. Test transactions don't undo the keys used
+    on PostgreSQL, which would leave a recent gap before the first change of a test.
+    """
+    cursor = connection.cursor()
+    for statement in connection.ops.sequence_reset_sql(no_style(), [Change]):
+        cursor.execute(statement)
+
+
 class DjangoBackendTestCase(BackendTestMixin, TestCase):
-    backend = 'healthcare.backends.djhealth.DjangoStorage'
\ No newline at end of file
+    backend = 'healthcare.backends.djhealth.DjangoStorage'
+
+    def setUp(self):
+        super(DjangoBackendTestCase, self).setUp()
+        reset_change_log()
+
+    def test_bulk_create_invalid_row(self):
+        "A bad row in a batch should not prevent the others from being created."
+        result = self.backend.bulk_create_patients([
+            {'name': 'Joe', 'sex': 'M'},
+            {'name': 'Jane', 'foo': 'bar'},
+            {'name': 'Jack', 'birth_date': 'not a date'},
+            {'name': 'Jill', 'sex': 'F'},
+        ])
+        self.assertEqual(4, len(result))
+        self.assertEqual('Joe', result[0]['name'])
+        self.assertEqual(None, result[1])
+        self.assertEqual(None, result[2])
+        self.assertEqual('Jill', result[3]['name'])
+        self.assertEqual(2, len(self.backend.filter_patients()))
+
+    def test_bulk_create_given_ids(self):
+        "Records given an id keep it and the others get the keys they were stored with."
+        self.backend.create_patient({'name': 'X'})
+        result = self.backend.bulk_create_patients([
+            {'name': 'Y'}, {'id': 50, 'name': 'Z'}, {'name': 'W'}])
+        stored = dict(Patient.objects.values_list('name', 'id'))
+        self.assertEqual([stored['Y'], 50, stored['W']], [p['id'] for p in result])
+        self.assertEqual(['Y', 'Z', 'W'], [self.backend.get_patient(p['id'])['name'] for p in result])
+        self.assertEqual(['Y', 'Z', 'W'], [p['name'] for p in self.backend.search_patients(
+            'Y') + self.backend.search_patients('Z') + self.backend.search_patients('W')])
+
+    def test_paging_nullable_field(self):
+        "Chunks and cursors include the rows without a value wherever the database sorts them."
+        self.backend.bulk_create_patients([
+            {'name': 'A', 'birth_date': datetime.date(1990, 1, 1)}, {'name': 'B'},
+            {'name': 'C', 'birth_date': datetime.date(1980, 1, 1)}, {'name': 'D'}])
+        for order_by in ('-birth_date', 'birth_date'):
+            expected = [p['name'] for p in self.backend.filter_patients(order_by=order_by)]
+            self.assertEqual(4, len(expected))
+            streamed = self.backend.filter_patients(order_by=order_by, chunk_size=1)
+            self.assertEqual(expected, [p['name'] for p in streamed])
+            paged, after = [], None
+            for i in range(5):
+                page = self.backend.filter_patients(order_by=order_by, limit=1, after=after)
+                paged.extend(p['name'] for p in page)
+                after = page.cursor
+            self.assertEqual(expected, paged)
+
+    def test_filter_is_lazy(self):
+        "No query should be run until the filter result is consumed."
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        with self.assertNumQueries(0):
+            result = self.backend.filter_patients()
+        self.assertEqual(1, len(result))
+
+    def test_filter_in_chunks(self):
+        "Filter results are streamed from the database in chunks."
+        self.backend.bulk_create_patients([{'name': 'Joe{0}'.format(i)} for i in range(5)])
+        result = self.backend.filter_patients(chunk_size=2)
+        with self.assertNumQueries(3):
+            names = [p['name'] for p in result]
+        self.assertEqual(['Joe0', 'Joe1', 'Joe2', 'Joe3', 'Joe4'], names)
+
+    def test_count_single_query(self):
+        "Counting patients should be a single query."
+        self.backend.bulk_create_patients([{'name': 'Joe'}, {'name': 'Jane'}])
+        with self.assertNumQueries(1):
+            self.assertEqual(2, self.backend.count_patients(('name', comparisons.LIKE, 'J')))
+
+    def test_aggregate_single_query(self):
+        "Aggregating patients should be a single GROUP BY query."
+        self.backend.bulk_create_patients([
+            {'name': 'Joe', 'location': 'Durham', 'birth_date': datetime.date(1980, 1, 1)},
+            {'name': 'Jane', 'location': 'Durham'},
+        ])
+        with self.assertNumQueries(1):
+            result = self.backend.aggregate_patients(
+                group_by=['location', AgeBands('birth_date')],
+                aggregates=[('count', aggregates.COUNT, None)])
+        self.assertEqual(2, len(result))
+
+    def test_changes_in_chunks(self):
+        "The change log should be read with one query per chunk."
+        self.backend.bulk_create_patients([{'name': 'Joe{0}'.format(i)} for i in range(5)])
+        with self.assertNumQueries(3):
+            self.assertEqual(5, len(list(self.backend.get_changes(chunk_size=2))))
+
+    def test_failed_write_not_logged(self):
+        "A write which fails should not leave an entry in the change log."
+        self.backend.create_patient({'name': 'Joe', 'foo': 'bar'})
+        self.assertFalse(Change.objects.exists())
+
+    def test_failed_write_in_transaction(self):
+        "A write which fails inside the caller's transaction only undoes its own rows."
+        Patient.objects.create(name='Joe')
+        if not connection.features.uses_savepoints:
+            self.skipTest('Undoing part of a transaction needs savepoints.')
+        with patch.object(self.backend, '_log_changes', side_effect=DatabaseError):
+            self.assertIsNone(self.backend.create_patient({'name': 'Jane'}))
+            self.assertEqual([None], self.backend.bulk_create_patients([{'name': 'Jane'}]))
+        self.assertEqual(['Joe'], list(Patient.objects.values_list('name', flat=True)))
+
+    def test_changes_wait_for_gap(self):
+        "Changes after a recent gap in the log are held back until it settles."
+        first = Change.objects.create(category='patient', action='create', record_id=1)
+        Change.objects.create(id=first.pk + 2, category='patient', action='create', record_id=2)
+        page = self.backend.get_changes(limit=1)
+        list(page)
+        self.assertEqual([], list(self.backend.get_changes(after=page.cursor)))
+        Change.objects.filter(pk=first.pk + 2).update(date=now() - datetime.timedelta(minutes=1))
+        self.assertEqual([2], [c['id'] for c in self.backend.get_changes(after=page.cursor)])
+
+    def test_changes_wait_for_first_gap(self):
+        "Reading without a cursor holds back the changes after a recent gap before the first one."
+        change = Change.objects.create(id=2, category='patient', action='create', record_id=2)
+        self.assertEqual([], list(self.backend.get_changes()))
+        change.date = now() - datetime.timedelta(minutes=1)
+        change.save()
+        self.assertEqual([2], [c['id'] for c in self.backend.get_changes()])
+
+    def test_search_from_index(self):
+        "Searches should read the candidates from the trigram table rather than scanning."
+        self.backend.bulk_create_patients([{'name': 'Joe Smith'}, {'name': 'Jane Doe'}])
+        self.assertTrue(SearchGram.objects.filter(category='patient', field='name', gram='smi').exists())
+        with self.assertNumQueries(2):
+            self.assertEqual(['Joe Smith'], [p['name'] for p in self.backend.search_patients('smith')])
+
+    def test_no_grams_with_trigrams(self):
+        "The trigram table isn't kept when searching with pg_trgm."
+        self.backend.trigram_search = True
+        self.backend.create_patient({'name': 'Joe Smith'})
+        self.assertFalse(SearchGram.objects.exists())
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'pg_trgm needs PostgreSQL.')
+    def test_search_with_trigrams(self):
+        "Searching with pg_trgm should match the same records as the trigram table."
+        connection.cursor().execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        self.backend.bulk_create_patients([
+            {'name': 'Jonathon Alexander Bartholomew Smith-Williams'}, {'name': 'Jo Banda'},
+            {'name': 'Mary Phiri'}])
+        for trigram_search in (False, True):
+            self.backend.trigram_search = trigram_search
+            self.assertEqual(['Jonathon Alexander Bartholomew Smith-Williams'],
+                [p['name'] for p in self.backend.search_patients('jonathan')])
+            self.assertEqual(['Jonathon Alexander Bartholomew Smith-Williams', 'Jo Banda'],
+                [p['name'] for p in self.backend.search_patients('jonathan', threshold=0.2)])
+
+    def test_duplicates_from_keys(self):
+        "Duplicate candidates should be read through the blocking keys rather than scanning."
+        birth_date = datetime.date(1980, 3, 12)
+        joe, jane = self.backend.bulk_create_patients([
+            {'name': 'Joe Smith', 'birth_date': birth_date}, {'name': 'Jane Doe', 'birth_date': birth_date}])
+        self.assertTrue(DuplicateKey.objects.filter(patient=joe['id'], key='S530:1980').exists())
+        with self.assertNumQueries(2):
+            result = self.backend.find_duplicate_patients({'name': 'Jo Smyth', 'birth_date': birth_date})
+        self.assertEqual([joe['id']], [patient['id'] for patient, score in result])
+        self.backend.delete_patient(joe['id'])
+        self.assertFalse(DuplicateKey.objects.filter(patient=joe['id']).exists())
+
+    def test_unique_source_id(self):
+        "The database should enforce unique source id/name pairs."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        PatientID.objects.create(uid='FOO', source='BAR', patient_id=patient['id'])
+        self.assertRaises(IntegrityError, PatientID.objects.create,
+            uid='FOO', source='BAR', patient_id=patient['id'])
+
+    def test_get_many_queries(self):
+        "Patients should be fetched with one query per batch of ids or source."
+        patients = self.backend.bulk_create_patients([{'name': 'Joe{0}'.format(i)} for i in range(5)])
+        ids = [p['id'] for p in patients]
+        for patient in patients:
+            self.backend.link_patient(patient['id'], patient['id'], 'BAR')
+        self.backend.batch_size = 2
+        with self.assertNumQueries(3):
+            result = self.backend.get_many_patients(ids)
+        self.assertEqual(set(ids), set(result))
+        with self.assertNumQueries(3):
+            result = self.backend.get_many_patients_by_source([(id, 'BAR') for id in ids])
+        self.assertEqual(set((id, 'BAR') for id in ids), set(result))
+
+    def test_expressions_single_query(self):
+        "Expressions should be translated into the WHERE clause of a single query."
+        self.backend.bulk_create_patients([{'name': 'Joe', 'location': 'Durham'}, {'name': 'Jane'}])
+        expression = Or(('location', comparisons.EQUAL, 'Durham'), Not(('name', comparisons.LIKE, 'a')))
+        with self.assertNumQueries(1):
+            self.assertEqual(['Joe'], [p['name'] for p in self.backend.filter_patients(expression)])
+
+    def test_prepared_filter_query(self):
+        "Running a prepared filter should take a single query for a page of records."
+        self.backend.bulk_create_patients([{'name': 'Joe', 'location': 'Durham'}, {'name': 'Jane'}])
+        plan = self.backend.prepare_patients([('location', comparisons.IN)], fields=['name'])
+        with self.assertNumQueries(1):
+            self.assertEqual(['Joe'], [p['name'] for p in plan.run([['Durham']])])
+
+    def test_loader_queries(self):
+        "Gets batched by a loader should take one query for ids and one for source ids."
+        client = HealthcareAPI('healthcare.backends.djhealth.DjangoStorage')
+        patients = self.backend.bulk_create_patients([{'name': 'Joe'}, {'name': 'Jane'}])
+        self.backend.link_patient(patients[0]['id'], 'abc', 'FOO')
+        with self.assertNumQueries(2):
+            with client.loader() as loader:
+                pending = [loader.patients.get(patient['id']) for patient in patients]
+                pending.append(loader.patients.get('abc', source='FOO'))
+        self.assertEqual(['Joe', 'Jane', 'Joe'], [p.result()['name'] for p in pending])
+
+    def test_fields_skip_models(self):
+        "Projected records should be built from the selected values without model instances."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        with patch.object(self.backend, '_patient_to_dict') as to_dict:
+            with self.assertNumQueries(1):
+                records = list(self.backend.filter_patients(fields=['name']))
+            self.backend.get_patient(patient['id'], fields=['name'])
+            self.assertFalse(to_dict.called)
+        self.assertEqual([{'id': patient['id'], 'name': 'Joe'}], records)
+
+
+@override_settings(HEALTHCARE_READ_DATABASES=['replica1', 'replica2'])
+class DjangoRoutingTestCase(TestCase):
+    "Reads should go to the replicas and writes to the primary database."
+
+    multi_db = True
+
+    def setUp(self):
+        unpin()
+        self.backend = DjangoStorage()
+
+    def tearDown(self):
+        unpin()
+
+    def test_writes_use_primary(self):
+        "Records are only written to the primary database."
+        patient = self.backend.create_patient({'name': 'Joe'})
+        self.backend.link_patient(patient['id'], 'abc', 'FOO')
+        self.assertTrue(Patient.objects.using('default').filter(pk=patient['id']).exists())
+        self.assertTrue(PatientID.objects.using('default').filter(uid='abc').exists())
+        self.assertFalse(Patient.objects.using('replica1').exists())
+        self.assertFalse(Patient.objects.using('replica2').exists())
+
+    def test_reads_use_replicas(self):
+        "Reads take turns between the replicas."
+        Patient.objects.using('replica1').create(name='Joe')
+        Patient.objects.using('replica2').create(name='Jane')
+        self.assertEqual(['Joe'], [p['name'] for p in self.backend.filter_patients()])
+        self.assertEqual(['Jane'], [p['name'] for p in self.backend.filter_patients()])
+        with self.assertNumQueries(1, using='replica1'):
+            with self.assertNumQueries(1, using='replica2'):
+                self.backend.count_patients()
+                self.backend.exists_patients()
+        with self.assertNumQueries(0, using='default'):
+            self.backend.get_patient(1)
+            self.backend.aggregate_patients(aggregates=[('count', aggregates.COUNT, None)])
+
+    def test_read_your_writes(self):
+        "Reads after a write use the primary until the next request starts."
+        patient = self.backend.create_patient({'name': 'Joe'})
+        self.assertEqual('Joe', self.backend.get_patient(patient['id'])['name'])
+        self.assertEqual(1, self.backend.count_patients())
+        request_started.send(sender=self.__class__)
+        self.assertIsNone(self.backend.get_patient(patient['id']))
+        self.assertEqual(0, self.backend.count_patients())
+
+    @override_settings(HEALTHCARE_STICKY_SECONDS=0)
+    def test_not_sticky(self):
+        "Reads can go to the replicas straight after a write."
+        backend = DjangoStorage()
+        patient = backend.create_patient({'name': 'Joe'})
+        self.assertIsNone(backend.get_patient(patient['id']))
+
+    def test_sticky_expires(self):
+        "Reads go back to the replicas once the sticky time has passed."
+        patient = self.backend.create_patient({'name': 'Joe'})
+        with patch('healthcare.backends.djhealth.routing.timer') as timer:
+            timer.return_value = time.time() + 3600
+            self.assertIsNone(self.backend.get_patient(patient['id']))
+
+    def test_carry_pins(self):
+        "A function called on another thread for this one reads with its pins and its writes pin it."
+        router = ReplicaRouter(replicas=['replica1', 'replica2'])
+        seen = []
+
+        def run(function):
+            thread = threading.Thread(target=function)
+            thread.start()
+            thread.join()
+
+        router.pin()
+        run(lambda: seen.append(router.pinned))
+        run(carry_pins(lambda: seen.append(router.pinned)))
+        unpin()
+        run(carry_pins(router.db_for_write))
+        self.assertEqual([False, True], seen)
+        self.assertTrue(router.pinned)
+
+    def test_thread_call(self):
+        "Calls on another thread carry the pins and close only this storage's connections."
+        self.backend.router = ReplicaRouter(primary='replica1', replicas=['replica2'])
+        aliases = ('default', 'replica1', 'replica2')
+        seen = []
+
+        def read():
+            for alias in aliases:
+                connections[alias].cursor()
+            return self.backend.router.pinned
+
+        def run(function):
+            seen.append(function())
+            seen.extend(alias for alias in aliases if connections[alias].connection is not None)
+            connections['default'].close()
+
+        self.backend.router.pin()
+        thread = threading.Thread(target=run, args=(self.backend.thread_call(read), ))
+        thread.start()
+        thread.join()
+        self.assertEqual([True, 'default'], seen)
+
+    def test_least_loaded(self):
+        "Reads go to the replica with the fewest reads in progress."
+        router = ReplicaRouter(replicas=['replica1', 'replica2'], routing=LEAST_LOADED)
+        with router.read() as first:
+            self.assertEqual(1, router.reads[first])
+            self.assertEqual(1, sum(router.reads.values()))
+            for i in range(3):
+                with router.read() as other:
+                    self.assertNotEqual(first, other)
+        self.assertEqual({'replica1': 0, 'replica2': 0}, router.reads)
+
+    def test_streaming_filter_is_a_read(self):
+        "A filter counts as a read in progress until its records are consumed."
+        Patient.objects.using('replica1').create(name='Joe')
+        Patient.objects.using('replica2').create(name='Joe')
+        self.backend.router.routing = LEAST_LOADED
+        records = iter(self.backend.filter_patients())
+        next(records)
+        self.assertEqual([0, 1], sorted(self.backend.router.reads.values()))
+        list(records)
+        self.assertEqual([0, 0], sorted(self.backend.router.reads.values()))
+
+    def test_unknown_alias(self):
+        "Routing to an unknown database or with an unknown choice of replica is an error."
+        with override_settings(HEALTHCARE_READ_DATABASES=['missing']):
+            self.assertRaises(ImproperlyConfigured, DjangoStorage)
+        with override_settings(HEALTHCARE_READ_ROUTING='random'):
+            self.assertRaises(ImproperlyConfigured, DjangoStorage)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'pg_trgm needs PostgreSQL.')
+class DjangoTrigramTestCase(TransactionTestCase):
+    "Searching with pg_trgm outside of a test transaction."
+
+    def setUp(self):
+        connection.cursor().execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        self.backend = DjangoStorage()
+        self.backend.trigram_search = True
+
+    def test_threshold_not_kept(self):
+        "The word similarity threshold is only changed for the search's own transaction."
+        cursor = connection.cursor()
+        cursor.execute('SHOW pg_trgm.word_similarity_threshold')
+        threshold = cursor.fetchone()[0]
+        self.backend.create_patient({'name': 'Jonathon Smith'})
+        self.assertEqual(['Jonathon Smith'], [p['name'] for p in self.backend.search_patients('jonathan')])
+        cursor.execute('SHOW pg_trgm.word_similarity_threshold')
+        self.assertEqual(threshold, cursor.fetchone()[0])
+
+
+@unittest.skipUnless(os.environ.get('HEALTHCARE_BENCHMARK'), 'Set HEALTHCARE_BENCHMARK=1 to run.')
+class SerializerBenchmarkTestCase(TestCase):
+    "Rows per second converted to records, run with HEALTHCARE_BENCHMARK=1 python runtests.py."
+
+    rows = 100000
+
+    def report(self, name, seconds):
+        sys.stderr.write('\n{0}: {1:,.0f} rows/s'.format(name, self.rows / seconds))
+
+    def test_convert_rows(self):
+        "Compare model_to_dict on instances with the serializer on rows of values."
+        created = now()
+        instances = [
+            Patient(pk=i, name='Patient {0}'.format(i), sex='M', location='Durham',
+                    birth_date=datetime.date(1980, 1, 1), created_date=created, updated_date=created)
+            for i in range(self.rows)
+        ]
+        serializer = get_serializer(Patient)
+        start = time.time()
+        for instance in instances:
+            result = model_to_dict(instance)
+            result['created_date'] = instance.created_date
+            result['updated_date'] = instance.updated_date
+        self.report('model_to_dict', time.time() - start)
+        start = time.time()
+        for instance in instances:
+            serializer.from_instance(instance)
+        self.report('serializer instances', time.time() - start)
+        rows = [tuple(getattr(instance, name) for name in serializer.names) for instance in instances]
+        start = time.time()
+        serializer.from_rows(rows)
+        self.report('serializer rows', time.time() - start)
+
+    def test_filter_rows(self):
+        "Stream all patients from the database."
+        Patient.objects.bulk_create(
+            [Patient(name='Patient {0}'.format(i), sex='F') for i in range(self.rows)], batch_size=500)
+        backend = DjangoStorage()
+        start = time.time()
+        count = sum(1 for patient in backend.filter_patients())
+        self.report('filter_patients', time.time() - start)
+        self.assertEqual(self.rows, count)
@@ -1,13 +1,83 @@
 from django.utils import unittest
 
 from .base import BackendTestMixin
+from ...backends import comparisons
+from ...backends.dummy import DummyStorage
+from ...backends.expressions import Not, Or
 
 
 class DummyBackendTestCase(BackendTestMixin, unittest.TestCase):
     backend = 'healthcare.backends.dummy.DummyStorage'
 
-    def setUp(self):
-        super(DummyBackendTestCase, self).setUp()
-        self.backend._patients = {}
-        self.backend._providers = {}
-        self.backend._patient_ids = {}
\ No newline at end of file
+    def test_instance_records(self):
+        "Each storage instance should keep its own records."
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        self.assertEqual(0, DummyStorage().count_patients())
+
+    def test_returned_copies(self):
+        "Changing a returned record should not change the stored record."
+        patient = self.backend.create_patient({'name': 'Joe', 'sex': 'M'})
+        patient['name'] = 'Jack'
+        self.backend.get_patient(patient['id'])['name'] = 'Jack'
+        self.assertEqual(1, self.backend.count_patients(('name', comparisons.EQUAL, 'Joe')))
+
+    def test_indexes_follow_writes(self):
+        "Indexed lookups should reflect updates and deletes made after the index was built."
+        joe = self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'location': 'Durham'})
+        jane = self.backend.create_patient({'name': 'Jane', 'sex': 'F', 'location': 'Durham'})
+        lookup = ('location', comparisons.EQUAL, 'Durham')
+        self.assertEqual(2, self.backend.count_patients(lookup))
+        self.assertEqual(['Jane', 'Joe'], [p['name'] for p in self.backend.filter_patients(
+            ('name', comparisons.GT, 'J'), order_by=['name'])])
+        self.backend.update_patient(joe['id'], {'location': 'Raleigh', 'name': 'Adam'})
+        self.backend.delete_patient(jane['id'])
+        self.backend.create_patient({'name': 'Kim', 'sex': 'F', 'location': 'Durham'})
+        self.assertEqual(['Kim'], [p['name'] for p in self.backend.filter_patients(lookup)])
+        self.assertEqual(['Kim'], [p['name'] for p in self.backend.filter_patients(
+            ('name', comparisons.GT, 'J'), order_by=['name'])])
+        self.assertEqual(['Adam', 'Kim'], [p['name'] for p in self.backend.filter_patients(
+            ('name', comparisons.LTE, 'Kim'), order_by=['name'])])
+
+    def test_unindexed_values(self):
+        "Lookups on values which can't be indexed should fall back to a scan."
+        self.backend.create_patient({'name': 'Joe', 'sex': 'M', 'tags': ['a']})
+        self.backend.create_patient({'name': 'Jane', 'sex': 'F', 'tags': ['b']})
+        result = self.backend.filter_patients(
+            ('tags', comparisons.EQUAL, ['a']), ('name', comparisons.LIKE, 'J'))
+        self.assertEqual(['Joe'], [p['name'] for p in result])
+
+    def test_write_while_iterating(self):
+        "Deleting records while iterating over a filter should not skip records."
+        for i in range(10):
+            self.backend.create_patient({'name': 'Patient {0}'.format(i), 'sex': 'M'})
+        seen = 0
+        for patient in self.backend.filter_patients(chunk_size=3):
+            self.backend.delete_patient(patient['id'])
+            seen += 1
+        self.assertEqual(10, seen)
+        self.assertEqual(0, self.backend.count_patients())
+
+    def test_or_from_indexes(self):
+        "An Or of equality lookups should be answered from the indexes without a scan."
+        self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        self.backend.create_patient({'name': 'Jane', 'location': 'Raleigh'})
+        expression = Or(('location', comparisons.EQUAL, 'Durham'), ('name', comparisons.IN, ['Jane']))
+        candidates, filters = self.backend._plan(self.backend._patients, [expression])
+        self.assertEqual(2, len(candidates))
+        self.assertEqual([], filters)
+
+    def test_short_circuit(self):
+        "Expressions should stop checking their children once the result is known."
+        checked = []
+        comparisons_used = dict(DummyStorage._comparison_mapping)
+
+        def equal(a, b):
+            checked.append(b)
+            return a == b
+
+        self.backend._comparison_mapping = dict(comparisons_used, **{comparisons.EQUAL: equal})
+        self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        expression = Or(Not(('name', comparisons.EQUAL, 'Jane')), ('location', comparisons.EQUAL, 'Cary'))
+        self.backend._patients.hash_index = lambda field: None
+        self.assertEqual(1, self.backend.count_patients(expression))
+        self.assertEqual(['Jane'], checked)
@@ -0,0 +1,219 @@
+from __future__ import absolute_import
+
+import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from mock import patch
+
+from .base import BackendTestMixin
+from ...backends import aggregates, comparisons
+from ...backends.base import clear_backends, get_backend
+from ...backends.djhealth import DjangoStorage
+from ...backends.djhealth.models import Patient
+from ...backends.djhealth.routing import unpin
+from ...backends.sharded import LocationShardKey, ShardedStorage
+from ...exceptions import InvalidCursor
+
+
+DUMMY_SHARDS = ['healthcare.backends.dummy.DummyStorage'] * 3
+
+
+class SecondDatabaseStorage(DjangoStorage):
+    "Django storage of the second shard."
+
+    database = 'replica1'
+
+
+class ReplicatedStorage(DjangoStorage):
+    "Django storage of the first shard reading from a replica."
+
+    read_databases = ['replica2']
+
+
+class SecondReplicatedStorage(SecondDatabaseStorage):
+    "Django storage of the second shard reading from a replica."
+
+    read_databases = ['replica2']
+
+
+@override_settings(HEALTHCARE_SHARDS=DUMMY_SHARDS, HEALTHCARE_SHARD_LOCATIONS={'Durham': 0, 'Raleigh': 1})
+class ShardedBackendTestCase(BackendTestMixin, TestCase):
+    backend = 'healthcare.backends.sharded.ShardedStorage'
+
+    def test_placed_by_location(self):
+        "New records are stored in the shard of the longest prefix of their location."
+        durham = self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        raleigh = self.backend.create_patient({'name': 'Jane', 'location': 'Raleigh'})
+        self.assertEqual([1, 1, 0], [shard.count_patients() for shard in self.backend.shards])
+        self.assertEqual(0, self.backend.decode_id(durham['id'])[0])
+        self.assertEqual(1, self.backend.decode_id(raleigh['id'])[0])
+        key = LocationShardKey({'Durham': 0, 'Durham/North': 2})
+        self.assertEqual(2, key.shard('patient', {'location': 'Durham/North/Ward 3'}, 3))
+        self.assertEqual(0, key.shard('patient', {'location': 'Durham/South'}, 3))
+        spread = set(key.shard('patient', {'location': 'Town {0}'.format(i)}, 3) for i in range(20))
+        self.assertEqual(set([0, 1, 2]), spread)
+
+    def test_shared_workers(self):
+        "Clients share one instance and its worker threads, which stop when it's cleared."
+        self.assertIs(self.backend, get_backend('healthcare.backends.sharded.ShardedStorage'))
+        clear_backends()
+        self.assertRaises(RuntimeError, self.backend.executor.submit, int)
+
+    def test_id_goes_to_one_shard(self):
+        "Calls for an id only use the shard encoded in it."
+        patient = self.backend.create_patient({'name': 'Joe', 'location': 'Raleigh'})
+        first, second, third = self.backend.shards
+        with patch.object(first, 'get_patient') as first_get:
+            with patch.object(third, 'get_patient') as third_get:
+                self.assertEqual('Joe', self.backend.get_patient(patient['id'])['name'])
+        self.assertFalse(first_get.called or third_get.called)
+        self.assertIsNone(self.backend.get_patient(patient['id'] + 50))
+        self.assertIsNone(self.backend.get_patient('foo'))
+        self.assertFalse(self.backend.update_patient(-1, {'name': 'Jane'}))
+
+    def test_filter_merged_across_shards(self):
+        "Records from every shard are merged in order before the page is taken."
+        names = ['Ann', 'Bob', 'Cat', 'Dan', 'Eve', 'Fay']
+        locations = ['Durham', 'Raleigh', 'Cary']
+        self.backend.bulk_create_patients([
+            {'name': name, 'location': locations[i % 3]} for i, name in enumerate(names)])
+        self.assertEqual([2, 2, 2], [shard.count_patients() for shard in self.backend.shards])
+        self.assertEqual(names, [p['name'] for p in self.backend.filter_patients(order_by='name')])
+        self.assertEqual(['Eve', 'Dan'], [p['name'] for p in self.backend.filter_patients(
+            order_by='-name', limit=2, offset=1)])
+        result = self.backend.filter_patients(order_by='name', limit=4)
+        self.assertEqual(names[:4], [p['name'] for p in result])
+        self.assertEqual(names[4:], [p['name'] for p in self.backend.filter_patients(
+            order_by='name', after=result.cursor)])
+
+    def test_paging_by_id(self):
+        "Cursors of the default id ordering page through every shard."
+        self.backend.bulk_create_patients([
+            {'name': 'Joe{0}'.format(i), 'location': 'Town {0}'.format(i)} for i in range(20)])
+        ids = [p['id'] for p in self.backend.filter_patients()]
+        self.assertEqual(sorted(ids), ids)
+        for order_by in (None, '-id'):
+            seen, after = [], None
+            while True:
+                page = self.backend.filter_patients(order_by=order_by, limit=3, after=after)
+                records = list(page)
+                if not records:
+                    break
+                seen.extend(p['id'] for p in records)
+                after = page.cursor
+            self.assertEqual(sorted(ids, reverse=order_by == '-id'), seen)
+
+    def test_cursor_of_other_ordering(self):
+        "A cursor for another ordering is rejected."
+        self.backend.create_patient({'name': 'Joe'})
+        result = self.backend.filter_patients(order_by='name')
+        list(result)
+        self.assertRaises(InvalidCursor, lambda: list(self.backend.filter_patients(after=result.cursor)))
+        self.assertRaises(InvalidCursor, lambda: list(self.backend.get_changes(after=result.cursor)))
+
+    def test_aggregates_combined(self):
+        "The aggregates of a group are combined from every shard."
+        self.backend.bulk_create_patients([
+            {'name': 'Joe', 'sex': 'M', 'location': 'Durham', 'birth_date': datetime.date(1980, 1, 1)},
+            {'name': 'Jack', 'sex': 'M', 'location': 'Raleigh', 'birth_date': datetime.date(1990, 1, 1)},
+            {'name': 'Jane', 'sex': 'F', 'location': 'Raleigh'},
+        ])
+        self.assertEqual([
+            {'sex': 'F', 'count': 1, 'oldest': None},
+            {'sex': 'M', 'count': 2, 'oldest': datetime.date(1980, 1, 1)},
+        ], self.backend.aggregate_patients(group_by=['sex'], aggregates=[
+            ('count', aggregates.COUNT, None), ('oldest', aggregates.MIN, 'birth_date')]))
+
+    def test_changes_from_every_shard(self):
+        "The change feed merges the changes of the shards with a cursor for each."
+        joe = self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        jane = self.backend.create_patient({'name': 'Jane', 'location': 'Raleigh'})
+        result = self.backend.get_changes(limit=1)
+        self.assertEqual([joe['id']], [c['id'] for c in result])
+        self.backend.delete_patient(joe['id'])
+        self.assertEqual([('create', jane['id']), ('delete', joe['id'])], [
+            (c['action'], c['id']) for c in self.backend.get_changes(after=result.cursor)])
+
+
+@override_settings(HEALTHCARE_SHARDS=[
+    'healthcare.backends.djhealth.DjangoStorage', 'healthcare.tests.backends.test_sharded.SecondDatabaseStorage'],
+    HEALTHCARE_SHARD_LOCATIONS={'Durham': 0, 'Raleigh': 1}, HEALTHCARE_SHARD_WORKERS=1)
+class ShardedDatabaseTestCase(TestCase):
+    "Shards in separate SQLite databases."
+
+    multi_db = True
+
+    def setUp(self):
+        # Created as the clients do, along with the shared shards
+        clear_backends()
+        self.backend = get_backend('healthcare.backends.sharded.ShardedStorage')
+
+    def test_shard_databases(self):
+        "Records are written to the database of their shard and read back from every shard."
+        joe = self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        jane = self.backend.create_patient({'name': 'Jane', 'location': 'Raleigh'})
+        self.assertEqual(['Joe'], list(Patient.objects.using('default').values_list('name', flat=True)))
+        self.assertEqual(['Jane'], list(Patient.objects.using('replica1').values_list('name', flat=True)))
+        self.assertEqual(['Jane', 'Joe'], [p['name'] for p in self.backend.filter_patients(order_by='name')])
+        self.assertEqual(1, self.backend.count_patients(('name', comparisons.EQUAL, 'Jane')))
+        self.assertTrue(self.backend.link_patient(jane['id'], 'abc', 'FOO'))
+        self.assertEqual(jane['id'], self.backend.get_patient('abc', source='FOO')['id'])
+        self.assertEqual({joe['id']: joe}, self.backend.get_many_patients([joe['id']]))
+
+    def test_no_shards(self):
+        "Shards need to be configured."
+        with override_settings(HEALTHCARE_SHARDS=[]):
+            self.assertRaises(ImproperlyConfigured, ShardedStorage)
+        with override_settings(HEALTHCARE_SHARD_KEY='healthcare.backends.sharded.Missing'):
+            self.assertRaises(ImproperlyConfigured, ShardedStorage)
+
+
+@override_settings(HEALTHCARE_SHARDS=[
+    'healthcare.tests.backends.test_sharded.ReplicatedStorage',
+    'healthcare.tests.backends.test_sharded.SecondReplicatedStorage'],
+    HEALTHCARE_SHARD_LOCATIONS={'Durham': 0, 'Raleigh': 1}, HEALTHCARE_SHARD_WORKERS=2)
+class ShardedWorkersTestCase(TransactionTestCase):
+    "Shards in separate databases called from worker threads."
+
+    multi_db = True
+
+    def setUp(self):
+        unpin()
+        self.backend = ShardedStorage()
+
+    def tearDown(self):
+        self.backend.close()
+        unpin()
+
+    def test_read_own_writes(self):
+        "Reads on the worker threads after a write from the calling thread use the primary databases."
+        self.backend.bulk_create_patients([
+            {'name': 'Joe', 'location': 'Durham', 'sex': 'M'}, {'name': 'Jane', 'location': 'Raleigh', 'sex': 'F'}])
+        self.assertEqual(['Jane', 'Joe'], [p['name'] for p in self.backend.filter_patients(order_by='name')])
+        self.assertEqual(['Joe'], [p['name'] for p in self.backend.filter_patients(
+            order_by='-name', limit=1)])
+        self.assertEqual(2, self.backend.count_patients())
+        # The replica doesn't have the records
+        unpin()
+        self.assertEqual(0, self.backend.count_patients())
+
+    def test_filter_in_chunks(self):
+        "Records after the first chunk of each shard are streamed from the calling thread."
+        self.backend.bulk_create_patients([
+            {'name': 'Joe{0:02d}'.format(i), 'location': 'Durham' if i % 2 else 'Raleigh'} for i in range(10)])
+        names = ['Joe{0:02d}'.format(i) for i in range(10)]
+        self.assertEqual(names, [p['name'] for p in self.backend.filter_patients(order_by='name', chunk_size=2)])
+        self.assertEqual(names[1:8], [p['name'] for p in self.backend.filter_patients(
+            order_by='name', chunk_size=2, offset=1, limit=7)])
+
+    def test_worker_connections_closed(self):
+        "The worker threads close their database connections after each call."
+        self.backend.create_patient({'name': 'Joe', 'location': 'Durham'})
+        self.assertEqual(1, self.backend.count_patients())
+        opened = self.backend.executor.submit(
+            lambda: [alias for alias in connections if connections[alias].connection is not None]).result()
+        self.assertEqual([], opened)
@@ -1,13 +1,22 @@
 from __future__ import unicode_literals
 
 import datetime
+import threading
+import time
 
+from django.test.utils import override_settings
 from django.utils import unittest
+from django.utils.functional import SimpleLazyObject
 
 from mock import patch
 
-from ..api import HealthcareAPI
+from .. import api
+from ..api import HealthcareAPI, Q
 from ..backends import comparisons
+from ..backends.base import InvalidBackendError, clear_backends, get_backend
+from ..backends.djhealth import DjangoStorage
+from ..backends.dummy import DummyStorage
+from ..backends.expressions import And, Not, Or
 from ..exceptions import PatientDoesNotExist, ProviderDoesNotExist
 
 
@@ -28,6 +37,12 @@ class APIClientTestCase(unittest.TestCase):
             self.client.patients.get(123)
             self.assertTrue(get.called, "Backend get_patient should be called.")
 
+    def test_get_patient_fields(self):
+        "Fields should be passed to the backend when given."
+        with patch('healthcare.backends.dummy.DummyStorage.get_provider') as get:
+            self.client.providers.get(123, fields=['name'])
+            get.assert_called_once_with(123, fields=['name'])
+
     def test_update_patient(self):
         "Update a patient record with the API client."
         with patch('healthcare.backends.dummy.DummyStorage.update_patient') as update:
@@ -40,6 +55,45 @@ class APIClientTestCase(unittest.TestCase):
             self.client.patients.delete(123)
             self.assertTrue(delete.called, "Backend delete_patient should be called.")
 
+    def test_bulk_create_patients(self):
+        "Create patients in batches with the API client."
+        with patch('healthcare.backends.dummy.DummyStorage.bulk_create_patients') as create:
+            create.side_effect = lambda batch: [dict(item, id=1) for item in batch]
+            items = ({'name': 'Joe'} for i in range(5))
+            result = self.client.patients.bulk_create(items, batch_size=2)
+            self.assertEqual(3, create.call_count, "Items should be sent in batches.")
+            self.assertEqual(5, len(result))
+            self.assertEqual({}, result.errors)
+
+    def test_bulk_create_errors(self):
+        "Failed items should be reported without aborting the other batches."
+        def create(batch):
+            if batch[0]['name'] == 'Bad':
+                raise ValueError("Bad batch")
+            return [None if item['name'] == 'Missing' else item for item in batch]
+        items = [{'name': 'Joe'}, {'name': 'Missing'}, {'name': 'Bad'}, {'name': 'Jane'}]
+        with patch('healthcare.backends.dummy.DummyStorage.bulk_create_patients') as bulk:
+            bulk.side_effect = create
+            result = self.client.patients.bulk_create(items, batch_size=2)
+        self.assertEqual([items[0], None, None, None], result.results)
+        self.assertEqual([1, 2, 3], sorted(result.errors))
+        self.assertEqual("Bad batch", result.errors[2])
+
+    def test_bulk_update_patients(self):
+        "Update patients in batches with the API client."
+        patient = self.client.patients.create(name='Joe')
+        result = self.client.patients.bulk_update([(patient['id'], {'name': 'Jack'}), (123, {})])
+        self.assertEqual([True, False], result.results)
+        self.assertEqual([1], list(result.errors))
+        self.assertEqual('Jack', self.client.patients.get(patient['id'])['name'])
+
+    def test_bulk_delete_providers(self):
+        "Delete providers in batches with the API client."
+        provider = self.client.providers.create(name='Joe')
+        result = self.client.providers.bulk_delete([123, provider['id']])
+        self.assertEqual([False, True], result.results)
+        self.assertEqual("Provider was not found", result.errors[0])
+
     def test_create_provider(self):
         "Create a new provider with the API client."
         with patch('healthcare.backends.dummy.DummyStorage.create_provider') as create:
@@ -116,7 +170,7 @@ class APIClientTestCase(unittest.TestCase):
                 self.client.patients.filter(**kwargs)
                 self.assertTrue(filter_call.called, "Backend filter_patients should be called.")
                 args, _ = filter_call.call_args
-                self.assertEqual(expected, *args)
+                self.assertEqual(expected, list(args))
                 filter_call.reset_mock()
 
     def test_filter_providers(self):
@@ -137,9 +191,180 @@ class APIClientTestCase(unittest.TestCase):
                 self.client.providers.filter(**kwargs)
                 self.assertTrue(filter_call.called, "Backend filter_providers should be called.")
                 args, _ = filter_call.call_args
-                self.assertEqual(expected, *args)
+                self.assertEqual(expected, list(args))
                 filter_call.reset_mock()
 
+    def test_filter_chunk_size(self):
+        "Chunk size should be passed to the backend when given."
+        with patch('healthcare.backends.dummy.DummyStorage.filter_patients') as filter_call:
+            self.client.patients.filter(name='Jane', chunk_size=50)
+            args, kwargs = filter_call.call_args
+            self.assertEqual([('name', comparisons.EQUAL, 'Jane')], list(args))
+            self.assertEqual({'chunk_size': 50}, kwargs)
+
+    def test_filter_page_options(self):
+        "Ordering and paging options should be passed to the backend when given."
+        with patch('healthcare.backends.dummy.DummyStorage.filter_providers') as filter_call:
+            self.client.providers.filter(
+                order_by='-name', limit=10, offset=0, after='abc', fields=['name'])
+            args, kwargs = filter_call.call_args
+            self.assertEqual([], list(args))
+            expected = {
+                'order_by': '-name', 'limit': 10, 'offset': 0, 'after': 'abc', 'fields': ['name']}
+            self.assertEqual(expected, kwargs)
+
+    def test_filter_results(self):
+        "Filter results can be consumed incrementally."
+        joe = self.client.patients.create(name='Joe', location='Durham')
+        jane = self.client.patients.create(name='Jane', location='Durham')
+        self.client.patients.create(name='Jack', location='Raleigh')
+        result = iter(self.client.patients.filter(location='Durham', name__like='J'))
+        self.assertTrue(next(result) in (joe, jane))
+        self.assertTrue(next(result) in (joe, jane))
+        self.assertRaises(StopIteration, next, result)
+
+    def test_filter_expressions(self):
+        "Q expressions should be passed to the backend as And, Or and Not lookups."
+        with patch.object(self.client.backend, 'filter_patients') as filter_call:
+            self.client.patients.filter(
+                Q(location='A') | Q(location='B', name__like='X'), ~Q(status='I'), sex='F')
+        args = filter_call.call_args[0]
+        self.assertEqual(('sex', comparisons.EQUAL, 'F'), args[0])
+        self.assertEqual(Or(And(('location', comparisons.EQUAL, 'A')), And(
+            ('location', comparisons.EQUAL, 'B'), ('name', comparisons.LIKE, 'X'))), args[1])
+        self.assertEqual(Not(And(('status', comparisons.EQUAL, 'I'))), args[2])
+
+    def test_invalid_expressions(self):
+        "Only Q objects and valid lookups can be used as expressions."
+        self.assertRaises(TypeError, self.client.patients.filter, ('name', comparisons.EQUAL, 'Joe'))
+        self.assertRaises(TypeError, self.client.patients.count, Q(name__foo='Joe'))
+        self.assertRaises(TypeError, lambda: Q(name='Joe') | ('name', comparisons.EQUAL, 'Jane'))
+
+    def test_count_expressions(self):
+        "Expressions can be used with count and exists."
+        self.client.patients.create(name='Joe', location='Durham')
+        self.client.patients.create(name='Jane', location='Raleigh')
+        self.assertEqual(2, self.client.patients.count(Q(location='Durham') | Q(name='Jane')))
+        self.assertFalse(self.client.patients.exists(~Q(name__in=['Joe', 'Jane'])))
+
+    def test_prepare_patients(self):
+        "Prepared filters should take the values by lookup or field name."
+        joe = self.client.patients.create(name='Joe', location='Durham', status='A')
+        self.client.patients.create(name='Jane', location='Raleigh', status='I')
+        query = self.client.patients.prepare(location__in=Ellipsis, status='A', order_by='name')
+        self.assertEqual([joe], list(query.run(location=['Durham', 'Raleigh'])))
+        self.assertEqual(['Jane'], [p['name'] for p in query.run(location__in=['Raleigh'], status='I')])
+        self.assertEqual([], list(query.run(location=['Chapel Hill'])))
+        self.assertRaises(TypeError, query.run)
+        self.assertRaises(TypeError, query.run, location=['Durham'], sex='M')
+        self.assertRaises(TypeError, self.client.patients.prepare, location__foo=Ellipsis)
+
+    def test_prepared_plan_cache(self):
+        "Backend plans should be compiled once for each shape and kept in a bounded cache."
+        prepare = self.client.backend.prepare_patients
+        self.client.patients.plans.max_size = 2
+        with patch.object(self.client.backend, 'prepare_patients', side_effect=prepare) as compile_plan:
+            for i in range(3):
+                self.client.patients.prepare(location=Ellipsis, status=i)
+            self.assertEqual(1, compile_plan.call_count)
+            self.client.patients.prepare(location=Ellipsis, order_by='name')
+            self.client.patients.prepare(name=Ellipsis)
+            self.client.patients.prepare(location=Ellipsis, status='A')
+        self.assertEqual(4, compile_plan.call_count)
+        self.assertEqual(2, self.client.patients.plans.evictions)
+
+    def test_count_patients(self):
+        "Translate API patient count calls to the backend."
+        with patch('healthcare.backends.dummy.DummyStorage.count_patients') as count:
+            count.return_value = 2
+            self.assertEqual(2, self.client.patients.count(location='Durham'))
+            args, _ = count.call_args
+            self.assertEqual([('location', comparisons.EQUAL, 'Durham')], list(args))
+
+    def test_providers_exist(self):
+        "Translate API provider exists calls to the backend."
+        with patch('healthcare.backends.dummy.DummyStorage.exists_providers') as exists:
+            exists.return_value = True
+            self.assertTrue(self.client.providers.exists(name__like='Jo'))
+            args, _ = exists.call_args
+            self.assertEqual([('name', comparisons.LIKE, 'Jo')], list(args))
+
+    def test_aggregate_patients(self):
+        "Translate API aggregate calls to the backend."
+        with patch('healthcare.backends.dummy.DummyStorage.aggregate_patients') as aggregate:
+            aggregate.return_value = []
+            self.client.patients.aggregate(
+                status='A', group_by=['location', 'birth_date__age'],
+                aggregates=['count', 'birth_date__min'], age_bands=[0, 18])
+            args, kwargs = aggregate.call_args
+            self.assertEqual([('status', comparisons.EQUAL, 'A')], list(args))
+            location, bands = kwargs['group_by']
+            self.assertEqual('location', location)
+            self.assertEqual(('birth_date', 'birth_date__age', [0, 18]), (bands.field, bands.name, bands.bounds))
+            self.assertEqual(
+                [('count', 'count', None), ('birth_date__min', 'min', 'birth_date')], kwargs['aggregates'])
+        self.assertRaises(TypeError, self.client.patients.aggregate, aggregates=['min'])
+        self.assertRaises(TypeError, self.client.patients.aggregate, aggregates=['name__sum'])
+        self.assertRaises(TypeError, self.client.patients.aggregate, group_by=['name__foo'])
+
+    def test_group_by(self):
+        "Count the records for each combination of field values."
+        self.client.patients.create(name='Joe', sex='M', location='Durham')
+        self.client.patients.create(name='Jane', sex='F', location='Durham')
+        self.client.patients.create(name='Jack', sex='M', location='Durham')
+        self.assertEqual([
+            {'location': 'Durham', 'sex': 'F', 'count': 1},
+            {'location': 'Durham', 'sex': 'M', 'count': 2},
+        ], self.client.patients.group_by('location', 'sex'))
+        self.assertEqual([{'sex': 'M', 'count': 2}], self.client.patients.group_by('sex', name__like='J', sex='M'))
+
+    def test_search_patients(self):
+        "Translate API search calls to the backend."
+        with patch('healthcare.backends.dummy.DummyStorage.search_patients') as search:
+            search.return_value = []
+            self.client.patients.search('smith', fields='name', limit=5)
+            search.assert_called_once_with('smith', fields=['name'], limit=5, threshold=None)
+        self.assertRaises(TypeError, self.client.patients.search, 'smith', fields=['sex'])
+        self.assertRaises(TypeError, self.client.providers.search, 'smith', fields=['location'])
+
+    def test_find_duplicate_patients(self):
+        "Translate API duplicate calls to the backend."
+        with patch('healthcare.backends.dummy.DummyStorage.find_duplicate_patients') as find:
+            find.return_value = []
+            self.client.patients.find_duplicates({'name': 'Joe'}, limit=5)
+            find.assert_called_once_with({'name': 'Joe'}, limit=5, threshold=None)
+        with patch('healthcare.backends.dummy.DummyStorage.dedupe_patients') as dedupe:
+            dedupe.return_value = []
+            self.client.patients.dedupe(threshold=0.9)
+            dedupe.assert_called_once_with(threshold=0.9)
+
+    def test_changes(self):
+        "Changes are read from the backend change feed."
+        patient = self.client.patients.create(name='Joe')
+        self.client.patients.delete(patient['id'])
+        result = self.client.changes(limit=1)
+        self.assertEqual([('create', patient['id'])], [(c['action'], c['id']) for c in result])
+        self.assertEqual(['delete'], [c['action'] for c in self.client.changes(after=result.cursor)])
+
+    def test_get_many_patients(self):
+        "Get several patient records with the API client."
+        joe = self.client.patients.create(name='Joe')
+        result = self.client.patients.get_many(iter([joe['id'], 123]))
+        self.assertEqual({joe['id']: joe}, result)
+
+    def test_get_many_patients_by_source(self):
+        "Get several patient records by source id/name with the API client."
+        joe = self.client.patients.create(name='Joe')
+        self.client.patients.link(joe['id'], 'abc', 'FOO')
+        result = self.client.patients.get_many_by_source([('abc', 'FOO'), ('def', 'FOO')])
+        self.assertEqual({('abc', 'FOO'): joe}, result)
+
+    def test_get_many_providers(self):
+        "Get several provider records with the API client."
+        with patch('healthcare.backends.dummy.DummyStorage.get_many_providers') as get_many:
+            self.client.providers.get_many([1, 2])
+            get_many.assert_called_once_with([1, 2])
+
     def test_link_patient(self):
         "Link a patient with an another ID with the API client."
         with patch('healthcare.backends.dummy.DummyStorage.link_patient') as link:
@@ -163,4 +388,198 @@ class APIClientTestCase(unittest.TestCase):
 
     def test_get_missing_patient_for_source(self):
         "Try to get a patient by source id/name which doesn't exist."
-        self.assertRaises(PatientDoesNotExist, self.client.patients.get, 123, source='ABC')
\ No newline at end of file
+        self.assertRaises(PatientDoesNotExist, self.client.patients.get, 123, source='ABC')
+
+class CoalescingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = HealthcareAPI('healthcare.backends.dummy.DummyStorage', coalesce=True)
+        self.release = threading.Event()
+
+    def wait_for(self, coalesced):
+        "Wait until the given number of calls are waiting on another call."
+        for i in range(500):
+            if self.client.coalescer.coalesced >= coalesced:
+                return
+            time.sleep(0.001)
+        self.fail('Calls were not coalesced.')
+
+    def concurrently(self, call, count):
+        "Make the call from several threads while the first backend call is held."
+        results = [None] * count
+
+        def run(i):
+            try:
+                results[i] = call()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i, )) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        self.wait_for(count - 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce_get(self):
+        "Identical gets in progress at the same time should make one backend call."
+        patient = self.client.patients.create(name='Joe')
+        get_patient = self.client.backend.get_patient
+
+        def slow_get(*args, **kwargs):
+            self.release.wait()
+            return get_patient(*args, **kwargs)
+
+        with patch.object(self.client.backend, 'get_patient', side_effect=slow_get) as get:
+            results = self.concurrently(lambda: self.client.patients.get(patient['id']), 5)
+        self.assertEqual(1, get.call_count)
+        self.assertEqual([patient] * 5, results)
+        results[0]['name'] = 'Jack'
+        self.assertEqual('Joe', results[1]['name'])
+        self.assertEqual({'calls': 5, 'coalesced': 4}, self.client.coalescer.stats)
+
+    def test_coalesce_errors(self):
+        "Callers sharing a call should all get its error."
+
+        def slow_get(*args, **kwargs):
+            self.release.wait()
+            return None
+
+        with patch.object(self.client.backend, 'get_patient', side_effect=slow_get):
+            results = self.concurrently(lambda: self.client.patients.get(123, source='ABC'), 3)
+        for result in results:
+            self.assertTrue(isinstance(result, PatientDoesNotExist))
+
+    def test_coalesce_filter(self):
+        "Identical filters with a limit should share the loaded records."
+        self.client.patients.create(name='Joe', location='Durham')
+        filter_patients = self.client.backend.filter_patients
+
+        def slow_filter(*args, **kwargs):
+            self.release.wait()
+            return filter_patients(*args, **kwargs)
+
+        with patch.object(self.client.backend, 'filter_patients', side_effect=slow_filter) as filter_call:
+            results = self.concurrently(
+                lambda: self.client.patients.filter(location='Durham', name__in=['Joe', 'Jane'], limit=10), 3)
+        self.assertEqual(1, filter_call.call_count)
+        for result in results:
+            self.assertEqual(['Joe'], [patient['name'] for patient in result])
+            self.assertTrue(result.cursor)
+
+    def test_unbounded_filter_streams(self):
+        "Filters without a limit aren't coalesced so their records are still streamed."
+        self.client.patients.create(name='Joe')
+        result = self.client.patients.filter(name='Joe')
+        self.assertIsNone(result._cache)
+        self.assertEqual(['Joe'], [patient['name'] for patient in result])
+        self.assertEqual({'calls': 0, 'coalesced': 0}, self.client.coalescer.stats)
+
+    def test_different_calls(self):
+        "Calls with different arguments or made one after another should not be coalesced."
+        patient = self.client.patients.create(name='Joe')
+        self.client.patients.get(patient['id'])
+        self.client.patients.get(patient['id'])
+        self.client.patients.get(patient['id'], fields=['name'])
+        list(self.client.patients.filter(name='Joe', limit=10))
+        self.assertEqual({'calls': 4, 'coalesced': 0}, self.client.coalescer.stats)
+
+
+class DataLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = HealthcareAPI('healthcare.backends.dummy.DummyStorage')
+        self.patients = [self.client.patients.create(name=name) for name in ('Joe', 'Jane', 'Jill')]
+        for patient in self.patients:
+            self.client.patients.link(patient['id'], patient['name'], 'FOO')
+
+    def test_batch_gets(self):
+        "Gets made within the loader should be fetched with one call per kind of lookup."
+        backend = self.client.backend
+        with patch.object(backend, 'get_many_patients', wraps=backend.get_many_patients) as by_id:
+            with patch.object(backend, 'get_many_patients_by_source',
+                    wraps=backend.get_many_patients_by_source) as by_source:
+                with self.client.loader() as loader:
+                    pending = [loader.patients.get(patient['id']) for patient in self.patients]
+                    pending.append(loader.patients.get('Jill', source='FOO'))
+                    self.assertFalse(by_id.called)
+        self.assertEqual(1, by_id.call_count)
+        self.assertEqual(1, by_source.call_count)
+        self.assertEqual(self.patients + self.patients[-1:], [p.result() for p in pending])
+
+    def test_dispatch_on_result(self):
+        "Reading a result should dispatch the gets queued so far."
+        loader = self.client.loader()
+        first = loader.patients.get(self.patients[0]['id'])
+        second = loader.patients.get(self.patients[1]['id'], fields=['name'])
+        with patch.object(self.client.backend, 'get_many_patients',
+                wraps=self.client.backend.get_many_patients) as get_many:
+            self.assertEqual(self.patients[0], first.result())
+            self.assertEqual({'id': self.patients[1]['id'], 'name': 'Jane'}, second.result())
+            self.assertEqual(self.patients[0], loader.patients.get(self.patients[0]['id']).result())
+        self.assertEqual(1, get_many.call_count)
+
+    def test_failed_dispatch(self):
+        "A failed fetch raises its error from each result until the gets are fetched."
+        loader = self.client.loader()
+        first = loader.patients.get(self.patients[0]['id'])
+        second = loader.patients.get(self.patients[1]['id'])
+        with patch.object(self.client.backend, 'get_many_patients', side_effect=IOError) as get_many:
+            self.assertRaises(IOError, first.result)
+            self.assertRaises(IOError, second.result)
+        self.assertEqual(2, get_many.call_count)
+        self.assertEqual(self.patients[1], second.result())
+        self.assertEqual(self.patients[0], first.result())
+
+    def test_own_records(self):
+        "Each caller should get its own copy of a record requested more than once."
+        with self.client.loader() as loader:
+            first = loader.patients.get(self.patients[0]['id'])
+            second = loader.patients.get(self.patients[0]['id'])
+        record = first.result()
+        record['name'] = 'Jack'
+        self.assertEqual('Joe', second.result()['name'])
+
+    def test_missing_records(self):
+        "Missing records should raise the same exceptions as get."
+        with self.client.loader() as loader:
+            patient = loader.patients.get(123)
+            source = loader.patients.get(123, source='ABC')
+            provider = loader.providers.get(123)
+            found = loader.patients.get(self.patients[0]['id'])
+        self.assertRaises(PatientDoesNotExist, patient.result)
+        self.assertRaises(PatientDoesNotExist, source.result)
+        self.assertRaises(ProviderDoesNotExist, provider.result)
+        self.assertEqual(self.patients[0], found.result())
+
+
+class DefaultClientTestCase(unittest.TestCase):
+
+    def test_lazy_client(self):
+        "The default client is created from the settings when it's first used."
+        self.assertTrue(isinstance(api.client, SimpleLazyObject))
+        with override_settings(
+                HEALTHCARE_STORAGE_BACKEND='healthcare.backends.dummy.DummyStorage', HEALTHCARE_COALESCE=True):
+            client = SimpleLazyObject(api.get_client)
+            with patch('healthcare.api.get_backend', wraps=get_backend) as loaded:
+                self.assertFalse(loaded.called)
+                self.assertTrue(isinstance(client.backend, DummyStorage))
+                client.patients.create(name='Joe')
+            self.assertEqual(1, loaded.call_count)
+            self.assertIsNotNone(client.coalescer)
+
+    def test_shared_backends(self):
+        "Backends which can be shared are created once for each path."
+        path = 'healthcare.backends.djhealth.DjangoStorage'
+        backend = get_backend(path)
+        self.assertTrue(isinstance(backend, DjangoStorage))
+        self.assertIs(backend, get_backend(path))
+        self.assertIs(backend, HealthcareAPI(path).backend)
+        clear_backends()
+        self.assertIsNot(backend, get_backend(path))
+        dummy = 'healthcare.backends.dummy.DummyStorage'
+        self.assertIsNot(get_backend(dummy), get_backend(dummy))
+        self.assertRaises(InvalidBackendError, get_backend, 'healthcare.backends.dummy.Missing')
+        self.assertRaises(InvalidBackendError, get_backend, 'missing')
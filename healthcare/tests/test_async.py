@@ -0,0 +1,177 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.utils import unittest
+
+from mock import patch
+
+from ..api import AsyncHealthcareAPI
+from ..backends.asynchronous import AsyncHealthcareStorage, SyncStorageAdapter, completed, get_asyncio
+from ..exceptions import PatientDoesNotExist, ProviderDoesNotExist
+
+
+asyncio = get_asyncio()
+
+
+class EchoStorage(AsyncHealthcareStorage):
+    "Asynchronous backend which returns the patient id it was given."
+
+    def get_patient(self, id, source=None, fields=None):
+        return completed({'id': id}, self.get_loop())
+
+
+@unittest.skipIf(asyncio is None, 'Requires asyncio or trollius.')
+class AsyncAPIClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncHealthcareAPI(
+            'healthcare.backends.dummy.DummyStorage', max_workers=2, loop=self.loop)
+        self.run = self.loop.run_until_complete
+
+    def tearDown(self):
+        self.client.backend.executor.shutdown()
+        self.loop.close()
+
+    def test_adapt_sync_backend(self):
+        "Synchronous backends should be run through the adapter."
+        self.assertTrue(isinstance(self.client.backend, SyncStorageAdapter))
+
+    def test_async_backend(self):
+        "Asynchronous backends should be used directly."
+        client = AsyncHealthcareAPI('healthcare.tests.test_async.EchoStorage')
+        client.backend.loop = self.loop
+        self.assertEqual({'id': 123}, self.run(client.patients.get(123)))
+
+    def test_create_get_patient(self):
+        "Create and fetch a patient without blocking the loop."
+        patient = self.run(self.client.patients.create(name='Joe', sex='M'))
+        self.assertEqual(patient, self.run(self.client.patients.get(patient['id'])))
+        fetched = self.run(self.client.patients.get(patient['id'], fields=['name']))
+        self.assertEqual({'id': patient['id'], 'name': 'Joe'}, fetched)
+
+    def test_get_missing(self):
+        "Missing records should raise the same exceptions as the synchronous client."
+        self.assertRaises(PatientDoesNotExist, self.run, self.client.patients.get(123, source='ABC'))
+        self.assertRaises(ProviderDoesNotExist, self.run, self.client.providers.get(123))
+
+    def test_link_patient(self):
+        "Link a patient and fetch it by source id."
+        patient = self.run(self.client.patients.create(name='Joe'))
+        self.assertTrue(self.run(self.client.patients.link(patient['id'], 'abc', 'FOO')))
+        self.assertEqual(patient['id'], self.run(self.client.patients.get('abc', source='FOO'))['id'])
+        self.assertTrue(self.run(self.client.patients.unlink(patient['id'], 'abc', 'FOO')))
+
+    def test_update_delete_provider(self):
+        "Update and delete should return booleans."
+        provider = self.run(self.client.providers.create(name='Joe'))
+        self.assertTrue(self.run(self.client.providers.update(provider['id'], name='Jack')))
+        self.assertTrue(self.run(self.client.providers.delete(provider['id'])))
+        self.assertFalse(self.run(self.client.providers.delete(provider['id'])))
+
+    def test_filter_patients(self):
+        "Filter results should be loaded before they are returned to the loop."
+        self.run(self.client.patients.create(name='Joe', location='Durham'))
+        self.run(self.client.patients.create(name='Jane', location='Raleigh'))
+        result = self.run(self.client.patients.filter(location='Durham', order_by='name'))
+        self.assertEqual(['Joe'], [patient['name'] for patient in result])
+        self.assertTrue(result.cursor)
+        self.assertEqual(1, self.run(self.client.patients.count(location='Durham')))
+        self.assertTrue(self.run(self.client.patients.exists(name='Jane')))
+
+    def test_bulk_create_errors(self):
+        "A failed batch should not prevent the other batches from being created."
+        backend = self.client.backend.backend
+        create = backend.bulk_create_patients
+
+        def bulk_create(data):
+            if data[0]['name'] == 'Bad':
+                raise ValueError('Bad batch')
+            return create(data)
+
+        with patch.object(backend, 'bulk_create_patients', side_effect=bulk_create):
+            result = self.run(self.client.patients.bulk_create(
+                [{'name': 'Joe'}, {'name': 'Bad'}, {'name': 'Jane'}], batch_size=1))
+        self.assertEqual(3, len(result))
+        self.assertEqual({1: 'Bad batch'}, result.errors)
+        self.assertEqual(2, backend.count_patients())
+
+    def test_bounded_workers(self):
+        "No more than max_workers calls should run at once and the loop should keep running."
+        active, peak, lock = [0], [0], threading.Lock()
+        ticks = []
+
+        def slow_get(id, **kwargs):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return {'id': id}
+
+        def tick():
+            ticks.append(True)
+            if len(ticks) < 5:
+                self.loop.call_later(0.001, tick)
+
+        with patch.object(self.client.backend.backend, 'get_patient', side_effect=slow_get):
+            futures = [self.client.patients.get(i) for i in range(10)]
+            self.loop.call_soon(tick)
+            results = self.run(asyncio.gather(*futures))
+        self.assertEqual(list(range(10)), [patient['id'] for patient in results])
+        self.assertEqual(2, peak[0])
+        self.assertEqual(5, len(ticks))
+
+    def test_coalesce(self):
+        "Identical pending gets should share one backend call."
+        client = AsyncHealthcareAPI(
+            'healthcare.backends.dummy.DummyStorage', max_workers=2, loop=self.loop, coalesce=True)
+
+        def slow_get(id, **kwargs):
+            time.sleep(0.01)
+            return {'id': id}
+
+        with patch.object(client.backend.backend, 'get_patient', side_effect=slow_get) as get:
+            futures = [client.patients.get(1) for i in range(5)] + [client.patients.get(2)]
+            results = self.run(asyncio.gather(*futures))
+        client.backend.executor.shutdown()
+        self.assertEqual([1] * 5 + [2], [patient['id'] for patient in results])
+        self.assertEqual(2, get.call_count)
+        self.assertEqual({'calls': 6, 'coalesced': 4}, client.coalescer.stats)
+
+    def test_batch(self):
+        "Gets made in the same loop iteration should be fetched with one call."
+        client = AsyncHealthcareAPI(
+            'healthcare.backends.dummy.DummyStorage', max_workers=2, loop=self.loop, batch=True)
+        joe = self.run(client.patients.create(name='Joe'))
+        self.run(client.patients.link(joe['id'], 'abc', 'FOO'))
+        backend = client.backend.backend
+        with patch.object(backend, 'get_many_patients', wraps=backend.get_many_patients) as get_many:
+            futures = [
+                client.patients.get(joe['id']),
+                client.patients.get(joe['id'], fields=['name']),
+                client.patients.get('abc', source='FOO'),
+                client.patients.get(123),
+            ]
+            results = self.run(asyncio.gather(*futures[:3]))
+            self.assertRaises(PatientDoesNotExist, self.run, futures[3])
+        client.backend.executor.shutdown()
+        self.assertEqual(1, get_many.call_count)
+        self.assertEqual([joe, {'id': joe['id'], 'name': 'Joe'}, joe], results)
+
+    def test_prepared_filter(self):
+        "Prepared filters should return futures of the loaded results."
+        self.run(self.client.patients.create(name='Joe', location='Durham'))
+        query = self.client.patients.prepare(location=Ellipsis)
+        result = self.run(query.run(location='Durham'))
+        self.assertEqual(['Joe'], [patient['name'] for patient in result])
+
+    def test_changes(self):
+        "The change feed should be loaded before it is returned to the loop."
+        patient = self.run(self.client.patients.create(name='Joe'))
+        result = self.run(self.client.changes())
+        self.assertEqual([patient['id']], [change['id'] for change in result])
+        self.assertEqual([], list(self.run(self.client.changes(after=result.cursor))))
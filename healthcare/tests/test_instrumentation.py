@@ -0,0 +1,136 @@
+from __future__ import unicode_literals
+
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+from django.utils import unittest
+
+from mock import Mock, patch
+
+from ..api import HealthcareAPI
+from ..exceptions import ProviderDoesNotExist
+from ..instrumentation import (LoggingSink, MemoryStatsClient, SignalSink, StatsSink,
+    get_instrumentation)
+from ..signals import backend_call
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = MemoryStatsClient()
+        self.client = HealthcareAPI(
+            'healthcare.backends.dummy.DummyStorage', instrumentation=[StatsSink(self.stats)])
+
+    def test_disabled(self):
+        "Without sinks the backend methods should be called directly."
+        client = HealthcareAPI('healthcare.backends.dummy.DummyStorage')
+        self.assertEqual(None, client.instrumentation)
+        self.assertEqual(client.backend.get_patient, client.patients._method('get_{category}'))
+
+    def test_timing_and_rows(self):
+        "Each backend call should be timed and count the records returned or changed."
+        patient = self.client.patients.create(name='Joe')
+        self.client.patients.get(patient['id'])
+        self.client.patients.update(123, name='Jack')
+        self.client.patients.bulk_create([{'name': 'Jane'}, {'name': 'Jill'}])
+        self.assertEqual({
+            'healthcare.create_patient.calls': 1,
+            'healthcare.create_patient.rows': 1,
+            'healthcare.get_patient.calls': 1,
+            'healthcare.get_patient.rows': 1,
+            'healthcare.update_patient.calls': 1,
+            'healthcare.bulk_create_patients.calls': 1,
+            'healthcare.bulk_create_patients.rows': 2,
+        }, self.stats.counters)
+        self.assertEqual(1, len(self.stats.timings['healthcare.get_patient']))
+
+    def test_filter_rows(self):
+        "Filter calls should be recorded once their records have been consumed."
+        self.client.patients.bulk_create([{'name': 'Joe'}, {'name': 'Jane'}])
+        result = self.client.patients.filter(chunk_size=1)
+        self.assertFalse('healthcare.filter_patients.calls' in self.stats.counters)
+        self.assertEqual(2, len(list(result)))
+        self.assertEqual(1, self.stats.counters['healthcare.filter_patients.calls'])
+        self.assertEqual(2, self.stats.counters['healthcare.filter_patients.rows'])
+
+    def test_filter_sent_once(self):
+        "A filter's call is sent once, when its first iteration stops or it's closed."
+        self.client.patients.bulk_create([{'name': 'Joe'}, {'name': 'Jane'}, {'name': 'Jill'}])
+        result = self.client.patients.filter(chunk_size=1)
+        self.assertEqual(3, len(list(result)))
+        self.assertEqual(3, len(list(result)))
+        self.assertEqual(1, self.stats.counters['healthcare.filter_patients.calls'])
+        result = self.client.patients.filter(order_by='name')
+        records = iter(result)
+        self.assertEqual('Jane', next(records)['name'])
+        self.assertEqual(1, self.stats.counters['healthcare.filter_patients.calls'])
+        result.close()
+        self.assertEqual(2, self.stats.counters['healthcare.filter_patients.calls'])
+        self.assertEqual(4, self.stats.counters['healthcare.filter_patients.rows'])
+        self.assertEqual([], list(records))
+        self.assertEqual(['Jill', 'Joe'], [p['name'] for p in self.client.patients.filter(
+            order_by='name', after=result.cursor)])
+
+    def test_errors(self):
+        "Errors should be recorded and raised to the caller."
+        with patch.object(self.client.backend, 'delete_patient', side_effect=ValueError('Bad')):
+            self.assertRaises(ValueError, self.client.patients.delete, 123)
+        self.assertEqual(1, self.stats.counters['healthcare.delete_patient.errors'])
+
+    @override_settings(HEALTHCARE_CACHING_BACKEND='healthcare.backends.dummy.DummyStorage')
+    def test_cache_hits(self):
+        "Cache hits and misses of the caching backend should be recorded."
+        client = HealthcareAPI(
+            'healthcare.backends.caching.CachingStorage', instrumentation=[StatsSink(self.stats)])
+        patient = client.patients.create(name='Joe')
+        client.patients.get(patient['id'])
+        client.patients.get(patient['id'])
+        self.assertEqual(1, self.stats.counters['healthcare.get_patient.hits'])
+        self.assertEqual(1, self.stats.counters['healthcare.get_patient.misses'])
+
+    def test_signal(self):
+        "The signal sink should send the backend_call signal."
+        calls = []
+
+        def receiver(sender, call, **kwargs):
+            calls.append(call)
+
+        backend_call.connect(receiver)
+        try:
+            client = HealthcareAPI(
+                'healthcare.backends.dummy.DummyStorage', instrumentation=[SignalSink()])
+            self.assertRaises(ProviderDoesNotExist, client.providers.get, 123)
+        finally:
+            backend_call.disconnect(receiver)
+        call, = calls
+        self.assertEqual(('provider', 'get_provider', 0), (call.category, call.method, call.rows))
+
+    def test_logging(self):
+        "The logging sink should log calls and log errors as warnings."
+        logger = Mock()
+        client = HealthcareAPI(
+            'healthcare.backends.dummy.DummyStorage', instrumentation=[LoggingSink(logger)])
+        client.patients.count(name='Joe')
+        args = logger.log.call_args[0]
+        self.assertEqual(logging.DEBUG, args[0])
+        self.assertEqual('DummyStorage.count_patients', args[2])
+        with patch.object(client.backend, 'count_patients', side_effect=ValueError('Bad')):
+            self.assertRaises(ValueError, client.patients.count)
+        self.assertEqual(logging.WARNING, logger.log.call_args[0][0])
+
+    def test_failing_sink(self):
+        "A failing sink should not fail the backend call."
+        sink = Mock(emit=Mock(side_effect=ValueError('Bad')))
+        client = HealthcareAPI(
+            'healthcare.backends.dummy.DummyStorage', instrumentation=[sink, StatsSink(self.stats)])
+        with patch('healthcare.instrumentation.logger') as logger:
+            client.patients.create(name='Joe')
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(1, self.stats.counters['healthcare.create_patient.calls'])
+
+    def test_sink_paths(self):
+        "Sinks can be given by their full Python path."
+        instrumentation = get_instrumentation(['healthcare.instrumentation.StatsSink'])
+        self.assertTrue(isinstance(instrumentation.sinks[0], StatsSink))
+        self.assertRaises(ImproperlyConfigured, get_instrumentation, ['healthcare.instrumentation.Foo'])
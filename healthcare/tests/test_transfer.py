@@ -0,0 +1,120 @@
+from __future__ import unicode_literals
+
+import datetime
+import io
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import unittest
+
+from mock import patch
+
+from ..api import HealthcareAPI
+from ..management.commands.healthcare_export import Command as ExportCommand
+from ..transfer import ColumnarFormat, ThreadPoolExecutor, export_records, get_format, import_records
+
+
+class TransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = HealthcareAPI('healthcare.backends.dummy.DummyStorage')
+        self.target = HealthcareAPI('healthcare.backends.dummy.DummyStorage')
+        self.source.patients.bulk_create([
+            {'name': 'Joe', 'sex': 'M', 'location': 'Durham', 'birth_date': datetime.date(1980, 1, 2)},
+            {'name': 'J\xe9r\xf4me', 'sex': 'M', 'location': 'Durham, NC', 'birth_date': None},
+            {'name': 'Jane', 'sex': 'F', 'location': 'Raleigh', 'status': 'I'},
+        ])
+
+    def fields(self, client):
+        return sorted(
+            (p['name'], p['sex'], p['location'], p.get('birth_date'), p['status'])
+            for p in client.patients.filter())
+
+    def round_trip(self, format, **options):
+        stream = io.BytesIO()
+        self.assertEqual(3, export_records(self.source.patients, stream, format, **options))
+        stream.seek(0)
+        result = import_records(self.target.patients, stream, format, batch_size=2)
+        self.assertEqual((3, 3, {}), (result.rows, result.created, result.errors))
+        return stream.getvalue()
+
+    def test_ndjson(self):
+        "Records should be exported and imported as one JSON object per line."
+        data = self.round_trip('ndjson')
+        self.assertEqual(3, len(data.splitlines()))
+        self.assertEqual(self.fields(self.source), self.fields(self.target))
+
+    def test_csv(self):
+        "Records should be exported and imported as CSV with a header row."
+        data = self.round_trip('csv')
+        self.assertTrue(data.startswith(b'id,'))
+        self.assertEqual(self.fields(self.source), self.fields(self.target))
+
+    def test_columnar(self):
+        "Records should be exported and imported in compressed blocks of columns."
+        data = self.round_trip(ColumnarFormat(block_size=2))
+        self.assertTrue(data.startswith(ColumnarFormat.magic))
+        self.assertEqual(self.fields(self.source), self.fields(self.target))
+
+    def test_export_lookups(self):
+        "Only the records matching the lookups and the given fields are exported."
+        stream = io.BytesIO()
+        export_records(self.source.patients, stream, 'ndjson', fields=['name'], status='I')
+        self.assertEqual(b'{"name":"Jane"}\n', stream.getvalue())
+
+    def test_import_errors(self):
+        "Records which can't be created are reported by their position in the file."
+        stream = io.BytesIO(b'{"name":"Joe"}\n{"name":"Jane"}\n')
+        create = self.target.backend.create_patient
+        failing = lambda data: None if data['name'] == 'Jane' else create(data)
+        with patch.object(self.target.backend, 'create_patient', side_effect=failing):
+            result = import_records(self.target.patients, stream, 'ndjson', batch_size=1)
+        self.assertEqual((2, 1), (result.rows, result.created))
+        self.assertEqual([1], list(result.errors))
+        self.assertTrue(result.rate > 0)
+
+    @unittest.skipIf(ThreadPoolExecutor is None, 'Requires concurrent.futures.')
+    def test_import_workers(self):
+        "Batches can be created by several workers."
+        stream = io.BytesIO(b''.join(b'{"name":"Joe"}\n' for i in range(25)))
+        result = import_records(self.target.patients, stream, 'ndjson', batch_size=2, workers=3)
+        self.assertEqual((25, 25), (result.rows, result.created))
+        self.assertEqual(25, self.target.patients.count())
+
+    def test_format_extension(self):
+        "The format is chosen by the file extension when not given."
+        self.assertTrue(isinstance(get_format(filename='patients.HCOL'), ColumnarFormat))
+        self.assertRaises(Exception, get_format, filename='patients.txt')
+
+
+class TransferCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.client = HealthcareAPI('healthcare.backends.djhealth.DjangoStorage')
+        self.client.patients.bulk_create([{'name': 'Joe', 'location': 'Durham'}, {'name': 'Jane'}])
+        self.directory = tempfile.mkdtemp()
+        self.stderr = io.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export_import(self):
+        "Records exported by the export command can be loaded by the import command."
+        path = os.path.join(self.directory, 'patients.hcol')
+        call_command('healthcare_export', 'patients', path, stderr=self.stderr)
+        call_command('healthcare_import', 'patients', path, batch_size=1, stderr=self.stderr)
+        self.assertEqual(4, self.client.patients.count())
+        self.assertEqual(2, self.client.patients.count(location='Durham'))
+        self.assertTrue('Imported 2 of 2 patients' in self.stderr.getvalue())
+
+    def test_invalid_arguments(self):
+        "The category and format must be known."
+        path = os.path.join(self.directory, 'patients.txt')
+        command = ExportCommand()
+        options = {'format': None, 'backend': None}
+        for args in (('visits', path + '.csv'), ('patients', path), ('patients', '-')):
+            self.assertRaises(CommandError, command.parse, args, options)
@@ -0,0 +1,290 @@
+"""
+Streaming export and import of patient and provider records. Records are exported
+from the filter results of a client category, such as ``client.patients``, and
+imported through its bulk create so any storage backend can be used on either end.
+"""
+from __future__ import unicode_literals
+
+import codecs
+import collections
+import csv
+import datetime
+import json
+import struct
+import time
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
+from django.utils.dateparse import parse_date, parse_datetime
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without futures
+    ThreadPoolExecutor = None
+
+from .utils import chunked
+
+
+# Record fields which are converted back from their text form on import
+DATE_FIELDS = ('birth_date', 'death_date')
+DATETIME_FIELDS = ('created_date', 'updated_date')
+
+# Fields of each category written to formats which need them up front
+FIELDS = {
+    'patient': ('id', 'name', 'sex', 'birth_date', 'death_date', 'location', 'status',
+                'created_date', 'updated_date'),
+    'provider': ('id', 'name', 'location', 'status', 'created_date', 'updated_date'),
+}
+
+# Fields set by the backend which are left out of imported records by default
+GENERATED_FIELDS = ('id', 'created_date', 'updated_date')
+
+
+def encode_value(value):
+    "Text form of dates and times, other values are written as they are."
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def decode_record(record):
+    "Convert the date and time fields of a read record back from their text form."
+    for names, parse in ((DATE_FIELDS, parse_date), (DATETIME_FIELDS, parse_datetime)):
+        for name in names:
+            value = record.get(name)
+            if isinstance(value, six.string_types):
+                record[name] = parse(value) if value else None
+    return record
+
+
+class NDJSONFormat(object):
+    "One JSON object per line."
+
+    def write(self, records, stream, fields=None):
+        count = 0
+        for record in records:
+            if fields is not None:
+                record = dict((name, record.get(name)) for name in fields)
+            line = json.dumps(dict((k, encode_value(v)) for k, v in record.items()),
+                              separators=(',', ':'), sort_keys=True)
+            stream.write(line.encode('utf-8') + b'\n')
+            count += 1
+        return count
+
+    def read(self, stream):
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield decode_record(json.loads(line.decode('utf-8')))
+
+
+class CSVFormat(object):
+    """
+    Comma separated values with a header row of the field names. Records can leave
+    out fields so the fields are always given up front. Empty values are written as
+    empty strings.
+    """
+
+    needs_fields = True
+
+    def write(self, records, stream, fields):
+        writer, count = self._writer(stream), 0
+        writer.writerow(fields)
+        for record in records:
+            writer.writerow([self._text(record.get(name)) for name in fields])
+            count += 1
+        return count
+
+    def _text(self, value):
+        if value is None:
+            return ''
+        return '{0}'.format(encode_value(value))
+
+    def _writer(self, stream):
+        if six.PY3:
+            return csv.writer(codecs.getwriter('utf-8')(stream))
+        return _EncodedWriter(csv.writer(stream))
+
+    def read(self, stream):
+        if six.PY3:
+            rows = csv.reader(codecs.getreader('utf-8')(stream))
+        else:
+            rows = ([cell.decode('utf-8') for cell in row] for row in csv.reader(stream))
+        header = None
+        for row in rows:
+            if header is None:
+                header = row
+                continue
+            yield decode_record(dict(zip(header, row)))
+
+
+class _EncodedWriter(object):
+    "CSV writer for Python 2 which encodes each value as UTF-8."
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def writerow(self, row):
+        self.writer.writerow([value.encode('utf-8') for value in row])
+
+
+class ColumnarFormat(object):
+    """
+    Compact binary format which stores blocks of up to block_size records. Each block
+    holds a list of the values of each field, so repeated values such as the location
+    or status are next to each other, compressed with zlib. Blocks are preceded by
+    their length and the file ends with an empty block.
+    """
+
+    magic = b'HCCOL1\n'
+    header = struct.Struct('>I')
+
+    def __init__(self, block_size=1000, level=6):
+        self.block_size, self.level = block_size, level
+
+    def write(self, records, stream, fields=None):
+        stream.write(self.magic)
+        count = 0
+        for block in chunked(records, self.block_size):
+            names = list(fields) if fields is not None else sorted(set().union(*block))
+            columns = dict((name, [encode_value(record.get(name)) for record in block]) for name in names)
+            data = zlib.compress(
+                json.dumps({'rows': len(block), 'columns': columns}, separators=(',', ':')).encode('utf-8'),
+                self.level)
+            stream.write(self.header.pack(len(data)) + data)
+            count += len(block)
+        stream.write(self.header.pack(0))
+        return count
+
+    def _read_exactly(self, stream, size):
+        data = stream.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated columnar file")
+        return data
+
+    def read(self, stream):
+        if self._read_exactly(stream, len(self.magic)) != self.magic:
+            raise ValueError("Not a columnar file")
+        while True:
+            size, = self.header.unpack(self._read_exactly(stream, self.header.size))
+            if not size:
+                return
+            block = json.loads(zlib.decompress(self._read_exactly(stream, size)).decode('utf-8'))
+            names = list(block['columns'])
+            columns = [block['columns'][name] for name in names]
+            for i in range(block['rows']):
+                yield decode_record(dict((name, column[i]) for name, column in zip(names, columns)))
+
+
+FORMATS = {
+    'ndjson': NDJSONFormat,
+    'csv': CSVFormat,
+    'columnar': ColumnarFormat,
+}
+
+# File extensions of each format used when none is given
+EXTENSIONS = {
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.csv': 'csv',
+    '.hcol': 'columnar',
+}
+
+
+def get_format(name=None, filename=None):
+    "Return the format for the name or, when there is none, the extension of the filename."
+    if name is None and filename:
+        for extension, format_name in EXTENSIONS.items():
+            if filename.lower().endswith(extension):
+                name = format_name
+    if name not in FORMATS:
+        raise ImproperlyConfigured("Unknown export format '%s'" % name)
+    return FORMATS[name]()
+
+
+def export_records(wrapper, stream, format='ndjson', fields=None, chunk_size=None, **lookups):
+    """
+    Write the records of a client category matching the lookups to a binary stream.
+    Records are streamed from the backend in chunks of chunk_size so memory use doesn't
+    grow with the number of records. Returns the number of records written.
+
+    Only the given fields are written. Formats such as CSV which need the fields up
+    front write the fields of the category in FIELDS when none are given.
+    """
+    if not hasattr(format, 'write'):
+        format = get_format(format)
+    options = dict(lookups)
+    for name, value in (('fields', fields), ('chunk_size', chunk_size)):
+        if value is not None:
+            options[name] = value
+    if fields is None and getattr(format, 'needs_fields', False):
+        fields = FIELDS[wrapper.category]
+    return format.write(wrapper.filter(**options), stream, fields=fields)
+
+
+class ImportResult(object):
+    """
+    Outcome of an import: the number of records read and created, the reason each
+    failed record wasn't created by its position in the file and the time taken.
+    """
+
+    def __init__(self):
+        self.rows = self.created = 0
+        self.errors = {}
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        "Records read per second."
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def import_records(wrapper, stream, format='ndjson', batch_size=None, workers=1,
+                   exclude=GENERATED_FIELDS):
+    """
+    Create the records read from a binary stream with the bulk create of a client
+    category. Batches of batch_size records are passed to bulk create by up to workers
+    threads; only a few batches are read ahead of them so memory use is bounded.
+    The excluded fields, by default those generated by the backend, are left out.
+    """
+    if not hasattr(format, 'read'):
+        format = get_format(format)
+    batch_size = batch_size or wrapper.bulk_batch_size
+    result = ImportResult()
+    start = time.time()
+
+    def records():
+        for record in format.read(stream):
+            for name in exclude:
+                record.pop(name, None)
+            yield record
+
+    def add(offset, outcome):
+        result.created += len(outcome) - len(outcome.errors)
+        for position, reason in outcome.errors.items():
+            result.errors[offset + position] = reason
+
+    batches = chunked(records(), batch_size)
+    if workers <= 1:
+        for batch in batches:
+            add(result.rows, wrapper.bulk_create(batch, batch_size=batch_size))
+            result.rows += len(batch)
+    else:
+        if ThreadPoolExecutor is None:
+            raise ImproperlyConfigured(
+                "Importing with workers requires concurrent.futures or, on Python 2, futures.")
+        pending = collections.deque()
+        with ThreadPoolExecutor(workers) as executor:
+            for batch in batches:
+                if len(pending) >= workers * 2:
+                    # Wait for the oldest batch rather than reading further ahead
+                    offset, future = pending.popleft()
+                    add(offset, future.result())
+                pending.append((result.rows, executor.submit(wrapper.bulk_create, batch, batch_size)))
+                result.rows += len(batch)
+            for offset, future in pending:
+                add(offset, future.result())
+    result.seconds = time.time() - start
+    return result
+
@@ -0,0 +1,25 @@
+"Shared helpers for the API client and storage backends."
+from __future__ import unicode_literals
+
+import itertools
+
+
+def chunked(iterable, size):
+    "Split an iterable into lists of at most size items."
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def freeze(value):
+    "Convert lists, dictionaries and sets nested in value to hashable equivalents."
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, set):
+        return frozenset(freeze(item) for item in value)
+    return value
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Benchmark the healthcare API client against each storage backend.
+
+Seeds each backend with patients, providers and patient source ids, then times the
+client calls and writes the throughput and latency percentiles of each as JSON so
+the results of different versions can be compared.
+
+    python runbenchmarks.py --patients=10000 --output=results.json
+"""
+import datetime
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+
+
+BACKENDS = {
+    'dummy': 'healthcare.backends.dummy.DummyStorage',
+    'django': 'healthcare.backends.djhealth.DjangoStorage',
+}
+
+
+parser = optparse.OptionParser()
+parser.add_option('--patients', type='int', default=10000, help='Number of patients to seed.')
+parser.add_option('--providers', type='int', default=1000, help='Number of providers to seed.')
+parser.add_option('--operations', type='int', default=500, help='Number of times to run each call.')
+parser.add_option('--backends', default='dummy,django',
+    help='Comma separated backends to run: {0}.'.format(', '.join(sorted(BACKENDS))))
+parser.add_option('--benchmarks', default='', help='Comma separated benchmarks to run, all by default.')
+parser.add_option('--seed', type='int', default=42, help='Random seed for the generated data.')
+parser.add_option('--output', help='File to write the JSON results to, stdout by default.')
+opts, args = parser.parse_args()
+
+
+directory = tempfile.mkdtemp()
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(directory, 'benchmark.db'),
+            }
+        },
+        INSTALLED_APPS=(
+            'healthcare',
+            'healthcare.backends.djhealth',
+        ),
+        HEALTHCARE_STORAGE_BACKEND='healthcare.backends.djhealth.DjangoStorage',
+        SITE_ID=1,
+        SECRET_KEY='this-is-just-for-benchmarks-so-not-that-secret',
+    )
+
+
+import django
+from django.core.management import call_command
+
+import healthcare
+from healthcare.api import HealthcareAPI
+
+
+LOCATIONS = 100
+SOURCE = 'BENCH'
+START = datetime.date(1940, 1, 1)
+# Limit on the records fetched by each filter so that all lookups return similar sizes
+FILTER_LIMIT = 100
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Fixture(object):
+    "Seeded records and the random choices used by the benchmarks."
+
+    def __init__(self, client, rng):
+        self.client, self.rng = client, rng
+        self.patients, self.providers, self.created = [], [], []
+
+    def seed(self, patients, providers):
+        "Create the patients, each with a source id, and providers."
+        rng = self.rng
+        data = [{
+            'name': 'Patient {0}'.format(i), 'sex': rng.choice('MF'),
+            'location': self.location(), 'birth_date': self.date(),
+            'status': rng.choice('AAAAI'),
+        } for i in range(patients)]
+        self.patients = [p['id'] for p in self.client.patients.bulk_create(data).results]
+        for id in self.patients:
+            self.client.patients.link(id, 'UID{0}'.format(id), SOURCE)
+        data = [{'name': 'Provider {0}'.format(i), 'location': self.location()}
+                for i in range(providers)]
+        self.providers = [p['id'] for p in self.client.providers.bulk_create(data).results]
+
+    def location(self):
+        return 'Location {0}'.format(self.rng.randint(0, LOCATIONS - 1))
+
+    def date(self):
+        return START + datetime.timedelta(days=self.rng.randint(0, 365 * 70))
+
+    def patient(self):
+        return self.rng.choice(self.patients)
+
+
+def consume(result):
+    return len(list(result))
+
+
+def get_by_id(fixture):
+    id = fixture.patient()
+    return lambda: fixture.client.patients.get(id)
+
+
+def get_by_source(fixture):
+    uid = 'UID{0}'.format(fixture.patient())
+    return lambda: fixture.client.patients.get(uid, source=SOURCE)
+
+
+def get_provider(fixture):
+    id = fixture.rng.choice(fixture.providers)
+    return lambda: fixture.client.providers.get(id)
+
+
+def filter_lookup(lookup, value):
+    "Benchmark of filter using the given lookup and a function for its value."
+
+    def benchmark(fixture):
+        kwargs = {lookup: value(fixture), 'limit': FILTER_LIMIT}
+        return lambda: consume(fixture.client.patients.filter(**kwargs))
+
+    return benchmark
+
+
+def create_patient(fixture):
+    data = {'name': 'New patient', 'location': fixture.location(), 'birth_date': fixture.date()}
+
+    def create():
+        fixture.created.append(fixture.client.patients.create(**data)['id'])
+
+    return create
+
+
+def update_patient(fixture):
+    id, location = fixture.patient(), fixture.location()
+    return lambda: fixture.client.patients.update(id, location=location)
+
+
+def delete_patient(fixture):
+    # Delete the patients added by the create benchmark so the seeded data is unchanged
+    id = fixture.created.pop() if fixture.created else fixture.client.patients.create(name='Extra')['id']
+    return lambda: fixture.client.patients.delete(id)
+
+
+def link_unlink(fixture):
+    id = fixture.patient()
+    uid = 'LINK{0}'.format(fixture.rng.random())
+
+    def link():
+        fixture.client.patients.link(id, uid, SOURCE)
+        fixture.client.patients.unlink(id, uid, SOURCE)
+
+    return link
+
+
+BENCHMARKS = (
+    ('get_by_id', get_by_id),
+    ('get_by_source', get_by_source),
+    ('get_provider', get_provider),
+    ('filter_equal', filter_lookup('location', Fixture.location)),
+    ('filter_like', filter_lookup('name__like', lambda f: 'Patient {0}'.format(f.rng.randint(0, 99)))),
+    ('filter_in', filter_lookup('location__in', lambda f: [f.location() for i in range(3)])),
+    ('filter_lt', filter_lookup('birth_date__lt', Fixture.date)),
+    ('filter_lte', filter_lookup('birth_date__lte', Fixture.date)),
+    ('filter_gt', filter_lookup('birth_date__gt', Fixture.date)),
+    ('filter_gte', filter_lookup('birth_date__gte', Fixture.date)),
+    ('create_patient', create_patient),
+    ('update_patient', update_patient),
+    ('delete_patient', delete_patient),
+    ('link_unlink', link_unlink),
+)
+
+
+def percentile(timings, fraction):
+    "Value at the fraction of the sorted timings, using the nearest rank."
+    index = max(int(round(fraction * len(timings))) - 1, 0)
+    return timings[min(index, len(timings) - 1)]
+
+
+def summarize(timings):
+    "Throughput and latency statistics, in milliseconds, of the call timings in seconds."
+    total = sum(timings)
+    timings = sorted(t * 1000 for t in timings)
+    return {
+        'operations': len(timings),
+        'throughput': round(len(timings) / total, 1) if total else None,
+        'mean': round(sum(timings) / len(timings), 4),
+        'p50': round(percentile(timings, 0.5), 4),
+        'p90': round(percentile(timings, 0.9), 4),
+        'p95': round(percentile(timings, 0.95), 4),
+        'p99': round(percentile(timings, 0.99), 4),
+        'max': round(timings[-1], 4),
+    }
+
+
+def run(path, benchmarks):
+    "Seed a client for the backend and time each benchmark."
+    rng = random.Random(opts.seed)
+    fixture = Fixture(HealthcareAPI(path), rng)
+    start = time.time()
+    fixture.seed(opts.patients, opts.providers)
+    results = {'seed_seconds': round(time.time() - start, 2), 'benchmarks': {}}
+    for name, benchmark in benchmarks:
+        timings = []
+        for i in range(opts.operations):
+            # Arguments are chosen before the timer starts so only the call is timed
+            call = benchmark(fixture)
+            start = timer()
+            call()
+            timings.append(timer() - start)
+        results['benchmarks'][name] = summarize(timings)
+        sys.stderr.write('{0} {1}: {2[throughput]} ops/s, p50 {2[p50]}ms, p99 {2[p99]}ms\n'.format(
+            path.rsplit('.', 1)[-1], name, results['benchmarks'][name]))
+    return results
+
+
+def main():
+    names = [name for name in opts.backends.split(',') if name]
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        parser.error('Unknown backends: {0}'.format(', '.join(unknown)))
+    selected = [name for name in opts.benchmarks.split(',') if name]
+    benchmarks = [(name, b) for name, b in BENCHMARKS if not selected or name in selected]
+    if 'django' in names:
+        call_command('syncdb', interactive=False, verbosity=0)
+    output = {
+        'version': healthcare.__version__,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'options': {
+            'patients': opts.patients, 'providers': opts.providers,
+            'operations': opts.operations, 'seed': opts.seed,
+        },
+        'backends': {},
+    }
+    try:
+        for name in names:
+            output['backends'][name] = run(BACKENDS[name], benchmarks)
+    finally:
+        shutil.rmtree(directory)
+    results = json.dumps(output, indent=2, separators=(',', ': '), sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        sys.stdout.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
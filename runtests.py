@@ -1,21 +1,47 @@
 #!/usr/bin/env python
+import atexit
 import optparse
+import os
+import shutil
 import sys
+import tempfile
 
 from django.conf import settings
 
 
 parser = optparse.OptionParser()
+parser.add_option('--postgres', action='store_true', default=False,
+    help='Run the tests against the healthcare, healthcare_replica1 and healthcare_replica2 '
+    'databases of a local PostgreSQL server as the postgres user.')
 opts, args = parser.parse_args()
 
+# SQLite test databases are kept in files, rather than memory, so that worker threads
+# see the same databases. A directory for each run keeps runs from sharing them
+test_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, test_dir, True)
+
+
+def database(name):
+    if opts.postgres:
+        return {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': name,
+            'USER': 'postgres',
+        }
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        'TEST_NAME': os.path.join(test_dir, 'test_{0}.db'.format(name)),
+    }
+
 
 if not settings.configured:
     settings.configure(
         DATABASES={
-            'default': {
-                'ENGINE': 'django.db.backends.sqlite3',
-                'NAME': ':memory:',
-            }
+            'default': database('healthcare'),
+            # Separate databases standing in for read replicas in the routing tests
+            'replica1': database('healthcare_replica1'),
+            'replica2': database('healthcare_replica2'),
         },
         INSTALLED_APPS=(
             'healthcare',